@@ -5,11 +5,11 @@ import pdb
 import numpy as np
 import pandas as pd
 
-from pybliometrics.scopus import AbstractRetrieval
 from data import utils
+from data.retrieval import Retriever
 
 
-def find_authors(abst_path, dois_path, entries):
+def find_authors(abst_path, dois_path, entries, retriever=None):
     """Listing all the authors who have at least one publlication which
     contains at least one of the given entries
 
@@ -18,6 +18,11 @@ def find_authors(abst_path, dois_path, entries):
     * `abst_paths`: (str) path to abstracts file
     * `dois_path`: (str) path to the list of DOIs
     * `entries`: (list) list of strings, each string is an entry
+    * `retriever`: (data.retrieval.Retriever) retriever of the documents
+                   (default: sequential, without cache)
+
+    All the documents are needed, hence retrieval errors (including an
+    exhausted quota, `Scopus429Error`) are raised.
 
     ** Returns:
 
@@ -32,7 +37,7 @@ def find_authors(abst_path, dois_path, entries):
     # domain of the search (DOIs)
     doi_list = pd.read_csv(dois_path, header=None)
 
-    auids = []
+    # scanning the abstracts first, and then retrieving the documents together
     dois = []
     with open(abst_path, 'r', encoding='utf-8') as f:
         for i,line in enumerate(f):
@@ -41,8 +46,14 @@ def find_authors(abst_path, dois_path, entries):
                 if np.any([p.normalized_formula(e) in abst 
                            for e in entries]):
                     dois += [doi_list.iloc[i][0]]
-                    doc = AbstractRetrieval(dois[-1]) 
-                    auids += [[a.auid for a in doc.authors]]
+
+    if retriever is None:
+        retriever = Retriever()
+    auids = []
+    for doi, doc in retriever.map(dois):
+        if isinstance(doc, Exception):
+            raise doc
+        auids += [[a.auid for a in doc.authors]]
                 
 
     # unique authors and their documents
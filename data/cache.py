@@ -0,0 +1,201 @@
+import os
+import re
+import json
+import time
+import atexit
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+
+
+class QueryCache(object):
+    """Disk-backed cache of query results
+
+    Each entry is keyed by the normalized SQL command plus its parameters and
+    is stored as a compressed NumPy file with one array per column. Entries
+    also keep versions of the tables that they read from (e.g. their row counts
+    or checksums) and are invalidated once these versions change. The total
+    size of the cache is bounded by `max_bytes` through evicting the least
+    recently used entries. Access times of the entries are updated in memory
+    on hits and persisted (along with the other changes of the index) on the
+    next `put`, `clear` or `flush` (also called at exit).
+    """
+
+    def __init__(self, cache_dir, max_bytes=2**30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'evictions': 0}
+        self.dirty = False
+        atexit.register(self.flush)
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                self.index = json.load(f)
+        else:
+            self.index = {}
+
+    @staticmethod
+    def make_key(scomm, args=None):
+        normalized = ' '.join(scomm.split()).rstrip(';')
+        params = json.dumps([] if args is None else [str(a) for a in args])
+        return hashlib.sha1((normalized + params).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def tables_of(scomm):
+        """Extracting names of the tables that a query reads from
+        """
+        return sorted(set(re.findall(r'\b(?:FROM|JOIN)\s+`?(\w+)', scomm, re.IGNORECASE)))
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, '{}.npz'.format(key))
+
+    def get(self, key, versions):
+        """Returning the cached rows of a key (as a list of tuples), or None
+        if the key is missing (also from the disk) or its table versions are
+        outdated
+        """
+        with self.lock:
+            entry = self.index.get(key, None)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            if entry['versions'] != versions:
+                self.stats['invalidations'] += 1
+                self.stats['misses'] += 1
+                self.remove(key)
+                return None
+
+            # the entry is read under the lock, such that it is not evicted meanwhile
+            try:
+                with np.load(self.entry_path(key), allow_pickle=True) as npz:
+                    cols = [npz['col{}'.format(i)].tolist() for i in range(entry['ncols'])]
+            except FileNotFoundError:
+                self.stats['misses'] += 1
+                self.remove(key)
+                return None
+
+            entry['atime'] = time.time()
+            self.dirty = True
+            self.stats['hits'] += 1
+        return list(zip(*cols))
+
+    def put(self, key, rows, versions):
+        ncols = len(rows[0]) if len(rows)>0 else 0
+        cols = {'col{}'.format(i): np.array(col) for i, col in enumerate(zip(*rows))}
+        path = self.entry_path(key)
+        np.savez_compressed(path, **cols)
+
+        with self.lock:
+            self.index[key] = {'versions': versions,
+                               'ncols': ncols,
+                               'size': os.path.getsize(path),
+                               'atime': time.time()}
+            self.evict()
+            self.save_index()
+
+    def remove(self, key):
+        self.index.pop(key, None)
+        self.dirty = True
+        if os.path.exists(self.entry_path(key)):
+            os.remove(self.entry_path(key))
+
+    def evict(self):
+        """Removing least recently used entries until the total size
+        is within the limit
+        """
+        total = sum([e['size'] for e in self.index.values()])
+        for key in sorted(self.index, key=lambda k: self.index[k]['atime']):
+            if total <= self.max_bytes:
+                break
+            total -= self.index[key]['size']
+            self.remove(key)
+            self.stats['evictions'] += 1
+
+    def save_index(self):
+        with open(self.index_path + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(self.index_path + '.tmp', self.index_path)
+        self.dirty = False
+
+    def flush(self):
+        """Saving the changes of the index (e.g. access times), if any
+        """
+        with self.lock:
+            if self.dirty:
+                self.save_index()
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.index):
+                self.remove(key)
+            self.save_index()
+
+    def summary(self):
+        with self.lock:
+            nlookups = self.stats['hits'] + self.stats['misses']
+            summary = dict(self.stats)
+            summary['hit_rate'] = self.stats['hits']/nlookups if nlookups>0 else np.nan
+            summary['entries'] = len(self.index)
+            summary['bytes'] = sum([e['size'] for e in self.index.values()])
+        return summary
+
+
+class MemoCache(object):
+    """In-memory memo of the results of a function, bounded to `maxsize`
+    entries by evicting the least recently used ones
+
+    The entries can be dumped and restored later (e.g. through a file), such
+    that the memo persists across runs.
+    """
+
+    def __init__(self, maxsize=2**20):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, key, func):
+        """Returning the memoized result of a key, or computing it by `func`
+        (without arguments) and memoizing it
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return self.entries[key]
+            self.stats['misses'] += 1
+
+        res = func()
+        with self.lock:
+            self.entries[key] = res
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+        return res
+
+    def dump(self):
+        """Returning the entries as a list of (key, result), from the least
+        recently used one
+        """
+        with self.lock:
+            return list(self.entries.items())
+
+    def restore(self, entries):
+        with self.lock:
+            for key, res in entries[-self.maxsize:]:
+                self.entries[key] = res
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def summary(self):
+        with self.lock:
+            nlookups = self.stats['hits'] + self.stats['misses']
+            summary = dict(self.stats)
+            summary['hit_rate'] = self.stats['hits']/nlookups if nlookups>0 else np.nan
+            summary['entries'] = len(self.entries)
+        return summary
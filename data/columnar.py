@@ -0,0 +1,118 @@
+import os
+import re
+import glob
+import numpy as np
+
+
+def encode_strings(values):
+    """Encoding a list of strings (or None's) into a flat array of UTF-8
+    bytes, offsets of the strings in it and a mask of the None's
+    """
+    isnull = np.array([v is None for v in values], dtype=bool)
+    data = [b'' if v is None else str(v).encode('utf-8') for v in values]
+    offsets = np.zeros(len(data)+1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(x) for x in data])
+    return np.frombuffer(b''.join(data), dtype=np.uint8), offsets, isnull
+
+
+def decode_strings(data, offsets, isnull):
+    buff = data.tobytes()
+    return np.array([None if isnull[i] else buff[offsets[i]:offsets[i+1]].decode('utf-8')
+                     for i in range(len(isnull))], dtype=object)
+
+
+def partition_dir(export_dir, year):
+    return os.path.join(export_dir, 'year={}'.format(year))
+
+
+def write_part(part_path, columns):
+    """Writing a part of a partition, given as a dictionary of columns;
+    numeric columns are stored as they are and the other ones as encoded
+    strings (see `encode_strings`)
+
+    The part is written into a temporary file first, hence readers never
+    see incomplete parts.
+    """
+
+    arrays = {}
+    for name, values in columns.items():
+        values = np.asarray(values) if not(isinstance(values, list)) else values
+        if isinstance(values, np.ndarray) and (values.dtype.kind in 'iufb'):
+            arrays[name] = values
+        else:
+            arrays[name+'.data'], arrays[name+'.offsets'], arrays[name+'.isnull'] = \
+                encode_strings(list(values))
+
+    if not os.path.exists(os.path.dirname(part_path)):
+        os.makedirs(os.path.dirname(part_path), exist_ok=True)
+    with open(part_path + '.tmp', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(part_path + '.tmp', part_path)
+
+
+def read_part(part_path, columns=None):
+    """Reading (a projection of) the columns of a part; only the arrays of
+    the requested columns are loaded from the file
+    """
+
+    with np.load(part_path) as npz:
+        names = []
+        for key in npz.files:
+            name = key.rsplit('.', 1)[0] if key.endswith(('.data', '.offsets', '.isnull')) else key
+            if name not in names:
+                names += [name]
+        if columns is None:
+            columns = names
+
+        res = {}
+        for name in columns:
+            if name in npz.files:
+                res[name] = npz[name]
+            elif name+'.data' in npz.files:
+                res[name] = decode_strings(npz[name+'.data'], npz[name+'.offsets'], npz[name+'.isnull'])
+            else:
+                raise KeyError('Column {} does not exist in {}.'.format(name, part_path))
+
+    return res
+
+
+def part_paths(export_dir, years=None):
+    """Listing (year, path) of the parts of the partitions (one directory
+    per year), restricted to the given years
+    """
+
+    res = []
+    for path in glob.glob(os.path.join(export_dir, 'year=*')):
+        year = int(re.search(r'year=(\d+)$', path).group(1))
+        if (years is None) or (year in years):
+            res += [(year, p) for p in sorted(glob.glob(os.path.join(path, '*.npz')))]
+
+    return sorted(res)
+
+
+def iter_parts(export_dir, columns=None, years=None):
+    """Iterating over the parts of the partitions, yielding (year, columns)
+    pairs; partitions of the years that are not given are never opened and
+    only the requested columns are loaded ("year" can be one of them too)
+    """
+
+    for year, path in part_paths(export_dir, years):
+        cols = None if columns is None else [c for c in columns if c!='year']
+        res = read_part(path, cols)
+        if (columns is not None) and ('year' in columns):
+            nrows = len(next(iter(res.values()))) if len(res)>0 else 0
+            res['year'] = np.full(nrows, year)
+        yield year, res
+
+
+def read_columns(export_dir, columns, years=None):
+    """Reading the given columns of all the parts of the partitions of the
+    given years, concatenated together
+    """
+
+    res = {c: [] for c in columns}
+    for _, part in iter_parts(export_dir, columns, years):
+        for c in columns:
+            res[c] += [part[c]]
+
+    return {c: np.concatenate(v) if len(v)>0 else np.array([], dtype=object) for c, v in res.items()}
@@ -0,0 +1,120 @@
+import sys
+
+path = '/home/jamshid/codes/social-knowledge-analysis/'
+sys.path.insert(0, path)
+from data import readers
+from misc.helpers import ordered_pool_map
+
+
+def paper_batches(db, start_id=None, batch_size=10000):
+    """Yielding batches of rows (ID, title, abstract) of papers with IDs
+    larger than `start_id` (all papers, if None), in the order of their IDs
+
+    Batches are read by key-set pagination, hence no connection is held
+    between the batches.
+    """
+    while True:
+        scomm = 'SELECT id, title, abstract FROM paper'
+        args = None
+        if start_id is not None:
+            scomm += ' WHERE id>%s'
+            args = [start_id]
+        rows = db.run_query(scomm + ' ORDER BY id LIMIT {};'.format(int(batch_size)), args)
+        if len(rows)==0:
+            break
+        yield rows
+        start_id = rows[-1][0]
+
+
+def extract_paper_chemicals(rows):
+    """Extracting normalized chemical formulas of a batch of papers, given
+    as rows of (ID, title, abstract), by the text processor of the current
+    process (see `data.readers.init_text_processor`); returns a list of
+    (ID, [formulas]) with the unique formulas of each paper
+    """
+
+    res = []
+    for pid, title, abstract in rows:
+        ccs = []
+        for text in [title, abstract]:
+            if text is None:
+                continue
+            # materials are given as (original form, normalized formula)
+            ccs += [x[1] for x in readers.text_processor.process(text)[1]]
+        res += [(pid, list(dict.fromkeys(ccs)))]
+
+    return res
+
+
+def populate_entity_mapping(db, **kwargs):
+    """Extracting chemical formulas from titles and abstracts of the papers
+    and storing them in the entity table and the entity-paper mapping table
+    of the database (`db.entity_tab` and `db.entity_tab`_paper_mapping),
+    which are created if they do not exist
+
+    Papers are read in batches of `batch_size` (sorted by their IDs) and
+    processed by a pool of `nworkers` processes, each with its own text
+    processor. Formulas are deduplicated against the existing entities (in
+    a dictionary loaded once) and only the new ones are added. New entities
+    and mappings of each batch are inserted together and committed once.
+
+    With `incremental=True` (default), only the papers after the last paper
+    in the mapping table are processed; since every batch is committed
+    atomically, papers up to that one have already been processed. Otherwise,
+    the mapping table is emptied and all the papers are processed.
+
+    *Keyword arguments:*
+
+    * batch_size: number of papers in each batch (default: 10000)
+    * nworkers: number of processes (default: 1)
+    * incremental: processing only the new papers (default: True)
+    * logger: logger of the progress
+    """
+
+    batch_size = kwargs.get('batch_size', 10000)
+    nworkers = kwargs.get('nworkers', 1)
+    incremental = kwargs.get('incremental', True)
+    logger = kwargs.get('logger', None)
+
+    ent_tab, ent_col = db.entity_tab, db.entity_col
+    map_tab = '{}_paper_mapping'.format(ent_tab)
+    db.execute_update('CREATE TABLE IF NOT EXISTS {} (id INT PRIMARY KEY, \
+                       {} VARCHAR(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin);'.format(
+                           ent_tab, ent_col))
+    db.execute_update('CREATE TABLE IF NOT EXISTS {} ({}_id INT, paper_id INT);'.format(
+        map_tab, ent_tab))
+
+    ents = {x[1]: x[0] for x in db.run_query('SELECT id, {} FROM {};'.format(ent_col, ent_tab))}
+    next_id = max(list(ents.values())+[-1]) + 1
+
+    start_id = None
+    if incremental:
+        start_id = db.run_query('SELECT MAX(paper_id) FROM {};'.format(map_tab))[0][0]
+    else:
+        db.execute_update('DELETE FROM {};'.format(map_tab))
+    if logger is not None:
+        logger.info('Extracting chemicals from papers with IDs larger than {}'.format(start_id))
+
+    ent_scomm = 'INSERT INTO {} (id, {}) VALUES (%s, %s);'.format(ent_tab, ent_col)
+    map_scomm = 'INSERT INTO {} ({}_id, paper_id) VALUES (%s, %s);'.format(map_tab, ent_tab)
+    nP, nM = 0, 0
+    batches = paper_batches(db, start_id, batch_size)
+    for rows, res in ordered_pool_map(extract_paper_chemicals, batches, nworkers,
+                                      readers.init_text_processor):
+        new_ents, mappings = [], []
+        for pid, ccs in res:
+            for cc in ccs:
+                if cc not in ents:
+                    ents[cc] = next_id
+                    new_ents += [(next_id, cc)]
+                    next_id += 1
+                mappings += [(ents[cc], pid)]
+        db.execute_batch([(ent_scomm, new_ents), (map_scomm, mappings)])
+
+        nP += len(rows)
+        nM += len(mappings)
+        if logger is not None:
+            logger.info('{} papers (last ID: {}) have been processed: {} entities, {} mappings.'.format(
+                nP, rows[-1][0], len(ents), nM))
+
+    return nP, nM
@@ -1,21 +1,33 @@
 import os
-import gc
 import re
 import sys
 import pdb
+import glob
 import gzip
 import json
+import time
 import pymysql
 import numpy as np
 from lxml import etree
 from zipfile import ZipFile
+from functools import partial
+from multiprocessing import Pool
+
+path = '/home/jamshid/codes/social-knowledge-analysis'
+sys.path.insert(0, path)
+
+from data import columnar
 
 root_dir = '/srv/wos2019/wos_raw/xml/'
 
+# columns of the stored/exported records
+WOS_COLUMNS = ['number', 'type', 'date', 'title', 'abstract', 'doi']
+
 class WOSextractor(object):
 
     def __init__(self, path, sql_config_path=None,):
         self.path = path
+        self.sql_config_path = sql_config_path
         if sql_config_path is None:
             self.db = None
         else:
@@ -32,8 +44,6 @@ class WOSextractor(object):
         self.crsr = self.db.cursor()
 
     def create_db(self):
-        self.year = year
-        
         sql = 'CREATE DATABASE IF NOT EXISTS {};'.format(self.db_name)
         try:
             self.crsr.execute(sql)    
@@ -44,7 +54,7 @@ class WOSextractor(object):
             print('Something went wrong..')
 
     def create_table(self, table_name):
-        sql = "CREATE TABLE IF NOT EXISTS {} (number INT, \
+        sql = "CREATE TABLE IF NOT EXISTS {} (number BIGINT, \
                                               type TEXT, \
                                               date DATE, \
                                               title TEXT, \
@@ -53,7 +63,17 @@ class WOSextractor(object):
         self.crsr.execute(sql)
 
         
-    def store_WOS_docs_info(self, table_name, year=None):
+    def store_WOS_docs_info(self, table_name, year=None, batch_size=1000):
+        """Streaming the WOS records of one year into a table
+
+        Each gzipped XML member of the year's zip archive is parsed
+        incrementally (see `iter_records`), such that only one record is in
+        memory at a time. Rows are inserted in batches of `batch_size` by
+        `executemany` with bound parameters; rows of a failed batch are
+        retried one by one and the ones that still fail are kept in
+        `self.bad_rows`. Number of records, elapsed time and throughput of
+        each member file are kept in `self.throughput`.
+        """
 
         if year is None:
             year = int(re.search(r'\d+', table_name).group())
@@ -64,49 +84,285 @@ class WOSextractor(object):
             # reading all files in the namelist
             cnt = 0
             self.bad_rows = []
+            self.throughput = []
             for name in f.namelist():
-                print('Only adding subfile {}'.format(name)) # temp
                 if '.xml.gz' not in name:
                     continue
+                cnt += self.store_member(f, name, table_name, cnt, batch_size)
+
+    def store_member(self, f, name, table_name, start_number=0, batch_size=1000, max_records=None):
+        """Streaming the records of one member of an opened zip archive into
+        a table, numbering them from `start_number`; returns the number of
+        records (which should not exceed `max_records`, if given)
+        """
+
+        sql = 'INSERT INTO {} VALUES (%s, %s, %s, %s, %s, %s);'.format(table_name)
+        t0 = time.time()
+        nrecs = 0
+        rows = []
+        with gzip.open(f.open(name), 'r') as z:
+            for doc in iter_records(z):
+                if (max_records is not None) and (nrecs>=max_records):
+                    raise ValueError('{} has more than {} records.'.format(name, max_records))
+                rows += [(start_number+nrecs,) + extract_info_from_one_doc(doc)]
+                nrecs += 1
+                if len(rows)>=batch_size:
+                    self.insert_rows(sql, rows)
+                    rows = []
+        self.insert_rows(sql, rows)
+
+        elapsed = time.time() - t0
+        self.throughput += [{'file': name,
+                             'records': nrecs,
+                             'seconds': elapsed,
+                             'records_per_sec': nrecs/elapsed if elapsed>0 else np.nan}]
+        print('{}: {} records in {:.1f} s ({:.0f} records/s)'.format(
+            name, nrecs, elapsed, self.throughput[-1]['records_per_sec']))
+
+        return nrecs
+
+    def store_WOS_years(self, years, table_name, manifest_path, nworkers=1, **kwargs):
+        """Ingesting the WOS records of multiple years in parallel
+
+        Each (year, member) pair of the years' zip archives is a work unit
+        that is processed by one of `nworkers` processes (each with its own
+        connection, see `init_worker_extractor`). `table_name` can include
+        "{year}" to store each year in a separate table.
+
+        Records are numbered globally as `unit ID * stride + (index of the
+        record in its member)`, where the unit IDs are assigned once (in the
+        order of years and members) and kept in the JSON manifest at
+        `manifest_path`, hence the numbers do not depend on the order in
+        which the units are processed. The manifest also keeps the status,
+        number of records and elapsed time of the units; re-running with the
+        same manifest skips the finished units, and removes the rows of the
+        unfinished ones before processing them again.
+
+        *Keyword arguments:*
+
+        * batch_size: number of rows per insertion (default: 1000)
+        * stride: maximum number of records in one member (default: 10^6)
+        * export_dir: if given, the records are exported into columnar
+          files partitioned by year in this directory (see `export_member`),
+          instead of being stored in the database (`table_name` is ignored)
+        * part_size: maximum number of records in one exported part
+          (default: 100000)
+        """
+
+        batch_size = kwargs.get('batch_size', 1000)
+        stride = kwargs.get('stride', 10**6)
+        export_dir = kwargs.get('export_dir', None)
+        part_size = kwargs.get('part_size', 100000)
+
+        manifest = {'stride': stride, 'units': {}}
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                manifest = json.load(f)
+            assert manifest['stride']==stride, 'Stride of the manifest is {}.'.format(manifest['stride'])
+        units = manifest['units']
+
+        def save_manifest():
+            with open(manifest_path + '.tmp', 'w') as f:
+                json.dump(manifest, f, indent=1)
+            os.replace(manifest_path + '.tmp', manifest_path)
+
+        if export_dir is None:
+            self.crsr.execute('USE {};'.format(self.db_name))
+        todo = []
+        next_id = max([u['id'] for u in units.values()]+[-1]) + 1
+        for year in sorted(years):
+            with ZipFile(os.path.join(self.path, '{}_DSSHPSH.zip'.format(year)), 'r') as f:
+                names = sorted([name for name in f.namelist() if '.xml.gz' in name])
+            table = None if export_dir is not None else table_name.format(year=year)
+            if table is not None:
+                self.create_table(table)
+            for name in names:
+                key = '{}/{}'.format(year, name)
+                if key not in units:
+                    units[key] = {'id': next_id, 'year': year, 'member': name, 'status': 'new'}
+                    next_id += 1
+                if units[key]['status']=='done':
+                    continue
+                # rows of the units that were not finished should be removed
+                todo += [(year, name, table, units[key]['id'], units[key]['status']!='new')]
+                units[key]['status'] = 'running'
+
+        # the largest number should fit in the column of numbers (tables
+        # created before numbers became global may still have INT columns)
+        max_number = next_id*stride - 1
+        for table in set([x[2] for x in todo if x[2] is not None]):
+            self.crsr.execute("SELECT DATA_TYPE FROM information_schema.COLUMNS WHERE \
+                               TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s AND COLUMN_NAME='number';",
+                              [table])
+            res = self.crsr.fetchall()
+            if (len(res)>0) and (res[0][0].lower()!='bigint') and (max_number>=2**31):
+                raise ValueError('Numbers up to {} do not fit in {}.number ({}); '
+                                 'change the column to BIGINT.'.format(max_number, table, res[0][0]))
+        if max_number>=2**63:
+            raise ValueError('Numbers up to {} do not fit in 64 bits.'.format(max_number))
+        save_manifest()
+        if export_dir is None:
+            self.db.commit()
+
+        func = partial(ingest_unit, stride=stride, batch_size=batch_size,
+                       export_dir=export_dir, part_size=part_size)
+        init = partial(init_worker_extractor, self.path,
+                       self.sql_config_path if export_dir is None else None)
+        if nworkers>1:
+            pool = Pool(nworkers, initializer=init)
+            results = pool.imap_unordered(func, todo)
+        else:
+            init()
+            pool = None
+            results = map(func, todo)
+
+        try:
+            for year, name, nrecs, elapsed, nbad, error in results:
+                unit = units['{}/{}'.format(year, name)]
+                if error is None:
+                    unit.update({'status': 'done', 'records': nrecs, 'seconds': elapsed, 'bad_rows': nbad})
+                else:
+                    unit.update({'status': 'failed', 'error': error})
+                    print('{}/{} failed: {}'.format(year, name, error))
+                save_manifest()
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
-                with gzip.open(f.open(name), 'r') as z:
-                    # get the XML root
-                    root = etree.XML(z.read())
-
-                    for i in range(len(root)):
-                        doc = root[i]
-                        (doctype,
-                         docdate,
-                         doctitle,
-                         docabstract,
-                         docdoi) = extract_info_from_one_doc(doc)
-
-                        sql = """INSERT INTO {} VALUES ({}, "{}", "{}", "{}", "{}", "{}")""".format(
-                            table_name, cnt, doctype, docdate, doctitle, docabstract, docdoi)
-
-                        try:
-                            self.crsr.execute(sql)
-                        except:
-                            self.bad_rows += [sql]
-
-                        if not(cnt%1000):
-                            self.db.commit()
-                            #print(cnt, end=',')
-                        cnt += 1
-                        
-                    del root
-                    gc.collect()
-                    
+        return manifest
+
+    def export_member(self, f, name, part_prefix, start_number=0, part_size=100000, max_records=None):
+        """Exporting the records of one member of an opened zip archive into
+        columnar parts (see `data.columnar.write_part`) with paths
+        `part_prefix`-XXXX.npz, each with at most `part_size` records;
+        returns the number of records
+        """
+
+        t0 = time.time()
+        nrecs, npart = 0, 0
+        rows = []
+
+        def write_rows():
+            cols = list(zip(*rows))
+            columnar.write_part('{}-{:04d}.npz'.format(part_prefix, npart),
+                                {'number': np.array(cols[0], dtype=np.int64),
+                                 **{c: list(cols[i]) for i,c in enumerate(WOS_COLUMNS) if i>0}})
+
+        with gzip.open(f.open(name), 'r') as z:
+            for doc in iter_records(z):
+                if (max_records is not None) and (nrecs>=max_records):
+                    raise ValueError('{} has more than {} records.'.format(name, max_records))
+                rows += [(start_number+nrecs,) + extract_info_from_one_doc(doc)]
+                nrecs += 1
+                if len(rows)>=part_size:
+                    write_rows()
+                    npart += 1
+                    rows = []
+        if len(rows)>0:
+            write_rows()
+
+        elapsed = time.time() - t0
+        self.throughput += [{'file': name,
+                             'records': nrecs,
+                             'seconds': elapsed,
+                             'records_per_sec': nrecs/elapsed if elapsed>0 else np.nan}]
+        print('{}: {} records exported in {:.1f} s ({:.0f} records/s)'.format(
+            name, nrecs, elapsed, self.throughput[-1]['records_per_sec']))
+
+        return nrecs
+
+    def insert_rows(self, sql, rows):
+        """Inserting a batch of rows and committing them; if the batch fails,
+        its rows are inserted one by one and the failed ones are kept in
+        `self.bad_rows`
+        """
+        if len(rows)==0:
+            return
+        try:
+            self.crsr.executemany(sql, rows)
+        except pymysql.Error:
+            self.db.rollback()
+            for row in rows:
+                try:
+                    self.crsr.execute(sql, row)
+                except pymysql.Error:
+                    self.bad_rows += [(sql, row)]
         self.db.commit()
-        
+
     def reenter_bad_rows(self):
-        for r in self.bad_rows:
-            r = r.replace('\\','')
-            self.crsr.execute(r)
+        for sql, row in self.bad_rows:
+            row = tuple([x.replace('\\','') if isinstance(x, str) else x for x in row])
+            self.crsr.execute(sql, row)
 
         self.db.commit()
 
 
+# extractor (with its own connection) of each worker process
+worker_extractor = None
+
+def init_worker_extractor(path, sql_config_path):
+    global worker_extractor
+    worker_extractor = WOSextractor(path, sql_config_path)
+    if worker_extractor.db is not None:
+        worker_extractor.crsr.execute('USE {};'.format(worker_extractor.db_name))
+    worker_extractor.bad_rows = []
+    worker_extractor.throughput = []
+
+
+def ingest_unit(unit, stride, batch_size, export_dir=None, part_size=100000):
+    """Storing (or exporting, if `export_dir` is given) one (year, member)
+    work unit by the extractor of the current worker; returns (year, member,
+    number of records, elapsed time, number of bad rows, error message or None)
+    """
+
+    year, name, table_name, unit_id, clean = unit
+    ext = worker_extractor
+    nbad = len(ext.bad_rows)
+    t0 = time.time()
+    try:
+        with ZipFile(os.path.join(ext.path, '{}_DSSHPSH.zip'.format(year)), 'r') as f:
+            if export_dir is not None:
+                part_prefix = os.path.join(columnar.partition_dir(export_dir, year),
+                                           'part-{:06d}'.format(unit_id))
+                if clean:
+                    for path in glob.glob(part_prefix + '-*.npz'):
+                        os.remove(path)
+                nrecs = ext.export_member(f, name, part_prefix, unit_id*stride, part_size, stride)
+            else:
+                if clean:
+                    ext.crsr.execute('DELETE FROM {} WHERE number>=%s AND number<%s;'.format(table_name),
+                                     [unit_id*stride, (unit_id+1)*stride])
+                    ext.db.commit()
+                nrecs = ext.store_member(f, name, table_name, unit_id*stride, batch_size, stride)
+    except Exception as e:
+        if ext.db is not None:
+            ext.db.rollback()
+        return year, name, None, time.time()-t0, None, repr(e)
+
+    return year, name, nrecs, time.time()-t0, len(ext.bad_rows)-nbad, None
+
+
+def iter_records(fileobj):
+    """Iterating over the records (children of the root) of a WOS XML file
+    by `iterparse`, clearing each record (and dropping it from the root)
+    once it is consumed, so that the memory usage does not grow with the
+    size of the file
+    """
+
+    depth = 0
+    for event, elem in etree.iterparse(fileobj, events=('start', 'end')):
+        if event=='start':
+            depth += 1
+            continue
+        depth -= 1
+        if depth==1:
+            yield elem
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+
 def extract_info_from_one_doc(doc):
     """Extracting various information from a single
     document
@@ -136,7 +392,6 @@ def extract_info_from_one_doc(doc):
         if t.get('type')=='item':
             doctitle = t.text
             doctitle = doctitle.replace('\\','')
-            doctitle = doctitle.replace('"','\\"')
             break
 
     # abstract
@@ -145,7 +400,6 @@ def extract_info_from_one_doc(doc):
                [a.tag for a in doc[1][1].getchildren()]]):
         docabstract = doc[1][1][-1][0][0][0].text
         docabstract = docabstract.replace('\\','')
-        docabstract = docabstract.replace('"','\\"')
 
     # authors (names)
     if False:
@@ -0,0 +1,250 @@
+import os
+import re
+import glob
+import numpy as np
+
+
+def make_segment(pids, texts_list):
+    """Building a segment of the inverted index from a set of papers
+
+    Tokens are the whitespace-separated pieces of the texts of each paper
+    (e.g. its title and abstract), hence any keyword without whitespace
+    that appears in a text is a substring of one of its tokens.
+
+    *Parameters:*
+
+    * pids: array of paper IDs
+    * texts_list: list of texts for each paper (e.g. [title, abstract])
+    """
+
+    vocab = {}
+    tids = []
+    doc_pids = []
+    for pid, texts in zip(pids, texts_list):
+        toks = set()
+        for text in texts:
+            if text is not None:
+                toks.update(text.split())
+        for tok in toks:
+            tids += [vocab.setdefault(tok, len(vocab))]
+        doc_pids += [pid]*len(toks)
+
+    tokens = np.array(list(vocab.keys()), dtype=object)
+    order = np.argsort(tokens.astype(str), kind='stable') if len(tokens)>0 else np.array([], dtype=int)
+    # local token IDs --> ranks of the tokens in the sorted vocabulary
+    ranks = np.empty(len(tokens), dtype=np.int64)
+    ranks[order] = np.arange(len(tokens))
+
+    tids = ranks[np.array(tids, dtype=np.int64)]
+    doc_pids = np.array(doc_pids, dtype=np.int64)
+    sinds = np.lexsort((doc_pids, tids))
+    offsets = np.searchsorted(tids[sinds], np.arange(len(tokens)+1))
+
+    return segment_from_arrays([str(x) for x in tokens[order]],
+                               offsets,
+                               doc_pids[sinds],
+                               np.array(pids, dtype=np.int64))
+
+
+def segment_from_arrays(tokens, offsets, postings, pids):
+    """Forming a segment (dictionary) out of its sorted vocabulary, CSR
+    offsets and postings of the tokens, and the indexed paper IDs; the
+    vocabulary is also kept as a single string (for fast substring search)
+    in case-sensitive and lower-cased forms
+    """
+
+    seg = {'tokens': tokens, 'offsets': offsets, 'postings': postings, 'pids': pids}
+    for name, toks in [('', tokens), ('lower_', [t.lower() for t in tokens])]:
+        lens = np.array([len(t)+1 for t in toks], dtype=np.int64)
+        seg[name+'joined'] = '\n' + '\n'.join(toks) + '\n'
+        seg[name+'starts'] = np.concatenate(([1], 1+np.cumsum(lens)[:-1])) if len(toks)>0 \
+            else np.array([], dtype=np.int64)
+
+    return seg
+
+
+class KeywordIndex(object):
+    """Inverted index over titles and abstracts of papers for answering
+    `LIKE '%keyword%'` queries without scanning the texts
+
+    The index consists of one or more segments, each of which holds a sorted
+    vocabulary of tokens and posting lists (sorted paper IDs) of the tokens.
+    Keywords are looked up by a substring search over the vocabulary (either
+    case-sensitive or case-insensitive) and the postings of the matching
+    tokens are merged. New papers can be added as new segments through
+    `add_papers`; segments can be merged by `merge_segments`.
+
+    Keywords with whitespace are matched as a combination of their pieces,
+    hence their results are candidates (a superset of the exact results) that
+    should be verified against the texts.
+    """
+
+    def __init__(self):
+        self.segments = []
+        self.pids = np.array([], dtype=np.int64)
+        self.years = np.array([], dtype=np.int64)
+
+    def add_papers(self, pids, years, titles, abstracts):
+        """Adding a set of papers as a new segment (incremental update)
+        """
+        self.segments += [make_segment(pids, list(zip(titles, abstracts)))]
+
+        # keep the years sorted by the paper IDs
+        pids = np.concatenate((self.pids, np.asarray(pids, dtype=np.int64)))
+        years = np.concatenate((self.years, np.asarray(years, dtype=np.int64)))
+        sinds = np.argsort(pids, kind='stable')
+        self.pids, self.years = pids[sinds], years[sinds]
+
+    def merge_segments(self):
+        """Merging all the segments into one
+        """
+        if len(self.segments)<2:
+            return
+        tokens = sorted(set().union(*[seg['tokens'] for seg in self.segments]))
+        tok_rank = {t:i for i,t in enumerate(tokens)}
+        tids, postings = [], []
+        for seg in self.segments:
+            ranks = np.array([tok_rank[t] for t in seg['tokens']], dtype=np.int64)
+            tids += [np.repeat(ranks, np.diff(seg['offsets']))]
+            postings += [seg['postings']]
+        tids = np.concatenate(tids)
+        postings = np.concatenate(postings)
+        sinds = np.lexsort((postings, tids))
+        offsets = np.searchsorted(tids[sinds], np.arange(len(tokens)+1))
+        self.segments = [segment_from_arrays(tokens, offsets, postings[sinds],
+                                             np.concatenate([seg['pids'] for seg in self.segments]))]
+
+    def token_postings(self, seg, piece, case_sensitive, where='any'):
+        """Papers (of one segment) having a token that contains `piece`
+        (`where='any'`), ends with it (`'end'`), starts with it (`'start'`) or
+        is equal to it (`'exact'`)
+        """
+        prefix = '' if case_sensitive else 'lower_'
+        if not(case_sensitive):
+            piece = piece.lower()
+        pattern = {'any': '{}', 'end': '{}\n', 'start': '\n{}', 'exact': '\n{}\n'}[where]
+        pattern = pattern.format(re.escape(piece))
+
+        # match positions --> tokens (through the start locations of the tokens)
+        locs = [m.start() + (where in ['start', 'exact']) for m in
+                re.finditer('(?={})'.format(pattern), seg[prefix+'joined'])]
+        toks = np.unique(np.searchsorted(seg[prefix+'starts'], locs, 'right') - 1)
+        offsets = seg['offsets']
+        return np.unique(np.concatenate([seg['postings'][offsets[t]:offsets[t+1]] for t in toks] +
+                                        [np.array([], dtype=np.int64)]))
+
+    def keyword_postings(self, keyword, case_sensitive=False):
+        """Papers having the keyword; exact for keywords without whitespace,
+        otherwise candidates
+        """
+        pieces = keyword.split()
+        res = []
+        for seg in self.segments:
+            if len(pieces)==1:
+                res += [self.token_postings(seg, pieces[0], case_sensitive)]
+                continue
+            # first piece should end a token, the last one should start a token,
+            # and the middle ones should be complete tokens
+            wheres = ['end'] + ['exact']*(len(pieces)-2) + ['start']
+            seg_res = None
+            for piece, where in zip(pieces, wheres):
+                P = self.token_postings(seg, piece, case_sensitive, where)
+                seg_res = P if seg_res is None else np.intersect1d(seg_res, P)
+            res += [seg_res]
+
+        return np.unique(np.concatenate(res + [np.array([], dtype=np.int64)]))
+
+    def search(self, keywords, **kwargs):
+        """Returning papers having (any or all of) the given keywords, along
+        with a flag indicating whether the results are exact or candidates
+        (see the class description)
+
+        Keyword arguments `logical_comb`, `case_sensitives` and `years` are
+        similar to those of `DB.get_papers_by_keywords`.
+        """
+        logical_comb = kwargs.get('logical_comb', 'OR')
+        case_sensitives = kwargs.get('case_sensitives', [])
+        years = kwargs.get('years', [])
+
+        res = None
+        for kw in keywords:
+            P = self.keyword_postings(kw, kw in case_sensitives)
+            if res is None:
+                res = P
+            elif logical_comb=='AND':
+                res = np.intersect1d(res, P)
+            else:
+                res = np.union1d(res, P)
+        if res is None:
+            res = np.array([], dtype=np.int64)
+
+        if len(years)>0:
+            res = res[np.isin(self.years[np.searchsorted(self.pids, res)], years)]
+
+        exact = np.all([len(kw.split())==1 for kw in keywords])
+        return res, exact
+
+    def save(self, index_dir):
+        if not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+        for path in glob.glob(os.path.join(index_dir, 'segment_*.npz')):
+            os.remove(path)
+        np.savez(os.path.join(index_dir, 'years.npz'), pids=self.pids, years=self.years)
+        for i, seg in enumerate(self.segments):
+            np.savez(os.path.join(index_dir, 'segment_{}.npz'.format(i)),
+                     tokens=np.array(seg['joined'][1:-1]),
+                     offsets=seg['offsets'],
+                     postings=seg['postings'],
+                     pids=seg['pids'])
+
+    @classmethod
+    def load(cls, index_dir):
+        index = cls()
+        with np.load(os.path.join(index_dir, 'years.npz')) as npz:
+            index.pids, index.years = npz['pids'], npz['years']
+        nsegs = len(glob.glob(os.path.join(index_dir, 'segment_*.npz')))
+        for i in range(nsegs):
+            with np.load(os.path.join(index_dir, 'segment_{}.npz'.format(i))) as npz:
+                tokens = str(npz['tokens'])
+                index.segments += [segment_from_arrays(tokens.split('\n') if len(tokens)>0 else [],
+                                                       npz['offsets'],
+                                                       npz['postings'],
+                                                       npz['pids'])]
+        return index
+
+
+def build_keyword_index(db, index_dir=None, batch_size=100000, logger=None):
+    """Building the keyword index of all papers in a database; if the index
+    already exists in `index_dir`, only the papers that are not indexed yet
+    will be added (as a new segment)
+    """
+
+    if (index_dir is not None) and os.path.exists(os.path.join(index_dir, 'years.npz')):
+        index = KeywordIndex.load(index_dir)
+    else:
+        index = KeywordIndex()
+
+    scomm = 'SELECT id, YEAR(date), title, abstract FROM paper'
+    args = None
+    if len(index.pids)>0:
+        scomm += ' WHERE id>%s'
+        args = [int(index.pids[-1])]
+
+    nsegs = len(index.segments)
+    for rows in db.stream(scomm + ';', args, batch_size):
+        pids, years, titles, abstracts = zip(*rows)
+        index.add_papers(pids, [-1 if y is None else y for y in years], titles, abstracts)
+        if logger is not None:
+            logger.info('{} papers have been indexed.'.format(len(index.pids)))
+
+    # new papers form a single segment
+    if len(index.segments)>nsegs+1:
+        old_segs = index.segments[:nsegs]
+        index.segments = index.segments[nsegs:]
+        index.merge_segments()
+        index.segments = old_segs + index.segments
+
+    if index_dir is not None:
+        index.save(index_dir)
+
+    return index
@@ -3,14 +3,267 @@ import re
 import sys
 import pdb
 import json
+import queue
+import asyncio
+import time
 import pickle
 import pymysql
+import threading
 import numpy as np
+from functools import partial
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 path = '/home/jamshid/codes/social-knowledge-analysis/'
 sys.path.insert(0, path)
-from data import utils
-from misc.helpers import set_up_logger #, find_first_time_cocrs
+from data import utils, columnar
+from data.cache import QueryCache
+from data.keyword_index import KeywordIndex
+from data.stats import QueryStats, ProfiledCursor
+from data.schema import explain
+from misc.helpers import set_up_logger, first_cocr_locs, ordered_pool_map
+
+
+class ConnectionPool(object):
+    """A simple thread-safe pool of database connections
+
+    Connections are created lazily by calling `connect_func` (without any
+    arguments) up to `size` connections. A thread that asks for a connection
+    while all of them are in use will be blocked until one is returned.
+    Connections that are not in autocommit mode are rolled back when they
+    are returned, such that no transaction (or snapshot) outlives its user.
+    """
+
+    def __init__(self, connect_func, size=4):
+        self.connect_func = connect_func
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.nconns = 0
+        self.lock = threading.Lock()
+
+    def get(self, timeout=None):
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                create = self.nconns < self.size
+                if create:
+                    self.nconns += 1
+            if create:
+                try:
+                    return self.connect_func()
+                except:
+                    with self.lock:
+                        self.nconns -= 1
+                    raise
+            conn = self.idle.get(timeout=timeout)
+
+        # make sure idle connections have not been dropped by the server
+        if hasattr(conn, 'ping'):
+            conn.ping(reconnect=True)
+        return conn
+
+    def put(self, conn):
+        try:
+            if not(getattr(conn, 'get_autocommit', lambda: False)()):
+                conn.rollback()
+        except Exception:
+            # a broken connection is dropped rather than reused
+            self.discard(conn)
+            return
+        self.idle.put(conn)
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self.lock:
+            self.nconns -= 1
+
+    @contextmanager
+    def connection(self):
+        conn = self.get()
+        try:
+            yield conn
+        finally:
+            self.put(conn)
+
+    def close_all(self):
+        """Closing the idle connections; the checked out ones are still
+        counted and will be returned to the pool later
+        """
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            self.discard(conn)
+
+
+# methods that only execute queries for other methods (they are skipped
+# when attributing the queries to methods in the profiles)
+EXECUTION_METHODS = ['db', 'crsr', 'cursor', 'profiled', 'calling_method', 'run_query',
+                     'execute', 'execute_update', 'execute_batch', 'stream',
+                     'execute_and_get_results', 'stream_results']
+
+# name of the temporary table that holds large ID lists
+ID_TABLE = 'tmp_query_ids'
+
+def placeholders(n):
+    """Returning a string of `n` comma-separated parameter placeholders
+    to be used inside an `IN (...)` clause
+    """
+    return ','.join(['%s']*n)
+
+
+def like_pattern(keyword):
+    """Returning the `LIKE` pattern of the texts containing a keyword, with
+    its wildcards (and the escape character "!") escaped, such that the
+    keyword is matched literally; it should be used with `ESCAPE '!'`
+    """
+    return '%{}%'.format(re.sub(r'([!%_])', r'!\1', keyword))
+
+
+def group_by_key(keys, columns):
+    """Grouping values of a set of columns (given as a dictionary 
+    {name: array}) by a key array through a single sort
+
+    *Returns:*
+
+    * distinct keys
+    * offsets such that rows of the i-th key are located in 
+      `offsets[i]:offsets[i+1]` of the value arrays
+    * dictionary of the value arrays sorted by the keys
+    """
+
+    keys = np.asarray(keys)
+    sinds = np.argsort(keys, kind='stable')
+    ukeys, offsets = np.unique(keys[sinds], return_index=True)
+    offsets = np.append(offsets, len(keys))
+    values = {name: np.asarray(arr)[sinds] for name, arr in columns.items()}
+
+    return ukeys, offsets, values
+
+
+def groups_to_dict(ukeys, offsets, values):
+    """Viewing grouped values (outputs of `group_by_key`) as a dictionary
+    {key: {name: array}}; the arrays are slices (not copies) of the values 
+    """
+    return {k: {name: arr[offsets[i]:offsets[i+1]] for name, arr in values.items()}
+            for i, k in enumerate(ukeys)}
+
+
+def concat_groups(groups):
+    """Concatenating a list of grouped values (outputs of `group_by_key`)
+    with distinct keys
+    """
+    ukeys = np.concatenate([g[0] for g in groups])
+    shifts = np.cumsum([0] + [g[1][-1] for g in groups])
+    offsets = np.concatenate([g[1][:-1]+shifts[i] for i, g in enumerate(groups)] +
+                             [shifts[-1:]])
+    values = {name: np.concatenate([g[2][name] for g in groups]) for name in groups[0][2]}
+
+    return ukeys, offsets, values
+
+
+def papers_by_year(years, pids):
+    """Listing papers (given with their years) by their years as a
+    dictionary {year: [paper IDs]}
+    """
+    sinds = np.lexsort((pids, years))
+    yrs, starts = np.unique(np.asarray(years)[sinds], return_index=True)
+    return {yr: P.tolist() for yr, P in zip(yrs.tolist(),
+                                           np.split(np.asarray(pids)[sinds], starts[1:]))}
+
+
+# rules for cleaning the abstracts before pre-processing
+DOI_RULE = re.compile(r'\[DOI:(.*)\]')
+COPYRIGHT_RULE = re.compile(r'©(.*)\.')
+
+# text processor of the current (worker) process
+text_processor = None
+
+def init_text_processor():
+    global text_processor
+    text_processor = utils.MatTextProcessor()
+
+
+def preprocess_papers(rows, clean=True):
+    """Pre-processing merged titles and abstracts of a batch of papers,
+    given as rows of (ID, paper ID, title, abstract), by the text processor
+    of the current process (see `init_text_processor`)
+
+    If `clean=True`, ad-hoc cleaning rules (e.g. removing DOIs and
+    copyright notes) are applied first. Messages about the removals are
+    returned along with the processed texts.
+    """
+
+    texts, msgs = [], []
+    for _, pid, title, abstract in rows:
+        A = title + '. ' + abstract
+        if clean:
+            A = A.replace('Inf', 'inf')
+            A = A.replace('All rights reserved.', '')
+            for rule in [DOI_RULE, COPYRIGHT_RULE]:
+                se = rule.search(A)
+                if (se is not None) and len(se.group(0).split(' '))<20:
+                    msgs += ['{}: {} (to be removed)'.format(pid, se.group(0))]
+                    A = rule.sub('', A)
+
+        texts += [' '.join(sum(text_processor.mat_preprocess(A), []))]
+
+    return texts, msgs
+
+
+def columnar_paper_batches(export_dir, years=None, batch_size=10000):
+    """Streaming batches of rows (number, number, title, abstract) of the
+    records exported into columnar partitions (see `data.extractors`), in
+    the same format as the rows that `preprocess_papers` takes; only the
+    partitions of the given years and the needed columns are read
+    """
+    for _, part in columnar.iter_parts(export_dir, ['number', 'title', 'abstract'], years):
+        rows = list(zip(part['number'].tolist(), part['number'].tolist(),
+                        part['title'], part['abstract']))
+        for i in range(0, len(rows), batch_size):
+            yield rows[i:i+batch_size]
+
+
+def extract_columnar_titles_abstracts(export_dir, years=None, save_path=None, **kwargs):
+    """Pre-processing titles and abstracts of the records exported into
+    columnar partitions, directly from the files (without going through
+    the database); texts are returned, or written into lines of `save_path`
+    if it is given
+
+    Keyword arguments `batch_size`, `nworkers` and `logger` are similar to
+    those of `DB.extract_titles_abstracts`.
+    """
+
+    batch_size = kwargs.get('batch_size', 10000)
+    nworkers = kwargs.get('nworkers', 1)
+    logger = kwargs.get('logger', None)
+
+    batches = columnar_paper_batches(export_dir, years, batch_size)
+    func = partial(preprocess_papers, clean=(save_path is not None))
+
+    texts = []
+    f = open(save_path, 'w') if save_path is not None else None
+    try:
+        for rows, (prAs, msgs) in ordered_pool_map(func, batches, nworkers, init_text_processor):
+            if logger is not None:
+                for msg in msgs:
+                    logger.info(msg)
+            if f is None:
+                texts += prAs
+            else:
+                f.write(''.join([prA + '\n' for prA in prAs]))
+    finally:
+        if f is not None:
+            f.close()
+
+    if f is None:
+        return texts
+
 
 class DB(object):
     """Class of databases that we will be wokring for running/evaluating
@@ -36,7 +289,91 @@ class DB(object):
     NOTE: we intentionally did not use MySQL's `GROUP_CONCAT` when returning
     list of papers, authors or entities so that we won't be restricted by
     the variable `group_concat_max_len`.
-    
+
+    Connections:
+    ------------
+    Connections are kept in a pool of size `pool_size` (default: 4). Query 
+    methods check out a connection only for the duration of the query and pass
+    all values through parameter binding, hence they can be called concurrently
+    from multiple threads. The attributes `db` and `crsr` are kept for direct
+    usage; they give a connection (and its cursor) that is dedicated to the 
+    calling thread and is created outside the pool (so that it does not hold
+    one of the pooled connections). Connections to MySQL are in autocommit
+    mode, hence every query reads the latest committed data; `execute_batch`
+    opens an explicit transaction.
+
+    A different (DB-API compatible) backend, e.g. a local stand-in server, can
+    be used by giving a function with no arguments via `connect_func` (in which
+    case `config_path` can be None). Its parameter style should be "format" 
+    (`%s` placeholders), as in pymysql.
+
+    Large ID lists:
+    ---------------
+    Methods that take a list of paper/author IDs split it into chunks of
+    `chunk_size` IDs (default: 1000), run the chunks concurrently over the pool
+    and merge the results. If `id_table_threshold` is given, lists larger than
+    that are instead loaded into a temporary table which is joined with the 
+    main query.
+
+    Concurrent queries:
+    -------------------
+    Independent queries can be given together to `run_queries` as a batch of
+    specs (method, args[, kwargs]); they are run by an asyncio executor with
+    bounded concurrency over the pool and their results are returned in the
+    order of the specs.
+
+    Query cache:
+    ------------
+    Giving `cache_dir` enables a disk-backed cache of the query results (see
+    `data.cache.QueryCache`) of size at most `cache_max_bytes`. Cached results
+    are invalidated when the versions of their tables change; versions are
+    re-computed at most every `cache_version_ttl` seconds (default: 600), or
+    after any modification through `execute_update`/`execute_batch`. The
+    versions are given by `cache_validation`:
+
+    * 'update_time' (default): last modification times of the tables from
+      `information_schema.TABLES`, without reading the tables; when the time
+      is not known (InnoDB forgets it after a restart), the start time of the
+      server is used instead, hence entries never outlive a restart
+    * 'count': row counts, which miss the updates that keep the number of rows
+    * 'checksum': checksums of the tables, which are exact but read all the
+      rows of the tables
+
+    Profiling:
+    ----------
+    With `profile=True`, latency, number of rows and (estimated) bytes of 
+    all the executed queries are recorded by their calling methods and SQL
+    fingerprints (see `data.stats.QueryStats`); `profile_report` summarizes
+    them and can also explain the slowest statements. Queries that take at
+    least `slow_query_threshold` seconds are written into the log file
+    `slow_query_log`, if given.
+
+    Keyword index:
+    --------------
+    Giving an inverted keyword index (`data.keyword_index.KeywordIndex`, or
+    the directory where it is saved) as `keyword_index` makes the keyword
+    methods (`get_papers_by_keywords` and `get_authors_by_keywords`) find the
+    papers from its posting lists rather than scanning the texts with `LIKE`.
+    In both cases, keywords are matched literally (wildcards "%" and "_" are
+    escaped) as substrings of the texts; the index finds them within the 
+    whitespace-separated tokens and verifies keywords with whitespace by
+    `LIKE`. Case-insensitive keywords are lower-cased by the index, whereas
+    `LIKE` follows the collation of the columns, which may also ignore
+    accents; hence results of such keywords with accented letters can differ.
+
+    Year filters:
+    -------------
+    Year restrictions are applied on the column `year` of the paper table
+    when it exists (see `data.schema.migrate_year_column`), such that they can
+    use its index; otherwise they are applied on `YEAR(date)`. Giving 
+    `year_column` (True/False) skips checking the existence of the column.
+
+    Grouped outputs:
+    ----------------
+    Methods that return a dictionary of the form {key: {column: array}} build
+    it by sorting the rows by the key only once. Giving `csr=True` to these 
+    methods returns the underlying (keys, offsets, values) structure instead
+    (see `group_by_key`).
     """
 
     def __init__(self, config_path, db_name, **kwargs):
@@ -46,29 +383,375 @@ class DB(object):
         # column of names (symbols, etc) in entity table
         self.entity_col = kwargs.get('entity_col', 'name')
         
-        with open(config_path,'r') as f:
-            self.configs = json.load(f)
-        self.client_config = self.configs['client_config']
-        self.db = pymysql.connect(**self.client_config)
-        self.crsr = self.db.cursor()
-        self.crsr.execute('USE {};'.format(db_name))
-
+        self.db_name = db_name
+        connect_func = kwargs.get('connect_func', None)
+        if connect_func is None:
+            with open(config_path,'r') as f:
+                self.configs = json.load(f)
+            self.client_config = self.configs['client_config']
+            connect_func = lambda: pymysql.connect(database=self.db_name,
+                                                   autocommit=True,
+                                                   **self.client_config)
+        self.pool = ConnectionPool(connect_func, kwargs.get('pool_size', 4))
+        self.local = threading.local()
+
+        self.chunk_size = kwargs.get('chunk_size', 1000)
+        self.id_table_threshold = kwargs.get('id_table_threshold', None)
+
+        cache_dir = kwargs.get('cache_dir', None)
+        self.cache = None if cache_dir is None else \
+            QueryCache(cache_dir, kwargs.get('cache_max_bytes', 2**30))
+        self.cache_validation = kwargs.get('cache_validation', 'update_time')
+        self.cache_version_ttl = kwargs.get('cache_version_ttl', 600)
+        self.table_versions_memo = {}
+
+        self.stats = None
+        if kwargs.get('profile', False):
+            self.stats = QueryStats(kwargs.get('slow_query_threshold', None),
+                                    kwargs.get('slow_query_log', None))
+
+        # None: checking the paper table on the first year-restricted query
+        self.use_year_column = kwargs.get('year_column', None)
+
+        keyword_index = kwargs.get('keyword_index', None)
+        if isinstance(keyword_index, str):
+            keyword_index = KeywordIndex.load(keyword_index)
+        self.keyword_index = keyword_index
+
+    @property
+    def db(self):
+        if getattr(self.local, 'db', None) is None:
+            self.local.db = self.pool.connect_func()
+            self.local.crsr = self.profiled(self.local.db.cursor(), 'crsr')
+        return self.local.db
+
+    @property
+    def crsr(self):
+        # make sure the thread has its own connection
+        self.db
+        return self.local.crsr
+
+    @contextmanager
+    def cursor(self, unbuffered=False):
+        """Checking out a connection from the pool and yielding a cursor
+        on it; the connection goes back to the pool afterwards
+
+        If `unbuffered=True`, a server-side (streaming) cursor will be used for
+        pymysql connections, such that rows are not loaded into the memory
+        before being fetched.
+        """
+        with self.pool.connection() as conn:
+            if unbuffered and isinstance(conn, pymysql.connections.Connection):
+                crsr = conn.cursor(pymysql.cursors.SSCursor)
+            else:
+                crsr = conn.cursor()
+            crsr = self.profiled(crsr)
+            try:
+                yield crsr
+            finally:
+                crsr.close()
         
+    def profiled(self, crsr, method=None):
+        """Wrapping a cursor such that its queries are recorded, if 
+        profiling is enabled
+        """
+        if self.stats is None:
+            return crsr
+        return ProfiledCursor(crsr, self.stats, self.calling_method() if method is None else method)
+
+    def calling_method(self):
+        """Returning name of the (innermost) method of the object in the
+        call stack that is not one of `EXECUTION_METHODS`, or the outermost
+        one of them if there is no such method
+        """
+        f = sys._getframe(1)
+        name = 'direct'
+        while f is not None:
+            if f.f_locals.get('self', None) is self:
+                name = f.f_code.co_name
+                if name not in EXECUTION_METHODS:
+                    break
+            f = f.f_back
+        return name
+
+    def profile_report(self, top=20, nexplain=0):
+        """Returning a text report of the recorded queries (see `profile`),
+        including the execution plans of the `nexplain` slowest SELECT
+        statements
+        """
+        assert self.stats is not None, 'Profiling is not enabled.'
+        explains = None
+        if nexplain>0:
+            explains = []
+            slowest = [x for x in self.stats.slowest_statements()
+                       if x[2].lstrip().upper().startswith('SELECT')]
+            for latency, method, scomm, args in slowest[:nexplain]:
+                try:
+                    plan = explain(self, scomm, args)
+                except Exception as e:
+                    plan = ['EXPLAIN failed: {}'.format(e)]
+                explains += [(latency, method, scomm, plan)]
+
+        return self.stats.report(top, explains)
+
     def re_establish_connection(self):
-        self.db.close()
-        self.db = pymysql.connect(**self.client_config)
-        self.crsr = self.db.cursor()
-        self.crsr.execute('USE {};'.format(self.db_name))
+        if getattr(self.local, 'db', None) is not None:
+            self.local.db.close()
+            self.local.db = None
+        self.pool.close_all()
+
+    def execute(self, scomm, args=None, id_table=None):
+        """Executing a query with (optional) bound parameters and returning
+        all the rows
+
+        If a list of IDs is given as `id_table`, it will be loaded into the
+        temporary table `ID_TABLE` (in the same connection) before the query
+        is executed.
 
+        Results of SELECT queries are read from/written into the cache, if
+        it is enabled.
+        """
+        if (self.cache is None) or not(scomm.lstrip().upper().startswith('SELECT')):
+            return self.run_query(scomm, args, id_table)
+
+        key = QueryCache.make_key(scomm, (args or []) + (id_table or []))
+        versions = self.table_versions([t for t in QueryCache.tables_of(scomm)
+                                        if t!=ID_TABLE])
+        rows = self.cache.get(key, versions)
+        if rows is None:
+            rows = self.run_query(scomm, args, id_table)
+            self.cache.put(key, rows, versions)
+        return rows
+
+    def table_versions(self, tables):
+        """Returning versions (update times, row counts or checksums) of a set
+        of tables, which are memoized for `cache_version_ttl` seconds
+        """
+        versions = {}
+        for table in tables:
+            memo = self.table_versions_memo.get(table, None)
+            if (memo is None) or (time.time()-memo[1] > self.cache_version_ttl):
+                if self.cache_validation=='checksum':
+                    version = self.run_query('CHECKSUM TABLE {};'.format(table))[0][1]
+                elif self.cache_validation=='count':
+                    version = self.run_query('SELECT COUNT(*) FROM {};'.format(table))[0][0]
+                else:
+                    version = self.table_update_time(table)
+                memo = (str(version), time.time())
+                self.table_versions_memo[table] = memo
+            versions[table] = memo[0]
+        return versions
+
+    def table_update_time(self, table):
+        """Returning the last modification time of a table, or the start time
+        of the server (prefixed by "start:") if it is not known
+        """
+        with self.cursor() as crsr:
+            try:
+                # MySQL 8 caches the table statistics for a day by default
+                crsr.execute('SET SESSION information_schema_stats_expiry=0;')
+            except Exception:
+                pass
+            crsr.execute('SELECT UPDATE_TIME FROM information_schema.TABLES \
+                          WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s;', [table])
+            rows = crsr.fetchall()
+            if (len(rows)>0) and (rows[0][0] is not None):
+                return rows[0][0]
+            crsr.execute("SHOW GLOBAL STATUS LIKE 'Uptime';")
+            uptime = int(crsr.fetchall()[0][1])
+            crsr.execute('SELECT UNIX_TIMESTAMP();')
+            return 'start:{}'.format(int(crsr.fetchall()[0][0]) - uptime)
+
+    def run_query(self, scomm, args=None, id_table=None):
+        """Executing a query directly on the database (see `execute`)
+        """
+        with self.cursor() as crsr:
+            if id_table is not None:
+                crsr.execute('CREATE TEMPORARY TABLE IF NOT EXISTS {} \
+                              (id BIGINT PRIMARY KEY) ENGINE=MEMORY;'.format(ID_TABLE))
+                crsr.execute('DELETE FROM {};'.format(ID_TABLE))
+                crsr.executemany('INSERT IGNORE INTO {} VALUES (%s);'.format(ID_TABLE),
+                                 [(x,) for x in id_table])
+            try:
+                crsr.execute(scomm, args)
+                return crsr.fetchall()
+            finally:
+                if id_table is not None:
+                    crsr.execute('DROP TEMPORARY TABLE IF EXISTS {};'.format(ID_TABLE))
+
+    def execute_batch(self, commands):
+        """Executing a list of (statement, list of rows) by `executemany` on
+        one connection and committing them together
+        """
+        with self.pool.connection() as conn:
+            crsr = self.profiled(conn.cursor())
+            try:
+                if hasattr(conn, 'begin'):
+                    conn.begin()
+                for scomm, rows in commands:
+                    if len(rows)>0:
+                        crsr.executemany(scomm, rows)
+                conn.commit()
+            except:
+                conn.rollback()
+                raise
+            finally:
+                crsr.close()
+                self.table_versions_memo.clear()
+
+    def execute_update(self, scomm, args=None):
+        """Executing a modifying statement (e.g. UPDATE, ALTER) and committing
+        it; the number of affected rows is returned
+        """
+        with self.pool.connection() as conn:
+            crsr = self.profiled(conn.cursor())
+            try:
+                crsr.execute(scomm, args)
+                conn.commit()
+                return crsr.rowcount
+            except:
+                conn.rollback()
+                raise
+            finally:
+                crsr.close()
+                # versions of the modified tables are re-computed in the next lookup
+                self.table_versions_memo.clear()
+
+    def table_columns(self, table):
+        with self.cursor() as crsr:
+            crsr.execute('SELECT * FROM {} LIMIT 0;'.format(table))
+            crsr.fetchall()
+            return [d[0] for d in crsr.description]
+
+    def year_expr(self, alias='P'):
+        """Expression of the publication year of papers (with alias `alias`)
+        """
+        if self.use_year_column is None:
+            self.use_year_column = 'year' in self.table_columns('paper')
+        if self.use_year_column:
+            return '{}.year'.format(alias)
+        else:
+            return 'YEAR({}.date)'.format(alias)
+
+    def years_constraint(self, years, alias='P'):
+        """Returning the constraint (and its arguments) for restricting
+        papers to a set of years
+        """
+        return '{} IN ({})'.format(self.year_expr(alias), placeholders(len(years))), \
+            [int(x) for x in years]
+
+    def stream(self, scomm, args=None, batch_size=10000):
+        """Executing a query through a server-side cursor and yielding the
+        rows in batches (lists) of size `batch_size`, hence reading the whole
+        results in a bounded memory
+
+        NOTE: the connection is held until the generator is exhausted or 
+        closed.
+        """
+        with self.cursor(unbuffered=True) as crsr:
+            crsr.execute(scomm, args)
+            while True:
+                rows = crsr.fetchmany(batch_size)
+                if len(rows)==0:
+                    break
+                yield rows
+
+    def ids_constraint(self, col, ids):
+        """Returning the constraint (and its arguments) for restricting a
+        column to a list of IDs, along with the IDs to be loaded into the
+        temporary ID table (if the list is too large, otherwise None)
+        """
+        ids = [int(x) for x in ids]
+        if (self.id_table_threshold is not None) and len(ids)>self.id_table_threshold:
+            return '{} IN (SELECT id FROM {})'.format(col, ID_TABLE), [], ids
+        else:
+            return '{} IN ({})'.format(col, placeholders(len(ids))), ids, None
+
+    def needs_chunking(self, ids):
+        if self.id_table_threshold is not None and len(ids)>self.id_table_threshold:
+            return False
+        return len(ids) > self.chunk_size
+
+    def map_chunks(self, func, ids):
+        """Applying a function on chunks of a list of IDs, concurrently
+        over the connection pool
+        """
+        ids = list(ids)
+        chunks = [ids[i:i+self.chunk_size] for i in range(0, len(ids), self.chunk_size)]
+        if self.pool.size > 1:
+            with ThreadPoolExecutor(self.pool.size) as executor:
+                return list(executor.map(func, chunks))
+        else:
+            return [func(chunk) for chunk in chunks]
+
+    def run_queries(self, specs, max_concurrency=None, return_exceptions=False):
+        """Running a batch of independent queries concurrently and returning
+        their results in the order of the specs
+
+        Each spec is a tuple (method, args) or (method, args, kwargs), where
+        `method` is a query method of the class (or its name), e.g.
+        `('get_LoA_by_ents', [['CO2']], {'years': [2000]})`. At most 
+        `max_concurrency` queries (default: size of the pool) are running 
+        at any time. If `return_exceptions=True`, failed queries give their
+        exceptions instead of raising them.
+
+        Inside a running event loop, use `run_queries_async` directly.
+        """
+        return asyncio.run(self.run_queries_async(specs, max_concurrency, return_exceptions))
+
+    async def run_queries_async(self, specs, max_concurrency=None, return_exceptions=False):
+        """Coroutine version of `run_queries`
+        """
+
+        max_concurrency = self.pool.size if max_concurrency is None else max_concurrency
+        semaphore = asyncio.Semaphore(max_concurrency)
+        loop = asyncio.get_running_loop()
+
+        with ThreadPoolExecutor(max_concurrency) as executor:
+            async def run(spec):
+                method, args = spec[0], spec[1]
+                kwargs = spec[2] if len(spec)>2 else {}
+                if isinstance(method, str):
+                    method = getattr(self, method)
+                async with semaphore:
+                    return await loop.run_in_executor(executor, partial(method, *args, **kwargs))
+
+            return await asyncio.gather(*[run(spec) for spec in specs],
+                                        return_exceptions=return_exceptions)
+
+    def chunked_query(self, method, ids, empty, **kwargs):
+        """Running a query method over chunks of a (large) list of IDs and
+        merging the resulting dictionaries (which are keyed by the IDs, or 
+        values associated with them)
+
+        `empty` is what the method returns when no results are found.
+        """
+        res = self.map_chunks(lambda chunk: method(chunk, **kwargs), ids)
+        res = [r for r in res if len(r)>0]
+        if len(res)==0:
+            return empty
+        elif isinstance(res[0], tuple):
+            # grouped values of `group_by_key`
+            return concat_groups(res)
+        
+        out = {}
+        for r in res:
+            out.update(r)
+        return out
 
     def count_table_rows(self, table_name):
-        self.crsr.execute('SELECT COUNT(*) FROM {};'.format(table_name))
-        return self.crsr.fetchall()[0][0]
+        return self.execute('SELECT COUNT(*) FROM {};'.format(table_name))[0][0]
 
     
-    def get_1d_query(self, scomm):
-        self.crsr.execute(scomm)
-        return np.array([x[0] for x in self.crsr.fetchall()])
+    def get_1d_query(self, scomm, args=None):
+        return np.array([x[0] for x in self.execute(scomm, args)])
+
+    def stream_1d_query(self, scomm, args=None, batch_size=10000):
+        """Streaming variant of `get_1d_query` that yields arrays of at
+        most `batch_size` values
+        """
+        for rows in self.stream(scomm, args, batch_size):
+            yield np.array([x[0] for x in rows])
 
     
     def get_LoA_by_PID(self, paper_ids, **kwargs):
@@ -80,25 +763,21 @@ class DB(object):
         if type(paper_ids) is int:
             paper_ids = [paper_ids]
         # a list of paper IDs
-        ID_list_str = '({})'.format(', '.join([str(a) for a in paper_ids]))
-        constraints_str = 'P2A.paper_id IN {}'.format(ID_list_str)
+        if self.needs_chunking(paper_ids):
+            return self.chunked_query(self.get_LoA_by_PID, paper_ids, [], **kwargs)
+        constraints_str, args, id_table = self.ids_constraint('P2A.paper_id', paper_ids)
 
         scomm = 'SELECT {} FROM author A \
                  INNER JOIN paper_author_mapping P2A ON P2A.author_id=A.id \
                  WHERE {}'.format(pcols, constraints_str)
             
-        R = self.execute_and_get_results(scomm, cols)
+        R = self.execute_and_get_results(scomm, cols, args, id_table)
         if len(R)==0:
             return []
         
-        A = R['P2A.paper_id']
-        out = {}
-        for a in np.unique(A):
-            out[a] = {}
-            for i,col in enumerate(cols[:-1]):
-                name = col.split('.')[1]
-                out[a][name] = np.array(R[col])[A==a]
-        return out
+        groups = group_by_key(R['P2A.paper_id'],
+                              {col.split('.')[1]: R[col] for col in cols[:-1]})
+        return groups if kwargs.get('csr', False) else groups_to_dict(*groups)
 
     def get_NoA_by_PID(self, paper_ids):
         """Getting Number of Authors (NoA) of a set of paper IDs
@@ -112,17 +791,15 @@ class DB(object):
         if type(paper_ids) is int:
             paper_ids = [paper_ids]
         # a list of paper IDs
-        ID_list_str = '({})'.format(', '.join([str(a) for a in paper_ids]))
-        constraints_str = 'P2A.paper_id IN {}'.format(ID_list_str)
+        if self.needs_chunking(paper_ids):
+            return self.chunked_query(self.get_NoA_by_PID, paper_ids, {})
+        constraints_str, args, id_table = self.ids_constraint('P2A.paper_id', paper_ids)
 
         scomm = 'SELECT P2A.paper_id, COUNT(*) FROM author A \
                  INNER JOIN paper_author_mapping P2A ON P2A.author_id=A.id \
                  WHERE {} GROUP BY P2A.paper_id;'.format(constraints_str)
 
-        self.crsr.execute(scomm)
-        res = self.crsr.fetchall()
-
-        return dict(res)
+        return dict(self.execute(scomm, args, id_table))
 
     
     def get_LoA_by_ents(self, ent_names, **kwargs):
@@ -145,14 +822,13 @@ class DB(object):
             pcols += ',P.id AS paper_id'
             cols += ['.paper_id']
         
-
-        ent_names = ['"{}"'.format(c) for c in ent_names]
-        constraints_str = 'E.{} IN ({})'.format(self.entity_col, ','.join(ent_names))
+        args = list(ent_names)
+        constraints_str = 'E.{} IN ({})'.format(self.entity_col, placeholders(len(args)))
 
         if len(years)>0:
-            yrs_arr = ','.join([str(x) for x in years])
-            constraints_str = '({}) AND YEAR(P.date) IN ({})'.format(
-                constraints_str, yrs_arr)
+            years_str, years_args = self.years_constraint(years)
+            args += years_args
+            constraints_str = '({}) AND {}'.format(constraints_str, years_str)
 
         scomm = 'SELECT {} FROM author A \
                  INNER JOIN paper_author_mapping P2A ON P2A.author_id=A.id \
@@ -163,18 +839,13 @@ class DB(object):
                                    self.entity_tab, constraints_str)
 
         cols = [col.split('.')[1] for col in cols]
-        R = self.execute_and_get_results(scomm, cols)
+        R = self.execute_and_get_results(scomm, cols, args)
         if len(R)==0:
             return []
 
-        A = np.array(R[self.entity_col])
         cols.remove(self.entity_col)
-        out = {}
-        for a in np.unique(A):
-            out[a] = {}
-            for i,col in enumerate(cols):
-                out[a][col] = np.array(R[col])[A==a]
-        return out
+        groups = group_by_key(R[self.entity_col], {col: R[col] for col in cols})
+        return groups if kwargs.get('csr', False) else groups_to_dict(*groups)
 
     
     def get_authors_by_keywords(self, keywords, **kwargs):
@@ -194,29 +865,41 @@ class DB(object):
         years = kwargs.get('years', [])
         return_papers = kwargs.get('return_papers', False)
         
-        constraints_str = ['P.abstract LIKE "%{}%"'.format(k) for k in keywords]
-        for k in case_sensitives:
-            idx = np.where([x==k for x in keywords])
-            idx = [] if len(idx)==0 else idx[0][0]
-            constraints_str[idx] = 'P.abstract LIKE BINARY "%{}%"'.format(k)
+        constraints_str = ["P.abstract LIKE {}%s ESCAPE '!'".format('BINARY ' if k in case_sensitives else '')
+                           for k in keywords]
+        args = [like_pattern(k) for k in keywords]
         constraints_str = ' {} '.format(logical_comb).join(constraints_str)
 
         if len(years)>0:
-            yrs_arr = ','.join([str(x) for x in years])
-            constraints_str = '({}) AND YEAR(P.date) IN ({})'.format(
-                constraints_str, yrs_arr)
+            years_str, years_args = self.years_constraint(years)
+            args += years_args
+            constraints_str = '({}) AND {}'.format(constraints_str, years_str)
 
         if return_papers:
             cols += ['P.id']
         pcols = ','.join(cols)
 
+        # the index covers titles too, hence its results are only candidates
+        # that restrict the query 
+        if self.keyword_index is not None:
+            pids,_ = self.keyword_index.search(keywords,
+                                               logical_comb=logical_comb,
+                                               case_sensitives=case_sensitives,
+                                               years=years)
+            if len(pids)==0:
+                return {}
+            constraints_str = '{{ids}} AND ({})'.format(constraints_str)
+
         scomm = 'SELECT {} \
                  FROM author A \
                  INNER JOIN paper_author_mapping P2A ON P2A.author_id=A.id \
                  INNER JOIN paper P ON P.id=P2A.paper_id \
                  WHERE {};'.format(pcols, constraints_str)
 
-        return self.execute_and_get_results(scomm, [col.split('.')[1] for col in cols])    
+        cols = [col.split('.')[1] for col in cols]
+        if self.keyword_index is not None:
+            return self.execute_and_get_results_by_ids(scomm, cols, 'P.id', pids, args)
+        return self.execute_and_get_results(scomm, cols, args)
         
     
     def get_LoP_by_AID(self, author_ids, **kwargs):
@@ -233,30 +916,27 @@ class DB(object):
         # taking care of the conditions in mySQL querying
         if type(author_ids) is int:
             author_ids = [author_ids]
-        ID_list_str = '({})'.format(', '.join([str(a) for a in author_ids]))
-        constraints_str = 'P2A.author_id IN {}'.format(ID_list_str)
+        if self.needs_chunking(author_ids):
+            return self.chunked_query(self.get_LoP_by_AID, author_ids, [], **kwargs)
+        constraints_str, args, id_table = self.ids_constraint('P2A.author_id', author_ids)
 
         if len(years)>0:
-            years_arr = ','.join([str(x) for x in years])
-            constraints_str = '{} AND YEAR(P.date) IN ({})'.format(constraints_str, years_arr)
+            years_str, years_args = self.years_constraint(years)
+            args += years_args
+            constraints_str = '{} AND {}'.format(constraints_str, years_str)
             
         scomm = 'SELECT {} FROM paper P \
                  INNER JOIN paper_author_mapping P2A ON P2A.paper_id=P.id \
                  WHERE {}'.format(pcols, constraints_str)
 
         cols = [col.split('.')[1] for col in cols]
-        R = self.execute_and_get_results(scomm, cols)
+        R = self.execute_and_get_results(scomm, cols, args, id_table)
         if len(R)==0:
             return []
         
-        A = np.array(R['id'])
-        cols.remove('id')
-        out = {}
-        for a in np.unique(A):
-            out[a] = {}
-            for i,col in enumerate(cols):
-                out[a][col] = np.array(R[col])[A==a]
-        return out
+        cols.remove('author_id')
+        groups = group_by_key(R['author_id'], {col: R[col] for col in cols})
+        return groups if kwargs.get('csr', False) else groups_to_dict(*groups)
 
         
     def get_NoP_by_AID(self, author_ids, **kwargs):
@@ -270,24 +950,21 @@ class DB(object):
         years = kwargs.get('years',[])
         # taking care of the conditions in mySQL querying
         if type(author_ids) is int:
-            constraints_str = 'P2A.author_id={}'.format(author_ids)
-        else:
-            # a list of author IDs
-            ID_list_str = '({})'.format(', '.join([str(a) for a in author_ids]))
-            constraints_str = 'P2A.author_id IN {}'.format(ID_list_str)
+            author_ids = [author_ids]
+        if self.needs_chunking(author_ids):
+            return self.chunked_query(self.get_NoP_by_AID, author_ids, {}, **kwargs)
+        constraints_str, args, id_table = self.ids_constraint('P2A.author_id', author_ids)
 
         if len(years)>0:
-            years_arr = ','.join([str(x) for x in years])
-            constraints_str = '{} AND YEAR(P.date) IN ({})'.format(constraints_str, years_arr)
+            years_str, years_args = self.years_constraint(years)
+            args += years_args
+            constraints_str = '{} AND {}'.format(constraints_str, years_str)
 
         scomm = "SELECT P2A.author_id, COUNT(*) FROM paper P \
                  INNER JOIN paper_author_mapping P2A ON P2A.paper_id=P.id \
                  WHERE {} GROUP BY P2A.author_id".format(constraints_str)
 
-        self.crsr.execute(scomm)
-        res = self.crsr.fetchall()
-
-        return dict(res)
+        return dict(self.execute(scomm, args, id_table))
 
     
     def get_LoP_by_ents(self, names, **kwargs):
@@ -301,12 +978,13 @@ class DB(object):
             ['E.{}'.format(self.entity_col)]
         pcols = ','.join(cols)
         
-        names = ['"{}"'.format(c) for c in names]
-        constraints_str = 'C.formula IN ({})'.format(', '.join(names))
+        args = list(names)
+        constraints_str = 'E.{} IN ({})'.format(self.entity_col, placeholders(len(args)))
 
         if len(years)>0:
-            years_arr = ','.join([str(x) for x in years])
-            constraints_str = '{} AND YEAR(P.date) IN ({})'.format(constraints_str, years_arr)
+            years_str, years_args = self.years_constraint(years)
+            args += years_args
+            constraints_str = '{} AND {}'.format(constraints_str, years_str)
 
         scomm = 'SELECT {} FROM paper P \
                  INNER JOIN {}_paper_mapping E2P ON P.id=E2P.paper_id \
@@ -315,18 +993,13 @@ class DB(object):
                                    self.entity_tab, constraints_str)
 
         cols = [col.split('.')[1] for col in cols]
-        R = self.execute_and_get_results(scomm, cols)
+        R = self.execute_and_get_results(scomm, cols, args)
         if len(R)==0:
             return []
         
-        A = np.array(R[self.entity_col])
         cols.remove(self.entity_col)
-        out = {}
-        for a in np.unique(A):
-            out[a] = {}
-            for i,col in enumerate(cols):
-                out[a][col] = np.array(R[col])[A==a]
-        return out
+        groups = group_by_key(R[self.entity_col], {col: R[col] for col in cols})
+        return groups if kwargs.get('csr', False) else groups_to_dict(*groups)
 
     
     def get_papers_by_keywords(self, keywords, **kwargs):
@@ -347,23 +1020,40 @@ class DB(object):
         case_sensitives = kwargs.get('case_sensitives', [])
         logical_comb = kwargs.get('logical_comb', 'OR')
 
-        constraints_str = ["(P.title LIKE '%{}%' OR P.abstract LIKE '%{}%')".format(k,k)
-                           for k in keywords]
-        for k in case_sensitives:
-            idx = np.where([x==k for x in keywords])
-            idx = [] if len(idx)==0 else idx[0][0]
-            constraints_str[idx] = "(P.title LIKE BINARY '%{}%' OR P.abstract LIKE BINARY '%{}%')".format(k,k)
+        constraints_str = []
+        args = []
+        for k in keywords:
+            binary = 'BINARY ' if k in case_sensitives else ''
+            constraints_str += ["(P.title LIKE {0}%s ESCAPE '!' OR P.abstract LIKE {0}%s ESCAPE '!')".format(binary)]
+            args += [like_pattern(k)]*2
         constraints_str = " {} ".format(logical_comb).join(constraints_str)
 
         if len(years)>0:
-            yrs_arr = ','.join([str(x) for x in years])
-            constraints_str = "({}) AND YEAR(P.date) IN ({})".format(
-                constraints_str, yrs_arr)
+            years_str, years_args = self.years_constraint(years)
+            args += years_args
+            constraints_str = "({}) AND {}".format(constraints_str, years_str)
+
+        if self.keyword_index is not None:
+            pids, exact = self.keyword_index.search(keywords,
+                                                    logical_comb=logical_comb,
+                                                    case_sensitives=case_sensitives,
+                                                    years=years)
+            if len(pids)==0:
+                return {}
+            elif exact and cols==['P.id']:
+                return {'id': pids}
+            elif exact:
+                constraints_str, args = '{ids}', []
+            else:
+                constraints_str = '{{ids}} AND ({})'.format(constraints_str)
 
         scomm = "SELECT {} FROM paper P \
                  WHERE {};".format(pcols, constraints_str)
-        
-        return self.execute_and_get_results(scomm, [col.split('.')[1] for col in cols])
+
+        cols = [col.split('.')[1] for col in cols]
+        if self.keyword_index is not None:
+            return self.execute_and_get_results_by_ids(scomm, cols, 'P.id', pids, args)
+        return self.execute_and_get_results(scomm, cols, args)
 
     
     def get_LoE_by_PID(self, paper_ids, **kwargs):
@@ -381,26 +1071,22 @@ class DB(object):
         if type(paper_ids) is int:
             paper_ids = [paper_ids]
         # a list of paper IDs
-        ID_list_str = '({})'.format(', '.join([str(a) for a in paper_ids]))
-        constraints_str = 'E2P.paper_id IN {}'.format(ID_list_str)
+        if self.needs_chunking(paper_ids):
+            return self.chunked_query(self.get_LoE_by_PID, paper_ids, [], **kwargs)
+        constraints_str, args, id_table = self.ids_constraint('E2P.paper_id', paper_ids)
         
         scomm = 'SELECT {} FROM {} E \
                  INNER JOIN {}_paper_mapping E2P ON E2P.{}_id=E.id \
                  WHERE {}'.format(pcols, self.entity_tab, self.entity_tab,
                                   self.entity_tab, constraints_str)
 
-        R = self.execute_and_get_results(scomm, cols)
+        R = self.execute_and_get_results(scomm, cols, args, id_table)
         if len(R)==0:
             return []
         
-        A = np.array(R['E2P.paper_id'])
-        out = {}
-        for a in np.unique(A):
-            out[a] = {}
-            for i,col in enumerate(cols[:-1]):
-                name = col.split('.')[1]
-                out[a][name] = np.array(R[col])[A==a]
-        return out
+        groups = group_by_key(R['E2P.paper_id'],
+                              {col.split('.')[1]: R[col] for col in cols[:-1]})
+        return groups if kwargs.get('csr', False) else groups_to_dict(*groups)
 
 
     def get_NoE_by_PID(self, paper_ids):
@@ -415,110 +1101,173 @@ class DB(object):
         if type(paper_ids) is int:
             paper_ids = [paper_ids]
         # a list of paper IDs
-        ID_list_str = '({})'.format(', '.join([str(a) for a in paper_ids]))
-        constraints_str = 'E2P.paper_id IN {}'.format(ID_list_str)
+        if self.needs_chunking(paper_ids):
+            return self.chunked_query(self.get_NoE_by_PID, paper_ids, {})
+        constraints_str, args, id_table = self.ids_constraint('E2P.paper_id', paper_ids)
 
         scomm = 'SELECT E2P.paper_id, COUNT(*) FROM {} E \
                  INNER JOIN {}_paper_mapping E2P ON E2P.{}_id=E.id \
                  WHERE {} GROUP BY E2P.paper_id;'.format(self.entity_tab, self.entity_tab,
                                                          self.entity_tab, constraints_str)
 
-        self.crsr.execute(scomm)
-        res = self.crsr.fetchall()
-
-        return dict(res)
+        return dict(self.execute(scomm, args, id_table))
     
 
     def get_affiliations_by_author_id(self, author_id, cols):
         
-        cols, pcols = self.prepare_column_headers(cols, 'AFF')
+        pcols = ','.join(['AFF.{}'.format(col) for col in cols])
         scomm = 'SELECT {} \
                  FROM affiliation AFF \
                  INNER JOIN author_affiliation_mapping A2AFF \
                  ON AFF.aff_id=A2AFF.aff_id \
-                 WHERE A2AFF.author_id={}'.format(pcols, author_id)
+                 WHERE A2AFF.author_id=%s'.format(pcols)
         
-        return self.execute_and_get_results(scomm, cols)
+        return self.execute_and_get_results(scomm, cols, [int(author_id)])
     
 
-    def execute_and_get_results(self, scomm, cols):
+    def execute_and_get_results(self, scomm, cols, args=None, id_table=None):
 
         # output shape: [(a1,b1),(a2,b2)]
         #                 ------  ------
         #                  Row1    Row2
-        self.crsr.execute(scomm)
+        rows = self.execute(scomm, args, id_table)
         
         # [(a1,b1),(a2,b2)] --> [(a1,a2), (b1,b2)]
         # |---------------|      |--------------|
         #  row-wise listing      colunmwise listing 
-        R = zip(*self.crsr.fetchall())
+        R = zip(*rows)
         # [A,B] + [(a1,a2), (b1,b2)] --> [(A,(a1,a2)), (B,(b1,b2))]
         # .. and then use column headers to make a dictionary
         return {x[0]:np.array(x[1]) for x in zip(cols,R)}
 
+    def execute_and_get_results_by_ids(self, scomm, cols, id_col, ids, args=None):
+        """Similar to `execute_and_get_results` for a query whose constraint
+        on a list of IDs is left as the placeholder "{ids}" in `scomm`; the
+        parameters of this constraint should come before `args`
+
+        Large lists of IDs are split into chunks (see `chunked_query`) and the
+        columns of the results are concatenated.
+        """
+        args = list(args or [])
+        if self.needs_chunking(ids):
+            res = self.map_chunks(lambda chunk: self.execute_and_get_results_by_ids(
+                scomm, cols, id_col, chunk, args), ids)
+            res = [r for r in res if len(r)>0]
+            if len(res)==0:
+                return {}
+            return {col: np.concatenate([r[col] for r in res]) for col in res[0]}
+
+        constraint_str, id_args, id_table = self.ids_constraint(id_col, ids)
+        return self.execute_and_get_results(scomm.format(ids=constraint_str), cols,
+                                            id_args + args, id_table)
+
+    def stream_results(self, scomm, cols, args=None, batch_size=10000):
+        """Streaming variant of `execute_and_get_results` that yields the
+        results in batches of at most `batch_size` rows, each with the same
+        format as the output of the non-streaming method
+        """
+        for rows in self.stream(scomm, args, batch_size):
+            yield {x[0]:np.array(x[1]) for x in zip(cols, zip(*rows))}
+
 
     def extract_titles_abstracts(self,
                                  before_year=None,
                                  em='RAM',
                                  save_path=None,
-                                 logger=None):
+                                 logger=None,
+                                 batch_size=10000,
+                                 nworkers=1,
+                                 shard_dir=None):
         """Returning titles and abstracts (merged together) as a list
         of lists (when `em=RAM`) or saving them into lines of a text file
         (when `em=HARD`). If the latter is specified, a path for saving the text
         file (`save_path`) should also be provided.
-        """
 
-        # MS text processor
-        self.text_processor = utils.MatTextProcessor()
+        Papers are read from the database (sorted by their IDs) in batches
+        of `batch_size` rows by key-set pagination, hence no query is held
+        open while the batches are pre-processed by a pool of `nworkers`
+        processes, each having its own text processor. 
+
+        In `HARD` mode, the processed batches are written in order into shards
+        in `shard_dir` (default: `save_path` + "_shards") along with a progress
+        marker, which are finally appended to `save_path` (as before, existing
+        contents of the file are kept). An interrupted extraction continues
+        from the last written shard when re-run, and shards that are already
+        appended are not appended again.
+        """
 
+        constraints, args = [], []
         if before_year:
-            scomm = 'SELECT paper_id, title, abstract FROM paper \
-                     WHERE YEAR(date)<{};'.format(before_year)
-        else:
-            scomm = 'SELECT paper_id, title, abstract FROM paper;'
-        (_,pids), (_,titles), (_,abstracts) = self.execute_and_get_results(scomm, ['paper_id', 'title','abstract']).items()
+            constraints += ['{}<%s'.format(self.year_expr())]
+            args += [int(before_year)]
 
         if em=='HARD':
             # processing and saving
             assert save_path is not None, 'Specify a saving path.'
+            if shard_dir is None:
+                shard_dir = save_path + '_shards'
+            if not os.path.exists(shard_dir):
+                os.makedirs(shard_dir)
+            marker_path = os.path.join(shard_dir, 'progress.json')
+            progress = {'last_id': None, 'nshards': 0}
+            if os.path.exists(marker_path):
+                with open(marker_path, 'r') as f:
+                    progress = json.load(f)
+            def save_progress(progress):
+                with open(marker_path + '.tmp', 'w') as f:
+                    json.dump(progress, f)
+                os.replace(marker_path + '.tmp', marker_path)
+            if (progress['last_id'] is not None) and (logger is not None):
+                logger.info('Continuing after {} shards (last paper ID: {})'.format(
+                    progress['nshards'], progress['last_id']))
+
+        def paper_batches(last_id):
+            while True:
+                bconstraints, bargs = list(constraints), list(args)
+                if last_id is not None:
+                    bconstraints += ['P.id>%s']
+                    bargs += [last_id]
+                scomm = 'SELECT P.id, P.paper_id, P.title, P.abstract FROM paper P'
+                if len(bconstraints)>0:
+                    scomm += ' WHERE ' + ' AND '.join(bconstraints)
+                rows = self.run_query(scomm + ' ORDER BY P.id LIMIT %s;', bargs + [int(batch_size)])
+                if len(rows)==0:
+                    break
+                yield rows
+                last_id = rows[-1][0]
+        batches = paper_batches(progress['last_id'] if em=='HARD' else None)
+
+        # only the saved texts are cleaned by the ad-hoc rules
+        func = partial(preprocess_papers, clean=(em=='HARD'))
+
+        texts = []
+        for rows, (prAs, msgs) in ordered_pool_map(func, batches, nworkers, init_text_processor):
+            if logger is not None:
+                for msg in msgs:
+                    logger.info(msg)
+
+            if em=='RAM':
+                texts += prAs
+                continue
+
+            shard_path = os.path.join(shard_dir, 'shard_{:06d}.txt'.format(progress['nshards']))
+            with open(shard_path + '.tmp', 'w') as f:
+                f.write(''.join([prA + '\n' for prA in prAs]))
+            os.replace(shard_path + '.tmp', shard_path)
+            progress = dict(progress, last_id=int(rows[-1][0]), nshards=progress['nshards']+1)
+            save_progress(progress)
+            if logger is not None:
+                logger.info('Shard {} has been written (last paper ID: {})'.format(
+                    progress['nshards']-1, progress['last_id']))
 
+        if em=='HARD':
+            # only the shards that are not appended yet (in the previous runs)
             with open(save_path, 'a') as f:
-                for i,pid in enumerate(pids):
-                    A = titles[i] + '. ' + abstracts[i]
-
-                    A = A.replace('Inf', 'inf')
-                    A = A.replace('All rights reserved.', '')
-
-                    # MORE RULES
-                    # removing [DOI: ...]
-                    rule_1 = '\[DOI:(.*)\]'
-                    rule_2 = '©(.*)\.'
-
-                    se =  re.search(rule_1, A)
-                    if se is not None:
-                        removal = se.group(0)
-                        if len(removal.split(' '))<20:
-                            logger.info('{}: {} (to be removed)'.format(
-                                pid, se.group(0)))
-                            A = re.sub(rule_1, lambda x: '', A)
-                    se = re.search(rule_2, A)
-                    if se is not None:
-                        removal = se.group(0)
-                        if len(removal.split(' '))<20:
-                            logger.info('{}: {} (to be removed)'.format(
-                                pid, se.group(0)))
-                            A = re.sub(rule_2, lambda x: '', A)
-
-                               
-                    prA = ' '.join(sum(self.text_processor.mat_preprocess(A), []))
-                    f.write(prA + '\n')
-
+                for i in range(progress.get('nmerged', 0), progress['nshards']):
+                    with open(os.path.join(shard_dir, 'shard_{:06d}.txt'.format(i)), 'r') as g:
+                        f.write(g.read())
+            save_progress(dict(progress, nmerged=progress['nshards']))
         elif em=='RAM':
-            texts = []
-            for i in range(len(titles)):
-                A = titles[i] + '. ' + abstracts[i]
-                prA = ' '.join(sum(self.text_processor.mat_preprocess(A), []))
-                texts += [prA]
             return texts
 
     def get_yearwise_authors_by_keywords(self, terms,
@@ -527,50 +1276,120 @@ class DB(object):
                                          max_yr=None,
                                          return_papers=True,
                                          case_sensitives=[]):
+        """Returning authors (and papers, if `return_papers=True`) of papers
+        with any of the given terms (keywords, or entities if `chemical=True`)
+        by their years, in the range [min_yr, max_yr] (defaults: first and last
+        years of the papers)
+
+        `terms` can also be a list of term sets (lists), in which case a list
+        of outputs (one per set) is returned. Papers, years and authors of all
+        the sets are fetched through a single join and grouped by a single sort.
+        """
 
+        multi = len(terms)>0 and isinstance(terms[0], (list, tuple, np.ndarray))
+        term_sets = terms if multi else [terms]
 
-        # For chemicals, we could get X-authors directly, but since we want to
-        # compute year-wise SDs, we will first get X-papers and their dates
-        # and then get their authors
+        # papers of each set
         if chemical:
-            res_dict = self.get_papers_by_chemicals(terms, ['paper_id','date'])
+            names = np.unique(np.concatenate([np.asarray(T, dtype=object) for T in term_sets]))
+            res = self.get_LoP_by_ents(names, cols=['id'], csr=True) if len(names)>0 else []
+            ent_pids = {} if len(res)==0 else \
+                {k: res[2]['id'][res[1][i]:res[1][i+1]] for i,k in enumerate(res[0])}
+            set_pids = [np.concatenate([ent_pids.get(t, np.array([], dtype=int)) for t in T] +
+                                       [np.array([], dtype=int)]) for T in term_sets]
         else:
-            res_dict = self.get_papers_by_keywords(terms,
-                                                   ['paper_id','date'],
-                                                   'OR',
-                                                   case_sensitives)
-
+            set_pids = [self.get_papers_by_keywords(T,
+                                                    logical_comb='OR',
+                                                    case_sensitives=case_sensitives).get('id', [])
+                        for T in term_sets]
+        set_pids = [np.unique(np.asarray(P, dtype=int)) for P in set_pids]
+
+        # (set, paper) pairs joined with (paper, year, author) triples
+        sets = np.repeat(np.arange(len(term_sets)), [len(P) for P in set_pids])
+        pids = np.concatenate(set_pids + [np.array([], dtype=int)])
+        T = self.get_years_authors_by_PID(np.unique(pids))
+        if len(T)==0:
+            return [{} for _ in term_sets] if multi else {}
+        sinds = np.argsort(T['paper_id'], kind='stable')
+        tpids = T['paper_id'][sinds]
+        starts = np.searchsorted(tpids, pids, 'left')
+        lens = np.searchsorted(tpids, pids, 'right') - starts
+        shifts = np.repeat(starts - np.concatenate(([0], np.cumsum(lens)[:-1])), lens)
+        rows = sinds[np.arange(np.sum(lens)) + shifts]
+        sets, pids = np.repeat(sets, lens), np.repeat(pids, lens)
+        years, auths = T['year'][rows].astype(int), T['author_id'][rows].astype(int)
+
+        # a single sort by (set, year, author, paper)
+        sinds = np.lexsort((pids, auths, years, sets))
+        sets, years, auths, pids = sets[sinds], years[sinds], auths[sinds], pids[sinds]
+        set_starts = np.searchsorted(sets, np.arange(len(term_sets)+1))
+
+        outs = []
+        for i in range(len(term_sets)):
+            yrs = years[set_starts[i]:set_starts[i+1]]
+            if len(yrs)==0:
+                outs += [{}]
+                continue
+            A = auths[set_starts[i]:set_starts[i+1]]
+            P = pids[set_starts[i]:set_starts[i+1]]
+            lo = np.min(yrs) if min_yr is None else min_yr
+            hi = np.max(yrs) if max_yr is None else max_yr
+
+            # rows are sorted by year and then author, hence duplicates are adjacent
+            first = np.ones(len(yrs), dtype=bool)
+            first[1:] = (yrs[1:]!=yrs[:-1]) | (A[1:]!=A[:-1])
+            first &= (A!=-1)
+            yr_authors = {yr: [] for yr in np.arange(lo, hi+1)}
+            yr_authors.update({yr: auths_yr for yr, auths_yr in
+                               papers_by_year(yrs[first], A[first]).items() if lo<=yr<=hi})
+            if return_papers:
+                yr_papers = {yr: [] for yr in np.arange(lo, hi+1)}
+                yr_papers.update({yr: list(np.unique(papers)) for yr, papers in
+                                  papers_by_year(yrs, P).items() if lo<=yr<=hi})
+                outs += [(yr_authors, yr_papers)]
+            else:
+                outs += [yr_authors]
+
+        return outs if multi else outs[0]
+
+    def get_years_authors_by_PID(self, paper_ids):
+        """Returning (paper ID, year, author ID) triples of a set of papers
+        through a single join; author-less papers get author ID -1
+        """
 
-        if len(res_dict)>0:
-            (_,papers), (_,dates) = res_dict.items()
-        else:
+        if len(paper_ids)==0:
             return {}
+        scomm = 'SELECT P.id, {}, IFNULL(P2A.author_id, -1) FROM paper P \
+                 LEFT JOIN paper_author_mapping P2A ON P2A.paper_id=P.id \
+                 WHERE {{ids}};'.format(self.year_expr())
+        return self.execute_and_get_results_by_ids(scomm, ['paper_id', 'year', 'author_id'],
+                                                   'P.id', paper_ids)
+
+    def get_years_authors_by_ents(self, names):
+        """Returning (entity, paper ID, year, author ID) quadruples of
+        the papers of a set of entities through a single join; author-less
+        papers get author ID -1
+        """
 
-        dates_yrs = np.array([d.year for d in dates])
-        if min_yr is None:    
-            min_yr = np.min(dates_yrs)
-        if max_yr is None:
-            max_yr = np.max(dates_yrs)
-
-        yr_authors = {yr: [] for yr in np.arange(min_yr,max_yr+1)}
-
-        for yr in np.arange(min_yr, max_yr+1):
-            yr_papers = [papers[i] for i in np.where(dates_yrs==yr)[0]]
-            if len(yr_papers)>0:
-                auths = self.get_authors_by_paper_id(yr_papers, ['author_id'])
-                # taking care of author-less papers
-                if len(auths)>0:
-                    yr_authors[yr] = list(np.unique(auths['author_id']))
+        names = list(names)
+        if len(names)==0:
+            return {}
+        if self.needs_chunking(names):
+            res = [r for r in self.map_chunks(self.get_years_authors_by_ents, names) if len(r)>0]
+            if len(res)==0:
+                return {}
+            return {col: np.concatenate([r[col] for r in res]) for col in res[0]}
 
-        if return_papers:
-            papers_dates_dict = {}
-            for yr in np.arange(min_yr, max_yr+1):
-                papers_dates_dict[yr] = list(np.array(papers)[dates_yrs==yr])
-            return yr_authors, papers_dates_dict
-        else:
-            return yr_authors
+        scomm = 'SELECT E.{}, P.id, {}, IFNULL(P2A.author_id, -1) FROM {} E \
+                 INNER JOIN {}_paper_mapping E2P ON E2P.{}_id=E.id \
+                 INNER JOIN paper P ON P.id=E2P.paper_id \
+                 LEFT JOIN paper_author_mapping P2A ON P2A.paper_id=P.id \
+                 WHERE E.{} IN ({});'.format(self.entity_col, self.year_expr(),
+                                             self.entity_tab, self.entity_tab, self.entity_tab,
+                                             self.entity_col, placeholders(len(names)))
+        return self.execute_and_get_results(scomm, [self.entity_col, 'paper_id', 'year', 'author_id'],
+                                            names)
 
-        
     def collect_authors_new_discoveries(self, full_chems,
                                         cocrs,
                                         Y_terms,
@@ -579,81 +1398,122 @@ class DB(object):
         """Collecting authors of papers with new co-occurrences (new discoveries)
         and extracting their previous papers on the topic of the property and/or
         the newly studied molecule
+
+        The output is of the form 
+        {year: {chemical: {paper: {author: [Y_papers, X_papers]}}}}
+        where `Y_papers` (`X_papers`) lists the earlier papers of the author 
+        on the property (molecule) by their years.
+
+        Papers, years and authors of the property and of all the new 
+        discoveries of a year are fetched by a few joins, and the rest is 
+        done in memory. Precomputed papers (and authors) of the property can be
+        given by year as `yr_Y_papers` (and `yr_Y_authors`); then the earlier
+        property papers of an author are only taken from the years in which
+        the author is among the given ones. If `savefile_path` is given, the
+        results are saved after each year; with `resume=True`, years that 
+        already exist in that file are skipped.
         """
 
         case_sensitives = kwargs.get('case_sensitives', [])
         logfile_path = kwargs.get('logfile_path', None)
         savefile_path = kwargs.get('savefile_path', None)
         start_yr = kwargs.get('start_yr', 2001)
-        yr_Y_authors = kwargs.get('yr_Y_authors', None)
+        # authors are queried along with the years of the papers; if given, the
+        # authors of each year restrict them
         yr_Y_papers = kwargs.get('yr_Y_papers', None)
+        yr_Y_authors = kwargs.get('yr_Y_authors', None)
+        resume = kwargs.get('resume', False)
         
         logger = set_up_logger(__name__,logfile_path,False)
 
-        if (yr_Y_authors is None) or (yr_Y_papers is None):
-            yr_Y_authors, yr_Y_papers = self.get_yearwise_authors_by_keywords(
-                Y_terms, return_papers=True, case_sensitives=case_sensitives)
+        if yr_Y_papers is None:
+            Y_pids = self.get_papers_by_keywords(Y_terms,
+                                                 case_sensitives=case_sensitives).get('id', [])
+        else:
+            Y_pids = np.concatenate([np.array(P, dtype=int) for P in yr_Y_papers.values()] +
+                                    [np.array([], dtype=int)])
+        Y = self.get_years_authors_by_PID(np.unique(Y_pids))
+        if len(Y)==0:
+            Y = {'paper_id': np.array([], dtype=int), 'year': np.array([], dtype=int),
+                 'author_id': np.array([], dtype=int)}
+        if yr_Y_authors is not None:
+            yr_auth_sets = {yr: set(A) for yr, A in yr_Y_authors.items()}
+            mask = np.array([a in yr_auth_sets.get(y, ()) for y, a in zip(Y['year'], Y['author_id'])],
+                            dtype=bool)
+            Y = {col: np.asarray(arr)[mask] for col, arr in Y.items()}
+        Y_sets = {yr: set(P) for yr, P in papers_by_year(Y['year'], Y['paper_id']).items()}
+        # property papers grouped by their authors
+        Y_auths, Y_offsets, Y_vals = group_by_key(Y['author_id'], {'year': Y['year'],
+                                                                   'paper_id': Y['paper_id']})
+        Y_auth_locs = dict(zip(Y_auths.tolist(), range(len(Y_auths))))
+
+        def earlier_papers(locs, offsets, vals, auth, yr):
+            i = locs.get(auth, None)
+            if i is None:
+                return {}
+            years = vals['year'][offsets[i]:offsets[i+1]]
+            pids = vals['paper_id'][offsets[i]:offsets[i+1]]
+            return papers_by_year(years[years<yr], pids[years<yr])
 
-        # analyze years from 2001 to 2018 (note that: yrs[-1]=2019)
         disc_dict = {}
+        if resume and (savefile_path is not None) and os.path.exists(savefile_path):
+            with open(savefile_path, 'rb') as f:
+                disc_dict = pickle.load(f)
+            logger.info('Results of years {} are loaded from {}'.format(
+                list(disc_dict.keys()), savefile_path))
+
+        first_locs = first_cocr_locs(cocrs)
+
+        # analyze years from 2001 to 2018 (note that: yrs[-1]=2019)
         for yr in np.arange(start_yr, yrs[-1]):
+            if yr in disc_dict:
+                logger.info('PROGRESS FOR {}: loaded from {}'.format(yr, savefile_path))
+                continue
             yr_loc = np.where(yrs==yr)[0][0]
-            thisyr_Y_papers = yr_Y_papers[yr]
+            thisyr_Y_papers = Y_sets.get(yr, set())
 
             disc_dict[yr] = {}
-            new_discs = find_first_time_cocrs(cocrs, yr_loc)
+            new_discs = np.where(first_locs==yr_loc)[0]
             logger.info('PROGRESS FOR {}: {} new discoveries found'.format(yr,len(new_discs)))
-            for i,chm in enumerate(full_chems[new_discs]):
-                yr_X_authors, yr_X_papers = self.get_yearwise_authors_by_keywords(
-                    [chm], chemical=True, return_papers=True)
-                thisyr_X_papers = yr_X_papers[yr]
 
-                # papers with co-occurrences
-                ov_papers = list(set(thisyr_Y_papers).intersection(set(thisyr_X_papers)))
-                disc_dict[yr][chm] = {pid:{} for pid in ov_papers}
-                for pid in ov_papers:
-                    # authors of papers with co-occurrences
-                    A = self.get_authors_by_paper_id([pid],['author_id'])
-                    if len(A)>0: A=A['author_id']
-                    disc_dict[yr][chm][pid]  = {a:[{},{}] for a in A}
-
-                    for auth in A:
-                        """ for the property """
-                        # years that the current author has published a paper on Y so that ..
-                        a_pubY_yrs = [y for y in yr_Y_authors if auth in yr_Y_authors[y] and y<yr]
-                        if len(a_pubY_yrs)>0:
-                            # .. we can consider only those years to query his/her papers
-                            array_yrs = '({})'.format(','.join([str(y) for y in a_pubY_yrs]))
-                            scomm = 'SELECT P.paper_id, YEAR(P.date) FROM paper P \
-                                     INNER JOIN paper_author_mapping P2A ON P.paper_id=P2A.paper_id \
-                                     WHERE P2A.author_id={} AND (YEAR(P.date) IN {})'.format(auth, array_yrs)
-                            # Pa and Ya are the papers and years of those papers
-                            (_,Pa),(_,Ya) = self.execute_and_get_results(scomm,['paper_id','year']).items()
-                            uYa = np.unique(Ya)
-                            disc_dict[yr][chm][pid][auth][0] = {yr: [Pa[i] for i in range(len(Pa))
-                                                                     if Ya[i]==yr
-                                                                     if Pa[i] in yr_Y_papers[yr]] for yr in uYa}
-                            
-                            
-                        """ for the molecule """
-                        a_pubX_yrs = [x for x in yr_X_authors if auth in yr_X_authors[x] and x<yr]
-                        if len(a_pubX_yrs)>0:
-                            array_yrs = '({})'.format(','.join([str(x) for x in a_pubX_yrs]))
-                            scomm = 'SELECT P.paper_id, YEAR(P.date) FROM paper P \
-                                     INNER JOIN paper_author_mapping P2A ON P.paper_id=P2A.paper_id \
-                                     WHERE P2A.author_id={} AND (YEAR(P.date) IN {})'.format(auth, array_yrs)
-                            (_,Pa),(_,Ya) = self.execute_and_get_results(scomm,['paper_id','year']).items()
-                            uYa = np.unique(Ya)
-                            disc_dict[yr][chm][pid][auth][1] = {yr: [Pa[i] for i in range(len(Pa))
-                                                                     if Ya[i]==yr
-                                                                     if Pa[i] in yr_X_papers[yr]] for yr in uYa}
-                            
+            chms = np.asarray(full_chems)[new_discs]
+            X = self.get_years_authors_by_ents(chms)
+            disc_dict[yr] = {chm: {} for chm in chms}
+            if len(X)==0:
+                X = {self.entity_col: np.array([]), 'paper_id': np.array([], dtype=int),
+                     'year': np.array([], dtype=int), 'author_id': np.array([], dtype=int)}
+            X_chms, X_offsets, X_vals = group_by_key(X[self.entity_col],
+                                                     {col: X[col] for col in ['paper_id', 'year', 'author_id']})
+
+            for i,chm in enumerate(X_chms):
                 if i>0 and not(i%100):
                     logger.info('\t{} materials have been analyzed'.format(i))
+                vals = {col: arr[X_offsets[i]:X_offsets[i+1]] for col, arr in X_vals.items()}
+
+                # papers with co-occurrences
+                thisyr = vals['year']==yr
+                ov_papers = sorted(thisyr_Y_papers.intersection(vals['paper_id'][thisyr].tolist()))
+                if len(ov_papers)==0:
+                    continue
+
+                # molecule papers grouped by their authors
+                auths, offsets, avals = group_by_key(vals['author_id'], {'year': vals['year'],
+                                                                         'paper_id': vals['paper_id']})
+                auth_locs = dict(zip(auths.tolist(), range(len(auths))))
+
+                ov_mask = np.isin(vals['paper_id'], ov_papers) & thisyr
+                pid_auths = groups_to_dict(*group_by_key(vals['paper_id'][ov_mask],
+                                                         {'author_id': vals['author_id'][ov_mask]}))
+                for pid in ov_papers:
+                    A = np.unique(pid_auths[pid]['author_id'])
+                    disc_dict[yr][chm][pid] = {a: [earlier_papers(Y_auth_locs, Y_offsets, Y_vals, a, yr),
+                                                   earlier_papers(auth_locs, offsets, avals, a, yr)]
+                                               for a in A.tolist() if a!=-1}
 
             if savefile_path is not None:
-                with open(savefile_path, 'wb') as f:
+                with open(savefile_path + '.tmp', 'wb') as f:
                     pickle.dump(disc_dict, f)
+                os.replace(savefile_path + '.tmp', savefile_path)
                 logger.info('The results have been saved in {}'.format(savefile_path))
                 
         return disc_dict
@@ -0,0 +1,217 @@
+import os
+import time
+import pickle
+import hashlib
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from pybliometrics.scopus import AbstractRetrieval
+from pybliometrics.scopus.exception import Scopus400Error, Scopus404Error, Scopus429Error
+
+
+# parsed documents (only the fields that we use from `AbstractRetrieval`)
+Author = namedtuple('Author', ['auid', 'indexed_name', 'surname', 'given_name', 'affiliation'])
+Affiliation = namedtuple('Affiliation', ['id', 'name', 'city', 'country'])
+Document = namedtuple('Document', ['doi', 'title', 'description', 'coverDate',
+                                   'authors', 'affiliation'])
+
+
+def parse_document(r):
+    """Converting a retrieved document into a (picklable) `Document`
+    """
+    fields = lambda x, cls: cls(*[getattr(x, f, None) for f in cls._fields])
+    authors = None if r.authors is None else [fields(a, Author) for a in r.authors]
+    affs = None if r.affiliation is None else [fields(a, Affiliation) for a in r.affiliation]
+    return Document(r.doi, r.title, r.description, r.coverDate, authors, affs)
+
+
+# errors that are not transient, i.e. retrying the DOI will fail again
+DEFINITIVE_ERRORS = (Scopus400Error, Scopus404Error)
+
+
+class RetrievalError(Exception):
+    """A document could not be retrieved (other than exceeding the quota)
+    """
+    pass
+
+
+class TokenBucket(object):
+    """Thread-safe token-bucket rate limiter allowing `rate` requests per
+    second on average and bursts of at most `capacity` requests; `pause`
+    blocks all the requests for a while (e.g. after quota errors)
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = max(1., rate) if capacity is None else capacity
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.paused_until = 0.
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.paused_until:
+                    self.tokens = min(self.capacity, self.tokens + (now-self.last)*self.rate)
+                    self.last = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1-self.tokens)/self.rate
+                else:
+                    wait = self.paused_until - now
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic()+seconds)
+            self.last = self.paused_until
+            self.tokens = 0.
+
+
+class DocumentCache(object):
+    """On-disk cache of parsed documents (or their retrieval errors), one
+    pickle file per DOI
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def path(self, doi):
+        key = hashlib.sha1(doi.lower().encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + '.pkl')
+
+    def get(self, doi):
+        path = self.path(doi)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def put(self, doi, entry):
+        path = self.path(doi)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(entry, f)
+        os.replace(tmp_path, path)
+
+
+class Retriever(object):
+    """Retrieving (and caching) documents of DOIs from Scopus concurrently
+    and with a limited rate
+
+    *Parameters:*
+
+    * cache_dir: directory of the on-disk cache of parsed documents; cached
+      DOIs are never fetched again
+    * cache_failures: caching the DOIs that failed definitively too (i.e. by
+      one of `DEFINITIVE_ERRORS`, such as not found); transient errors (e.g.
+      time-outs) are never cached (default: False)
+    * nworkers: number of concurrent requests
+    * rate: maximum number of requests per second
+    * max_retries: number of retries after quota errors (`Scopus429Error`),
+      each after pausing all requests for `backoff * 2^k` seconds
+    * backend: function that retrieves a DOI (default: `AbstractRetrieval`),
+      e.g. a local fake backend for testing
+    """
+
+    def __init__(self, cache_dir=None, nworkers=1, rate=5, **kwargs):
+        self.cache = None if cache_dir is None else DocumentCache(cache_dir)
+        self.nworkers = nworkers
+        self.bucket = TokenBucket(rate, kwargs.get('burst', None))
+        self.max_retries = kwargs.get('max_retries', 3)
+        self.backoff = kwargs.get('backoff', 1.)
+        self.backend = kwargs.get('backend', AbstractRetrieval)
+        self.cache_failures = kwargs.get('cache_failures', False)
+        self.logger = kwargs.get('logger', None)
+        self.stats = {'cached': 0, 'fetched': 0, 'failed': 0, 'throttled': 0}
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def fetch(self, doi):
+        for attempt in range(self.max_retries+1):
+            self.bucket.acquire()
+            try:
+                return self.backend(doi)
+            except Scopus429Error:
+                self.count('throttled')
+                if attempt==self.max_retries:
+                    raise
+                delay = self.backoff * 2**attempt
+                if self.logger is not None:
+                    self.logger.info('Scopus quota error for {}; pausing for {} s.'.format(doi, delay))
+                self.bucket.pause(delay)
+
+    def get(self, doi):
+        """Returning the parsed document of a DOI, raising `RetrievalError`
+        if it cannot be retrieved or `Scopus429Error` if the quota is still
+        exceeded after the retries
+        """
+        if self.cache is not None:
+            entry = self.cache.get(doi)
+            if entry is not None:
+                self.count('cached')
+                if isinstance(entry, Document):
+                    return entry
+                raise RetrievalError(entry)
+
+        try:
+            doc = parse_document(self.fetch(doi))
+        except Scopus429Error:
+            raise
+        except Exception as e:
+            self.count('failed')
+            if (self.cache is not None) and self.cache_failures and \
+               isinstance(e, DEFINITIVE_ERRORS):
+                self.cache.put(doi, repr(e))
+            raise RetrievalError(repr(e))
+
+        self.count('fetched')
+        if self.cache is not None:
+            self.cache.put(doi, doc)
+        return doc
+
+    def get_or_error(self, doi):
+        try:
+            return self.get(doi)
+        except RetrievalError as e:
+            return e
+
+    def map(self, dois):
+        """Yielding (DOI, document) pairs in the order of the DOIs, where
+        the document is a `RetrievalError` for DOIs that could not be
+        retrieved; `Scopus429Error` is raised once the quota is exhausted
+
+        At most twice the number of workers DOIs are requested ahead of
+        the consumer.
+        """
+
+        if self.nworkers<=1:
+            for doi in dois:
+                yield doi, self.get_or_error(doi)
+            return
+
+        with ThreadPoolExecutor(self.nworkers) as executor:
+            pending = deque()
+            try:
+                for doi in dois:
+                    pending.append((doi, executor.submit(self.get_or_error, doi)))
+                    if len(pending) >= 2*self.nworkers:
+                        doi, future = pending.popleft()
+                        yield doi, future.result()
+                while len(pending)>0:
+                    doi, future = pending.popleft()
+                    yield doi, future.result()
+            finally:
+                for _, future in pending:
+                    future.cancel()
@@ -0,0 +1,105 @@
+# index of the materialized year column (covering the paper IDs)
+YEAR_INDEX = 'paper_year_id'
+
+# covering indexes: (table, index name, columns); "{entity_tab}" will be
+# replaced by the entity table of the database
+COVERING_INDEXES = [('paper', YEAR_INDEX, ['year', 'id']),
+                    ('paper_author_mapping', 'p2a_paper_author', ['paper_id', 'author_id']),
+                    ('paper_author_mapping', 'p2a_author_paper', ['author_id', 'paper_id']),
+                    ('{entity_tab}_paper_mapping', 'e2p_paper_entity', ['paper_id', '{entity_tab}_id']),
+                    ('{entity_tab}_paper_mapping', 'e2p_entity_paper', ['{entity_tab}_id', 'paper_id'])]
+
+
+def has_index(db, table, index_name):
+    scomm = 'SELECT COUNT(*) FROM information_schema.STATISTICS \
+             WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s AND INDEX_NAME=%s;'
+    return db.run_query(scomm, [table, index_name])[0][0] > 0
+
+
+def has_trigger(db, trigger_name):
+    scomm = 'SELECT COUNT(*) FROM information_schema.TRIGGERS \
+             WHERE TRIGGER_SCHEMA=DATABASE() AND TRIGGER_NAME=%s;'
+    return db.run_query(scomm, [trigger_name])[0][0] > 0
+
+
+def migrate_year_column(db, batch_size=100000, triggers=True, logger=None):
+    """Adding an indexed column `year` to the paper table (materializing
+    `YEAR(date)`) and covering indexes to the mapping tables, such that
+    year-restricted queries of `data.readers.DB` can use indexes
+
+    The migration can be re-run safely: existing columns, triggers and
+    indexes are skipped and only the rows whose year is missing are
+    backfilled (in batches of `batch_size` paper IDs). If `triggers=True`,
+    triggers are also created to keep the column in sync with the dates of
+    papers that are inserted/updated later.
+    """
+
+    if 'year' not in db.table_columns('paper'):
+        db.execute_update('ALTER TABLE paper ADD COLUMN year SMALLINT NULL;')
+        if logger is not None:
+            logger.info('Column "year" has been added to table paper.')
+
+    # triggers go before the backfill so that no new paper is missed
+    if triggers:
+        for event in ['INSERT', 'UPDATE']:
+            name = 'paper_year_{}'.format(event.lower())
+            if not(has_trigger(db, name)):
+                db.execute_update('CREATE TRIGGER {} BEFORE {} ON paper FOR EACH ROW \
+                                   SET NEW.year=YEAR(NEW.date);'.format(name, event))
+
+    min_id, max_id = db.run_query('SELECT MIN(id), MAX(id) FROM paper;')[0]
+    if min_id is not None:
+        for start in range(min_id, max_id+1, batch_size):
+            cnt = db.execute_update('UPDATE paper SET year=YEAR(date) \
+                                     WHERE id>=%s AND id<%s AND year IS NULL;',
+                                    [start, start+batch_size])
+            if logger is not None:
+                logger.info('Years of papers in [{}, {}) have been backfilled ({} rows).'.format(
+                    start, start+batch_size, cnt))
+
+    for table, index_name, cols in COVERING_INDEXES:
+        table = table.format(entity_tab=db.entity_tab)
+        cols = [col.format(entity_tab=db.entity_tab) for col in cols]
+        if not(has_index(db, table, index_name)):
+            db.execute_update('CREATE INDEX {} ON {} ({});'.format(index_name, table, ','.join(cols)))
+            if logger is not None:
+                logger.info('Index {} has been created on {}({}).'.format(
+                    index_name, table, ','.join(cols)))
+
+    db.use_year_column = True
+
+
+def explain(db, scomm, args=None):
+    """Returning the execution plan of a query as a list of dictionaries
+    (one per row of MySQL's `EXPLAIN`)
+    """
+    with db.cursor() as crsr:
+        crsr.execute('EXPLAIN ' + scomm, args)
+        names = [d[0] for d in crsr.description]
+        return [dict(zip(names, row)) for row in crsr.fetchall()]
+
+
+def check_year_filters(db, years, logger=None):
+    """Checking (through `EXPLAIN`) whether year-restricted queries built
+    by `DB` read the paper table through the year index
+
+    Returns a dictionary {query name: (index is used or not, plan)}.
+    """
+
+    constraint_str, args = db.years_constraint(years)
+    queries = {'papers': 'SELECT P.id FROM paper P WHERE {};',
+               'paper_authors': 'SELECT P2A.author_id, P.id FROM paper P \
+                                 INNER JOIN paper_author_mapping P2A ON P2A.paper_id=P.id \
+                                 WHERE {};'}
+
+    res = {}
+    for name, scomm in queries.items():
+        plan = explain(db, scomm.format(constraint_str), args)
+        used = any([(row.get('table')=='P') and (row.get('key')==YEAR_INDEX) for row in plan])
+        res[name] = (used, plan)
+        if logger is not None:
+            logger.info('{}: year index is {}used ({}).'.format(
+                name, '' if used else 'NOT ',
+                ', '.join(['{}:{}'.format(row.get('table'), row.get('key')) for row in plan])))
+
+    return res
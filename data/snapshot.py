@@ -0,0 +1,282 @@
+import os
+import re
+import json
+import numpy as np
+
+from data.readers import group_by_key, groups_to_dict
+
+
+# arrays of the snapshot: {file name: (table, column)}
+SNAPSHOT_ARRAYS = {'paper_id':       ('paper', 'id'),
+                   'paper_year':     ('paper', 'YEAR(date)'),
+                   'paper_doi':      ('paper', 'doi'),
+                   'author_id':      ('author', 'id'),
+                   'entity_id':      ('{entity_tab}', 'id'),
+                   'entity_name':    ('{entity_tab}', '{entity_col}'),
+                   'p2a_paper_id':   ('paper_author_mapping', 'paper_id'),
+                   'p2a_author_id':  ('paper_author_mapping', 'author_id'),
+                   'e2p_entity_id':  ('{entity_tab}_paper_mapping', '{entity_tab}_id'),
+                   'e2p_paper_id':   ('{entity_tab}_paper_mapping', 'paper_id')}
+# arrays of strings (the others are integers)
+STRING_ARRAYS = ['paper_doi', 'entity_name']
+
+
+def export_snapshot(db, snapshot_dir, batch_size=100000, logger=None):
+    """Dumping the tables that are needed for the analysis (papers with their
+    years and DOIs, authors, entities and the mapping tables) from a database
+    (`data.readers.DB`) into NumPy files in `snapshot_dir`, which can be
+    later queried by `SnapshotDB` without any database connection
+
+    Tables are streamed in batches of `batch_size` rows; paper and entity
+    tables are sorted by their IDs. Integer columns are filled into arrays
+    that are allocated by the row counts of the tables, and strings are kept
+    as UTF-8 encoded byte arrays (per batch), such that no column is held as
+    a list of Python objects. Byte arrays of strings can be memory-mapped
+    similar to the other arrays.
+    """
+
+    if not os.path.exists(snapshot_dir):
+        os.makedirs(snapshot_dir)
+
+    tables = {}
+    for name, (tab, col) in SNAPSHOT_ARRAYS.items():
+        tab = tab.format(entity_tab=db.entity_tab)
+        col = col.format(entity_tab=db.entity_tab, entity_col=db.entity_col)
+        tables.setdefault(tab, []).append((name, col))
+
+    counts = {}
+    for tab, name_cols in tables.items():
+        order = ' ORDER BY id' if tab in ['paper', 'author', db.entity_tab] else ''
+        scomm = 'SELECT {} FROM {}{};'.format(','.join([col for _,col in name_cols]), tab, order)
+
+        nrows = db.run_query('SELECT COUNT(*) FROM {};'.format(tab))[0][0]
+        cols = [[] if name in STRING_ARRAYS else np.empty(nrows, dtype=np.int64)
+                for name,_ in name_cols]
+        n = 0
+        for rows in db.stream(scomm, batch_size=batch_size):
+            for i, col in enumerate(zip(*rows)):
+                if name_cols[i][0] in STRING_ARRAYS:
+                    cols[i] += [np.array([b'' if x is None else x.encode('utf-8') for x in col],
+                                         dtype=bytes)]
+                    continue
+                if n+len(col) > len(cols[i]):
+                    # rows that are added after counting
+                    cols[i] = np.concatenate((cols[i], np.empty(n+len(col)-len(cols[i]), dtype=np.int64)))
+                cols[i][n:n+len(col)] = [-1 if x is None else x for x in col]
+            n += len(rows)
+        for (name, _), col in zip(name_cols, cols):
+            if name in STRING_ARRAYS:
+                arr = np.concatenate(col) if len(col)>0 else np.array([], dtype=bytes)
+            else:
+                arr = col[:n]
+            np.save(os.path.join(snapshot_dir, '{}.npy'.format(name)), arr)
+        counts[tab] = n
+        if logger is not None:
+            logger.info('{} rows of table {} have been exported.'.format(counts[tab], tab))
+
+    with open(os.path.join(snapshot_dir, 'meta.json'), 'w') as f:
+        json.dump({'entity_tab': db.entity_tab,
+                   'entity_col': db.entity_col,
+                   'counts': counts}, f)
+
+
+def rows_of_keys(index, keys):
+    """Locating rows whose keys are among the given keys, using an index
+    (sorted keys, sorting order) of the key column
+    """
+
+    sorted_keys, order = index
+    keys = np.unique(keys)
+    starts = np.searchsorted(sorted_keys, keys, 'left')
+    lens = np.searchsorted(sorted_keys, keys, 'right') - starts
+    if np.sum(lens)==0:
+        return np.array([], dtype=int)
+
+    # concatenating the ranges [start, start+len) of all the keys
+    shifts = np.repeat(starts - np.concatenate(([0], np.cumsum(lens)[:-1])), lens)
+    return np.sort(order[np.arange(np.sum(lens)) + shifts])
+
+
+class SnapshotDB(object):
+    """Answering (a subset of) query methods of `data.readers.DB` from a
+    snapshot that is exported by `export_snapshot`, through vectorized joins
+    over memory-mapped arrays
+
+    The outputs have the same format as those of `DB`. Available columns are
+    "id", "year" and "doi" for papers, "id" for authors and "id" and the name
+    column for entities.
+    """
+
+    def __init__(self, snapshot_dir, mmap=True):
+
+        with open(os.path.join(snapshot_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.entity_tab = self.meta['entity_tab']
+        self.entity_col = self.meta['entity_col']
+
+        mmap_mode = 'r' if mmap else None
+        self.arrs = {name: np.load(os.path.join(snapshot_dir, '{}.npy'.format(name)),
+                                   mmap_mode=mmap_mode)
+                     for name in SNAPSHOT_ARRAYS}
+
+        # indices of the key columns: (sorted keys, sorting order)
+        self.indices = {}
+        for name in ['p2a_paper_id', 'p2a_author_id', 'e2p_paper_id', 'e2p_entity_id', 'entity_name']:
+            order = np.argsort(self.arrs[name], kind='stable')
+            self.indices[name] = (np.asarray(self.arrs[name])[order], order)
+
+        self.columns = {'paper': {'id': 'paper_id', 'year': 'paper_year', 'doi': 'paper_doi'},
+                        'author': {'id': 'author_id'},
+                        self.entity_tab: {'id': 'entity_id', self.entity_col: 'entity_name'}}
+
+    def count_table_rows(self, table_name):
+        return self.meta['counts'][table_name]
+
+    def get_1d_query(self, scomm, args=None):
+        """Answering simple queries of the form "SELECT col FROM table;"
+        (including "SELECT YEAR(date) FROM paper;")
+        """
+        m = re.match(r'\s*SELECT\s+(\w+|YEAR\(\s*date\s*\))\s+FROM\s+(\w+)\s*;?\s*$',
+                     scomm, re.IGNORECASE)
+        # years of the papers are exported as a column
+        col = 'year' if (m is not None) and m.group(1).upper().startswith('YEAR') else \
+            (m.group(1) if m is not None else None)
+        if (m is None) or (m.group(2) not in self.columns) or \
+           (col not in self.columns[m.group(2)]):
+            raise ValueError('Query "{}" cannot be answered by the snapshot.'.format(scomm))
+        return self.column(m.group(2), col, slice(None))
+
+    def column(self, table, col, inds):
+        """Returning values of a column of the paper, author or entity table
+        in the given row indices
+        """
+        arr = self.arrs[self.columns[table][col]][inds]
+        if arr.dtype.kind=='S':
+            arr = np.char.decode(arr, 'utf-8')
+        return np.asarray(arr)
+
+    def locate(self, table, ids):
+        """Row indices of a set of IDs in the paper, author or entity table,
+        together with a mask of the IDs that are found in the table (indices
+        of the missing ones are not valid)
+        """
+        arr = self.arrs[self.columns[table]['id']]
+        ids = np.asarray(ids)
+        inds = np.minimum(np.searchsorted(arr, ids), max(len(arr)-1, 0))
+        found = (arr[inds]==ids) if len(arr)>0 else np.zeros(len(ids), dtype=bool)
+        return inds, found
+
+    def select_papers_years(self, pids, years):
+        """Returning a mask of papers that are published in given years
+        (papers missing from the paper table are left out)
+        """
+        if len(years)==0:
+            return np.ones(len(pids), dtype=bool)
+        inds, found = self.locate('paper', pids)
+        return found & np.isin(self.arrs['paper_year'][inds], years)
+
+    def entity_ids(self, names):
+        names = np.array([x.encode('utf-8') for x in names], dtype=bytes)
+        return self.arrs['entity_id'][rows_of_keys(self.indices['entity_name'], names)]
+
+    def grouped(self, keys, table, ids, cols, csr=False):
+        """Grouping the columns of the rows (given by their IDs) of a table
+        by a set of keys, in the same format as `DB`'s outputs; similar to the
+        joins of `DB`, IDs that are missing from the table are left out
+        """
+        inds, found = self.locate(table, ids)
+        keys, inds = np.asarray(keys)[found], inds[found]
+        if len(keys)==0:
+            return []
+        groups = group_by_key(keys, {col: self.column(table, col, inds) for col in cols})
+        return groups if csr else groups_to_dict(*groups)
+
+    def get_LoA_by_PID(self, paper_ids, **kwargs):
+        if type(paper_ids) is int:
+            paper_ids = [paper_ids]
+        rows = rows_of_keys(self.indices['p2a_paper_id'], paper_ids)
+        return self.grouped(self.arrs['p2a_paper_id'][rows], 'author',
+                            self.arrs['p2a_author_id'][rows], kwargs.get('cols', ['id']),
+                            kwargs.get('csr', False))
+
+    def get_NoA_by_PID(self, paper_ids):
+        if type(paper_ids) is int:
+            paper_ids = [paper_ids]
+        rows = rows_of_keys(self.indices['p2a_paper_id'], paper_ids)
+        keys, counts = np.unique(self.arrs['p2a_paper_id'][rows], return_counts=True)
+        return dict(zip(keys, counts))
+
+    def get_LoE_by_PID(self, paper_ids, **kwargs):
+        if type(paper_ids) is int:
+            paper_ids = [paper_ids]
+        rows = rows_of_keys(self.indices['e2p_paper_id'], paper_ids)
+        return self.grouped(self.arrs['e2p_paper_id'][rows], self.entity_tab,
+                            self.arrs['e2p_entity_id'][rows], kwargs.get('cols', ['id']),
+                            kwargs.get('csr', False))
+
+    def get_NoE_by_PID(self, paper_ids):
+        if type(paper_ids) is int:
+            paper_ids = [paper_ids]
+        rows = rows_of_keys(self.indices['e2p_paper_id'], paper_ids)
+        keys, counts = np.unique(self.arrs['e2p_paper_id'][rows], return_counts=True)
+        return dict(zip(keys, counts))
+
+    def get_LoP_by_AID(self, author_ids, **kwargs):
+        if type(author_ids) is int:
+            author_ids = [author_ids]
+        rows = rows_of_keys(self.indices['p2a_author_id'], author_ids)
+        pids = self.arrs['p2a_paper_id'][rows]
+        mask = self.select_papers_years(pids, kwargs.get('years', []))
+        return self.grouped(self.arrs['p2a_author_id'][rows][mask], 'paper',
+                            pids[mask], kwargs.get('cols', ['id']),
+                            kwargs.get('csr', False))
+
+    def get_NoP_by_AID(self, author_ids, **kwargs):
+        if type(author_ids) is int:
+            author_ids = [author_ids]
+        rows = rows_of_keys(self.indices['p2a_author_id'], author_ids)
+        pids = self.arrs['p2a_paper_id'][rows]
+        mask = self.select_papers_years(pids, kwargs.get('years', []))
+        keys, counts = np.unique(self.arrs['p2a_author_id'][rows][mask], return_counts=True)
+        return dict(zip(keys, counts))
+
+    def get_LoP_by_ents(self, names, **kwargs):
+        rows = rows_of_keys(self.indices['e2p_entity_id'], self.entity_ids(names))
+        pids = self.arrs['e2p_paper_id'][rows]
+        mask = self.select_papers_years(pids, kwargs.get('years', []))
+        # entity IDs are taken from the entity table, hence they are all found
+        ents = self.column(self.entity_tab, self.entity_col,
+                           self.locate(self.entity_tab, self.arrs['e2p_entity_id'][rows][mask])[0])
+        return self.grouped(ents, 'paper', pids[mask], kwargs.get('cols', ['id']),
+                            kwargs.get('csr', False))
+
+    def get_LoA_by_ents(self, ent_names, **kwargs):
+        """See `DB.get_LoA_by_ents`; only author IDs can be returned (along
+        with paper IDs, if `return_papers=True`)
+        """
+        rows = rows_of_keys(self.indices['e2p_entity_id'], self.entity_ids(ent_names))
+        pids = self.arrs['e2p_paper_id'][rows]
+        mask = self.select_papers_years(pids, kwargs.get('years', []))
+        pids = pids[mask]
+        eids = self.arrs['e2p_entity_id'][rows][mask]
+        if len(pids)==0:
+            return []
+
+        # joining (entity, paper) pairs with (paper, author) pairs
+        sorted_pids, order = self.indices['p2a_paper_id']
+        starts = np.searchsorted(sorted_pids, pids, 'left')
+        lens = np.searchsorted(sorted_pids, pids, 'right') - starts
+        shifts = np.repeat(starts - np.concatenate(([0], np.cumsum(lens)[:-1])), lens)
+        p2a_rows = order[np.arange(np.sum(lens)) + shifts]
+        # authors missing from the author table are left out
+        found = self.locate('author', self.arrs['p2a_author_id'][p2a_rows])[1]
+
+        ents = self.column(self.entity_tab, self.entity_col,
+                           self.locate(self.entity_tab, np.repeat(eids, lens)[found])[0])
+        columns = {'id': self.arrs['p2a_author_id'][p2a_rows][found]}
+        if kwargs.get('return_papers', False):
+            columns['paper_id'] = np.repeat(pids, lens)[found]
+        if len(ents)==0:
+            return []
+        groups = group_by_key(ents, columns)
+        return groups if kwargs.get('csr', False) else groups_to_dict(*groups)
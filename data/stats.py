@@ -0,0 +1,184 @@
+import re
+import json
+import time
+import heapq
+import threading
+import numpy as np
+
+
+def rows_nbytes(rows):
+    """Estimating the number of bytes of a set of rows (strings and
+    bytes by their lengths, other values as 8 bytes)
+    """
+    return sum([len(x) if isinstance(x, (str, bytes)) else 8 for row in rows for x in row])
+
+
+class QueryStats(object):
+    """Recording latency, number of rows and (estimated) bytes of the
+    executed queries, aggregated by the calling method and the fingerprint
+    of the SQL command
+
+    Fingerprints are the commands with their literals and parameters replaced
+    by "?" and lists of values collapsed, such that the same query with
+    different values is aggregated together. Queries slower than
+    `slow_threshold` seconds are appended (one JSON per line) to the slow
+    query log `slow_log_path`, if given. The `nslowest` slowest statements
+    are kept (with their arguments) so that they can be explained later.
+    """
+
+    def __init__(self, slow_threshold=None, slow_log_path=None, nslowest=10):
+        self.slow_threshold = slow_threshold
+        self.slow_log_path = slow_log_path
+        self.nslowest = nslowest
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.entries = {}
+        self.slowest = []
+        self.counter = 0
+
+    @staticmethod
+    def fingerprint(scomm):
+        fp = ' '.join(scomm.split()).rstrip(';')
+        fp = re.sub(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"", '?', fp)
+        fp = re.sub(r'\b\d+\b', '?', fp)
+        fp = fp.replace('%s', '?')
+        fp = re.sub(r'\?(\s*,\s*\?)+', '?,...', fp)
+        return fp
+
+    def record(self, method, scomm, args, latency, nrows, nbytes):
+        fp = self.fingerprint(scomm)
+        with self.lock:
+            entry = self.entries.setdefault((method, fp), {'calls': 0, 'time': 0., 'max_time': 0.,
+                                                           'rows': 0, 'bytes': 0})
+            entry['calls'] += 1
+            entry['time'] += latency
+            entry['max_time'] = max(entry['max_time'], latency)
+            entry['rows'] += nrows
+            entry['bytes'] += nbytes
+
+            self.counter += 1
+            item = (latency, self.counter, method, scomm, args)
+            if len(self.slowest) < self.nslowest:
+                heapq.heappush(self.slowest, item)
+            elif latency > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, item)
+
+            if (self.slow_threshold is not None) and (latency >= self.slow_threshold) and \
+               (self.slow_log_path is not None):
+                with open(self.slow_log_path, 'a') as f:
+                    f.write(json.dumps({'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                                        'method': method,
+                                        'latency': latency,
+                                        'rows': nrows,
+                                        'bytes': nbytes,
+                                        'query': ' '.join(scomm.split()),
+                                        'args': None if args is None else [str(a) for a in args][:100]})
+                            + '\n')
+
+    def summary(self):
+        """Returning the aggregated records sorted by their total time
+        """
+        with self.lock:
+            res = [dict(method=method, fingerprint=fp, **entry)
+                   for (method, fp), entry in self.entries.items()]
+        for r in res:
+            r['mean_time'] = r['time']/r['calls']
+        return sorted(res, key=lambda r: -r['time'])
+
+    def slowest_statements(self):
+        """Returning the slowest statements as (latency, method, query, args),
+        from the slowest one
+        """
+        with self.lock:
+            return [(x[0], x[2], x[3], x[4]) for x in sorted(self.slowest, reverse=True)]
+
+    def report(self, top=20, explains=None):
+        """Making a text report of the `top` most time-consuming (method,
+        fingerprint) pairs and, if given, the execution plans of the slowest
+        statements (list of (latency, method, query, plan))
+        """
+        summary = self.summary()
+        total = np.sum([r['time'] for r in summary])
+        lines = ['{} queries, {:.3f} s in total'.format(np.sum([r['calls'] for r in summary]), total),
+                 '{:>8} {:>10} {:>10} {:>10} {:>12} {:>14}  {}'.format(
+                     'calls', 'time (s)', 'mean (s)', 'max (s)', 'rows', 'bytes', 'method: query')]
+        for r in summary[:top]:
+            lines += ['{:>8} {:>10.3f} {:>10.4f} {:>10.4f} {:>12} {:>14}  {}: {}'.format(
+                r['calls'], r['time'], r['mean_time'], r['max_time'], r['rows'], r['bytes'],
+                r['method'], r['fingerprint'][:200])]
+        if explains is not None:
+            lines += ['', 'Execution plans of the slowest statements:']
+            for latency, method, scomm, plan in explains:
+                lines += ['{:.4f} s, {}: {}'.format(latency, method, ' '.join(scomm.split())[:200])]
+                lines += ['    {}'.format(row) for row in plan]
+
+        return '\n'.join(lines)
+
+
+class ProfiledCursor(object):
+    """Wrapper of a cursor that records its executions into a `QueryStats`
+    object; the time of an execution includes fetching its results
+    """
+
+    def __init__(self, crsr, stats, method='crsr'):
+        self.crsr = crsr
+        self.stats = stats
+        self.method = method
+        self.last = None
+
+    def execute(self, scomm, args=None):
+        self.finish()
+        t0 = time.time()
+        res = self.crsr.execute(scomm, args)
+        self.last = [scomm, args, time.time()-t0, 0, 0]
+        return res
+
+    def executemany(self, scomm, rows):
+        """Executing a statement over a list of rows; it is recorded as one
+        execution (with the first row as its arguments), counting the given
+        rows and their bytes
+        """
+        self.finish()
+        rows = list(rows)
+        t0 = time.time()
+        res = self.crsr.executemany(scomm, rows)
+        self.stats.record(self.method, scomm, rows[0] if len(rows)>0 else None,
+                          time.time()-t0, len(rows), rows_nbytes(rows))
+        return res
+
+    def finish(self):
+        if self.last is not None:
+            self.stats.record(self.method, *self.last)
+            self.last = None
+
+    def fetched(self, rows, t0):
+        if self.last is not None:
+            self.last[2] += time.time()-t0
+            self.last[3] += len(rows)
+            self.last[4] += rows_nbytes(rows)
+        return rows
+
+    def fetchall(self):
+        t0 = time.time()
+        rows = self.fetched(self.crsr.fetchall(), t0)
+        self.finish()
+        return rows
+
+    def fetchmany(self, size):
+        t0 = time.time()
+        return self.fetched(self.crsr.fetchmany(size), t0)
+
+    def fetchone(self):
+        t0 = time.time()
+        row = self.crsr.fetchone()
+        self.fetched([] if row is None else [row], t0)
+        return row
+
+    def close(self):
+        self.finish()
+        self.crsr.close()
+
+    def __getattr__(self, name):
+        return getattr(self.crsr, name)
@@ -1,6 +1,8 @@
 import os
 import re
 import sys
+import json
+import pickle
 import pdb
 import numpy as np
 import pandas as pd
@@ -13,12 +15,106 @@ path = '/home/jamshid/codes/social-knowledge-analysis'
 sys.path.insert(0, path)
 
 from misc import helpers
+from data.cache import MemoCache
+from data.retrieval import Retriever, RetrievalError
 
-from pybliometrics.scopus import AbstractRetrieval
 from pybliometrics.scopus.exception import Scopus429Error
 from mat2vec.processing.process import MaterialsTextProcessor
 
+# brackets around numbers that keep them from being replaced (e.g. "(111)")
+NUMBER_BRACKETS = ['(', ')', '〈', '〉']
+
 class MatTextProcessor(MaterialsTextProcessor):
+    """Text processor of mat2vec with memoized formula checks/normalizations
+    and token processing
+
+    Results of `is_simple_formula`, `normalized_formula` and processing of
+    single tokens are kept in bounded LRU memos (`memo_size` entries each, see
+    `data.cache.MemoCache`), optionally loaded from/saved into `memo_path`
+    (see `save_memos`). Processing of a token does not depend on the other
+    tokens of the sentence, except for numbers next to brackets, in which
+    case the sentence is processed without the memo; hence the memoized
+    results are the same as the original ones (which can be checked on
+    sample texts by `check_memos`). `memo_stats` reports the hit rates of
+    the memos.
+    """
+
+    def __init__(self, *args, **kwargs):
+        memo_size = kwargs.pop('memo_size', 2**20)
+        memo_path = kwargs.pop('memo_path', None)
+        super(MatTextProcessor, self).__init__(*args, **kwargs)
+
+        self.memos = {name: MemoCache(memo_size) for name in
+                      ['is_simple_formula', 'normalized_formula', 'process']}
+        if (memo_path is not None) and os.path.exists(memo_path):
+            self.load_memos(memo_path)
+
+    def is_simple_formula(self, text):
+        return self.memos['is_simple_formula'].get(
+            text, lambda: MaterialsTextProcessor.is_simple_formula(self, text))
+
+    def normalized_formula(self, formula, *args, **kwargs):
+        key = (formula, args, tuple(sorted(kwargs.items())))
+        return self.memos['normalized_formula'].get(
+            key, lambda: MaterialsTextProcessor.normalized_formula(self, formula, *args, **kwargs))
+
+    def process_token(self, tok, flags):
+        """Processing a single token (memoized); returns the processed
+        pieces, the detected materials and whether it is a number
+        """
+        def func():
+            pieces, mats = MaterialsTextProcessor.process(self, [tok], make_phrases=False, **flags)
+            return tuple(pieces), tuple(mats), flags['convert_num'] and self.is_number(tok)
+        return self.memos['process'].get((tok,) + tuple(flags.values()), func)
+
+    def process(self, tmp, exclude_punct=False, convert_num=True, normalize_materials=True,
+                remove_accents=True, make_phrases=False, split_oxidation=True):
+        if not isinstance(tmp, list):
+            tmp = self.tokenize(tmp, keep_sentences=False, split_oxidation=split_oxidation)
+
+        flags = dict(exclude_punct=exclude_punct, convert_num=convert_num,
+                     normalize_materials=normalize_materials, remove_accents=remove_accents,
+                     split_oxidation=split_oxidation)
+        res = [self.process_token(tok, flags) for tok in tmp]
+        for i, (_, _, is_num) in enumerate(res):
+            if is_num and ((i>0 and tmp[i-1] in NUMBER_BRACKETS) or
+                           (i+1<len(tmp) and tmp[i+1] in NUMBER_BRACKETS)):
+                return MaterialsTextProcessor.process(self, tmp, make_phrases=make_phrases, **flags)
+
+        processed = [piece for pieces, _, _ in res for piece in pieces]
+        mat_list = [mat for _, mats, _ in res for mat in mats]
+        if make_phrases:
+            processed = self.make_phrases(processed, reps=2)
+
+        return processed, mat_list
+
+    def check_memos(self, texts, **kwargs):
+        """Checking that the memoized processing of a set of texts (e.g.
+        sample abstracts) gives the same results as the original processor,
+        with both values of `split_oxidation`; returns the (text, flag) pairs
+        with different results
+        """
+        mismatches = []
+        for text in texts:
+            for split_oxidation in [True, False]:
+                flags = dict(kwargs, split_oxidation=split_oxidation)
+                if self.process(text, **flags) != MaterialsTextProcessor.process(self, text, **flags):
+                    mismatches += [(text, split_oxidation)]
+        return mismatches
+
+    def save_memos(self, memo_path):
+        with open(memo_path + '.tmp', 'wb') as f:
+            pickle.dump({name: memo.dump() for name, memo in self.memos.items()}, f)
+        os.replace(memo_path + '.tmp', memo_path)
+
+    def load_memos(self, memo_path):
+        with open(memo_path, 'rb') as f:
+            entries = pickle.load(f)
+        for name, memo in self.memos.items():
+            memo.restore(entries.get(name, []))
+
+    def memo_stats(self):
+        return {name: memo.summary() for name, memo in self.memos.items()}
 
     def mat_preprocess(self, text):
         """Pre-processing a given text using tools provided by 
@@ -32,7 +128,7 @@ class MatTextProcessor(MaterialsTextProcessor):
 
         return ptokens   
 
-    def make_training_file(self, dois, save_dir):
+    def make_training_file(self, dois, save_dir, retriever=None):
         """Downloading, pre-processsing and storing abstracts of a set
         of DOIs in a text file which can be later used as the training data
         for tuning models like word2vec
@@ -43,6 +139,13 @@ class MatTextProcessor(MaterialsTextProcessor):
         ** Parameters:
             * dois : *(list)* list of DOIs
             * saved_dir : *(str)* directory to save the files
+            * retriever : *(data.retrieval.Retriever)* retriever of the 
+              documents (default: sequential, without cache)
+
+        DOIs that cannot be retrieved or processed are written into the
+        misses file. Once the Scopus quota is exhausted (`Scopus429Error`),
+        the rest of the DOIs (which would all fail) are written into the 
+        misses file too and the function returns.
         """
 
         # list of lists (each list = one line = title + abstract)
@@ -50,9 +153,20 @@ class MatTextProcessor(MaterialsTextProcessor):
         save_path_dois = os.path.join(save_dir, 'saved_DOIs')
         save_path_misses = os.path.join(save_dir, 'missed_DIOs')
         missed_dois = []
-        for doi in dois:
+        if retriever is None:
+            retriever = Retriever()
+        docs = retriever.map(dois)
+        for j in range(len(dois)):
             try:
-                r = AbstractRetrieval(doi)
+                doi, r = next(docs)
+            except Scopus429Error:
+                print('Scopus resource exhausted. Check your quota.')
+                with open(save_path_misses, 'a+', encoding='utf-8') as f:
+                    f.write(''.join([doi+'\n' for doi in dois[j:]]))
+                return
+            try:
+                if isinstance(r, RetrievalError):
+                    raise r
                 tokens = self.mat_preprocess(r.title) + self.mat_preprocess(r.description)
             except:
                 #pdb.set_trace()
@@ -72,61 +186,135 @@ class MatTextProcessor(MaterialsTextProcessor):
             with open(save_path_dois, 'a+') as f:
                 f.write(doi_line)
 
-def Scopus_to_SQLtable(dois,
-                       sql_db, 
-                       sql_cursor, 
-                       bad_dois_save_path=None):
+def load_scopus_keys(sql_cursor):
+    """Loading the next primary keys of the paper, author and affiliation
+    tables, along with dictionaries that map Scopus IDs of the existing
+    authors and affiliations to their primary keys, set of the existing
+    DOIs and set of the existing (author, affiliation) pairs
 
-    # get the last primary paper/author IDs
-    sql_cursor.execute('SELECT paper_id FROM paper;')
-    all_paper_PKs = sql_cursor.fetchall()
-    if len(all_paper_PKs)==0:
-        paper_PK = 0
-    else:
-        paper_PK = max([a[0] for a in all_paper_PKs]) + 1
+    Scopus IDs are kept as strings (keys of the dictionaries).
+    """
 
-    sql_cursor.execute('SELECT author_id FROM author;')
-    all_author_PKs = sql_cursor.fetchall()
-    if len(all_author_PKs)==0:
-        author_PK = 0
-    else:
-        author_PK = max([a[0] for a in all_author_PKs]) + 1
+    keys = {}
+    for name, scomm in [('paper_PK', 'SELECT MAX(paper_id) FROM paper;'),
+                        ('author_PK', 'SELECT MAX(author_id) FROM author;'),
+                        ('aff_PK', 'SELECT MAX(aff_id) FROM affiliation;')]:
+        sql_cursor.execute(scomm)
+        max_PK = sql_cursor.fetchall()[0][0]
+        keys[name] = 0 if max_PK is None else max_PK + 1
+
+    sql_cursor.execute('SELECT doi FROM paper;')
+    keys['dois'] = set([a[0] for a in sql_cursor.fetchall()])
+    sql_cursor.execute('SELECT author_scopus_ID, author_id FROM author;')
+    keys['authors'] = {str(a[0]): a[1] for a in sql_cursor.fetchall()}
+    sql_cursor.execute('SELECT aff_scopus_ID, aff_id FROM affiliation;')
+    keys['affs'] = {str(a[0]): a[1] for a in sql_cursor.fetchall()}
+    # (author, affiliation)'s can be repeatitive too
+    sql_cursor.execute('SELECT * FROM author_affiliation_mapping;')
+    keys['pairs'] = set([tuple(a) for a in sql_cursor.fetchall()])
+
+    return keys
+
+
+# buffered rows of each table, in the order of insertion
+INSERT_COMMANDS = [('paper', 'INSERT INTO paper (paper_id, doi, date, title, abstract) \
+                              VALUES (%s, %s, %s, %s, %s);'),
+                   ('author', 'INSERT INTO author VALUES (%s, %s, %s, %s);'),
+                   ('affiliation', 'INSERT INTO affiliation VALUES (%s, %s, %s, %s, %s);'),
+                   ('paper_author_mapping', 'INSERT INTO paper_author_mapping VALUES (%s, %s);'),
+                   ('author_affiliation_mapping', 'INSERT INTO author_affiliation_mapping \
+                                                   VALUES (%s, %s);')]
+
+def empty_rows():
+    return {table: [] for table, _ in INSERT_COMMANDS}
+
+
+def flush_rows(sql_db, sql_cursor, rows):
+    """Writing the buffered rows into their tables (by `executemany`),
+    committing them and emptying the buffers
+    """
+    for table, scomm in INSERT_COMMANDS:
+        if len(rows[table])>0:
+            sql_cursor.executemany(scomm, rows[table])
+            rows[table] = []
+    sql_db.commit()
+
+
+def add_author_affiliations(r, i, author_PK, keys, rows):
+    """Buffering affiliations of the i-th author of a retrieved document
+    (and the new (author, affiliation) pairs); returns the added pairs
+    """
+
+    if r.authors[i].affiliation is None:
+        return []
+    paper_affs = {str(x.id): x for x in r.affiliation} if r.affiliation is not None else {}
+
+    added = []
+    for aff_scps_id in np.unique(r.authors[i].affiliation):
+        this_aff_PK = keys['affs'].get(str(aff_scps_id), None)
+        if this_aff_PK is None:
+            aff = paper_affs.get(str(aff_scps_id), None)
+            if aff is not None:
+                aff_name, aff_city, aff_country = aff.name, aff.city, aff.country
+            else:
+                aff_name, aff_city, aff_country = 'NA', 'NA', 'NA'
+            this_aff_PK = keys['aff_PK']
+            rows['affiliation'] += [(this_aff_PK, aff_scps_id, aff_name, aff_city, aff_country)]
+            keys['affs'][str(aff_scps_id)] = this_aff_PK
+            keys['aff_PK'] += 1
 
-    sql_cursor.execute('SELECT aff_id FROM affiliation;')
-    all_aff_PKs = sql_cursor.fetchall()
-    if len(all_aff_PKs)==0:
-        aff_PK = 0
-    else:
-        aff_PK = max([a[0] for a in all_aff_PKs]) + 1
+        # add the pair only if the author/aff. have not already
+        # been added to the mapping table
+        if (author_PK, this_aff_PK) not in keys['pairs']:
+            rows['author_affiliation_mapping'] += [(author_PK, this_aff_PK)]
+            keys['pairs'].add((author_PK, this_aff_PK))
+            added += [(author_PK, this_aff_PK)]
 
+    return added
 
 
-    # all previously entered paper DOIs to avoid repetition
-    sql_cursor.execute('SELECT doi FROM paper;')
-    all_dois = sql_cursor.fetchall()
-    all_dois = [a[0] for a in all_dois]
-    # ... same for authors
-    sql_cursor.execute('SELECT author_scopus_ID FROM author;')
-    curr_scopus_id_list = [a[0] for a in sql_cursor.fetchall()]
-    sql_cursor.execute('SELECT aff_scopus_ID FROM affiliation;')
-    # ... same for affiliations
-    curr_aff_scopus_id_list = [a[0] for a in sql_cursor.fetchall()]
-    # ... even same for (author, affiliation)'s, since they can be repeatitive
-    sql_cursor.execute('SELECT * FROM author_affiliation_mapping;')
-    curr_author_aff_pairs = list(sql_cursor.fetchall())
+def Scopus_to_SQLtable(dois,
+                       sql_db, 
+                       sql_cursor, 
+                       bad_dois_save_path=None,
+                       batch_size=1000,
+                       retriever=None):
+    """Retrieving documents of a list of DOIs from Scopus and inserting
+    them (papers, authors, affiliations and their mappings) into the database
+
+    Existing DOIs, authors, affiliations and (author, affiliation) pairs are
+    looked up in hashed dictionaries/sets that are loaded once. New rows are
+    buffered and written by `executemany` and committed every `batch_size` 
+    documents. Documents are downloaded by `retriever` (default: sequential,
+    without cache; see `data.retrieval.Retriever`).
+    """
+
+    keys = load_scopus_keys(sql_cursor)
+    rows = empty_rows()
+    if retriever is None:
+        retriever = Retriever()
+
+    new_dois = []
+    for doi in dois:
+        if doi in keys['dois']:
+            print('{} has been already entered to the database'.format(doi))
+        else:
+            new_dois += [doi]
+            keys['dois'].add(doi)
     
     bad_dois = []
-    for i,doi in enumerate(dois):
-        if doi in all_dois:
-            print('{} has been already entered to the database'.format(doi))
-            continue
+    docs = retriever.map(new_dois)
+    for j in range(len(new_dois)):
+        if j>0 and not(j%batch_size):
+            flush_rows(sql_db, sql_cursor, rows)
 
         try:
-            r = AbstractRetrieval(doi)
+            doi, r = next(docs)
         except Scopus429Error:
             print('Scopus resource exhausted. Check your quota.')
+            flush_rows(sql_db, sql_cursor, rows)
             return
-        except:
+        if isinstance(r, RetrievalError):
             bad_dois += [doi]
             if bad_dois_save_path is not None:
                 with open(bad_dois_save_path, 'a+') as bad_f:
@@ -150,334 +338,268 @@ def Scopus_to_SQLtable(dois,
                               '-duration α, among others',abst)
         else:
             abst = 'NA'
-            
-        scomm = """INSERT INTO paper VALUES({},"{}","{}","{}","{}");""".format(
-            paper_PK,
-            r.doi,
-            r.coverDate,
-            title,
-            abst)
-        # taking care of unicode characters
-        #scomm = "{}".format(scomm.encode('utf-8'))
-        #scomm = scomm[2:-1].replace('\\', '\\\\')
-
-        sql_cursor.execute(scomm)
 
+        paper_PK = keys['paper_PK']
+        rows['paper'] += [(paper_PK, r.doi, r.coverDate, title, abst)]
+        keys['paper_PK'] += 1
 
         # ROW IN AUTHOR TABLE
         # skip the rest if no auhotrs were available
         if r.authors is None:
-            paper_PK += 1
             continue
-        paper_scopus_id_list = [a.auid for a in r.authors]
-        for i,scps_id in enumerate(paper_scopus_id_list):
+        paper_scopus_ids = set()
+        for i,a in enumerate(r.authors):
+            scps_id = str(a.auid)
             # if repetitive author, ignore:
-            if scps_id in paper_scopus_id_list[:i]:
+            if scps_id in paper_scopus_ids:
                 continue
+            paper_scopus_ids.add(scps_id)
             
-            if scps_id in curr_scopus_id_list:
-                # extract existing author PK from scopus ID
-                sql_cursor.execute('SELECT author_id \
-                                    FROM author \
-                                    WHERE author_scopus_ID = {}'.format(scps_id))
-                this_author_PK = sql_cursor.fetchall()[0][0]
-                sql_cursor.execute('INSERT INTO paper_author_mapping VALUES({}, {})'.format(
-                    paper_PK, this_author_PK))
-            else:
+            this_author_PK = keys['authors'].get(scps_id, None)
+            if this_author_PK is None:
                 # create a row for this new author
-                au_given_name = r.authors[i].given_name.replace('\"','') if \
-                    r.authors[i].given_name is not None else r.authors[i].given_name
-                au_surname = r.authors[i].surname.replace('\"','') if \
-                    r.authors[i].surname is not None else r.authors[i].surname
-                
-                sql_cursor.execute('INSERT INTO author \
-                                    VALUES({}, "{}", "{}", "{}")'.format(
-                                        author_PK,
-                                        scps_id,
-                                        au_given_name,
-                                        au_surname)
-                )
-                sql_cursor.execute('INSERT INTO paper_author_mapping \
-                                    VALUES({}, {})'.format(
-                                        paper_PK, author_PK))
-                
-                # update the global authors scopus ID list
-                curr_scopus_id_list += [scps_id]
-                this_author_PK = author_PK  #this will be used in affiliation table
-                author_PK += 1
+                au_given_name = a.given_name.replace('\"','') if \
+                    a.given_name is not None else a.given_name
+                au_surname = a.surname.replace('\"','') if \
+                    a.surname is not None else a.surname
+                this_author_PK = keys['author_PK']
+                rows['author'] += [(this_author_PK, a.auid, str(au_given_name), str(au_surname))]
+                keys['authors'][scps_id] = this_author_PK
+                keys['author_PK'] += 1
+            rows['paper_author_mapping'] += [(paper_PK, this_author_PK)]
                 
             # adding affiliations
-            # ---------------------
-            # handling None affiliations
-            if r.authors[i].affiliation is not None:
-                author_aff_scopus_id_list = np.unique(r.authors[i].affiliation)
-            else:
-                author_aff_scopus_id_list = []
-            for aff_scps_id in author_aff_scopus_id_list:
-                if aff_scps_id in curr_aff_scopus_id_list:
-                    sql_cursor.execute('SELECT aff_id \
-                    FROM affiliation \
-                    WHERE aff_scopus_ID = {}'.format(aff_scps_id))
-                    this_aff_PK = sql_cursor.fetchall()[0][0]
-
-                    # add the pair only if the author/aff. have not already
-                    # been added to the mapping table
-                    if (this_author_PK, this_aff_PK) not in curr_author_aff_pairs:
-                        sql_cursor.execute('INSERT INTO author_affiliation_mapping \
-                                            VALUES({}, {})'.format(this_author_PK,
-                                                                   this_aff_PK))
-                        curr_author_aff_pairs += [(this_author_PK, this_aff_PK)]
-                else:
-                    lcn = np.where([x.id==aff_scps_id for x in r.affiliation])[0]
-                    if len(lcn)>0:
-                        lcn = lcn[0]
-                        aff_name = r.affiliation[lcn].name.replace('"','\\"')
-                        aff_city = r.affiliation[lcn].city
-                        aff_country = r.affiliation[lcn].country
-                    else:
-                        aff_name = 'NA'
-                        aff_city = 'NA'
-                        aff_country = 'NA'
-
-                    sql_cursor.execute('INSERT INTO affiliation \
-                                        VALUES({},"{}","{}","{}","{}");'.format(
-                                            aff_PK,
-                                            aff_scps_id,
-                                            aff_name,
-                                            aff_city,
-                                            aff_country)
-                    )
-                    sql_cursor.execute('INSERT INTO author_affiliation_mapping \
-                                        VALUES({}, {})'.format(this_author_PK, aff_PK))
-                    curr_author_aff_pairs += [(this_author_PK, aff_PK)]
-                    # update the affliations list
-                    curr_aff_scopus_id_list += [aff_scps_id]
-                    aff_PK += 1
-
-        paper_PK += 1
-
-        sql_db.commit()
+            add_author_affiliations(r, i, this_author_PK, keys, rows)
+
+    flush_rows(sql_db, sql_cursor, rows)
 
     return bad_dois
 
     
-def complete_affiliations(paper_ids, sql_db, sql_cursor, logfile_path=None):
+def complete_affiliations(paper_ids,
+                          sql_db,
+                          sql_cursor,
+                          logfile_path=None,
+                          retriever=None,
+                          batch_size=1000,
+                          state_path=None):
+    """Adding the missing affiliations (and author-affiliation pairs) of
+    the authors of a set of papers, by re-retrieving their documents
+
+    Scopus IDs of the existing authors and affiliations, and the existing
+    pairs are looked up in dictionaries/sets that are loaded once. New rows
+    are written by `executemany` every `batch_size` documents, after which
+    the last processed paper ID is saved in the JSON file `state_path` (if
+    given); re-running with the same state file continues after that paper.
+    Documents are downloaded by `retriever`, hence they can be fanned out to
+    multiple workers (see `data.retrieval.Retriever`).
+    """
 
     logger = helpers.set_up_logger(__name__, logfile_path, False, file_mode='a')
-    
-    # initialize the affiliation primary key
-    sql_cursor.execute('SELECT aff_id FROM affiliation;')
-    all_aff_PKs = sql_cursor.fetchall()
-    if len(all_aff_PKs)==0:
-        aff_PK = 0
-    else:
-        aff_PK = max([a[0] for a in all_aff_PKs]) + 1
-        
-    sql_cursor.execute('SELECT aff_scopus_ID FROM affiliation;')
-    curr_aff_scopus_id_list = [a[0] for a in sql_cursor.fetchall()]
-    sql_cursor.execute('SELECT * FROM author_affiliation_mapping;')
-    curr_author_aff_pairs = list(sql_cursor.fetchall())
 
-    pids_array = ','.join([str(p) for p in paper_ids])
-    sql_cursor.execute('SELECT doi, paper_id FROM paper WHERE paper_id IN {};'.format(pids_array))
-    RES = sql_cursor.fetchall()
+    keys = load_scopus_keys(sql_cursor)
+    rows = empty_rows()
+    if retriever is None:
+        retriever = Retriever()
+
+    state = {'last_paper_id': None, 'missing_authors': 0}
+    if (state_path is not None) and os.path.exists(state_path):
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+        logger.info('Continuing after paper ID {}'.format(state['last_paper_id']))
+
+    def checkpoint(last_paper_id):
+        flush_rows(sql_db, sql_cursor, rows)
+        if last_paper_id is None:
+            return
+        state['last_paper_id'] = last_paper_id
+        if state_path is not None:
+            with open(state_path + '.tmp', 'w') as f:
+                json.dump(state, f)
+            os.replace(state_path + '.tmp', state_path)
+
+    paper_ids = list(paper_ids)
+    RES = []
+    for i in range(0, len(paper_ids), 10000):
+        chunk = paper_ids[i:i+10000]
+        sql_cursor.execute('SELECT doi, paper_id FROM paper WHERE paper_id IN ({});'.format(
+            ','.join(['%s']*len(chunk))), chunk)
+        RES += list(sql_cursor.fetchall())
+    RES = sorted(RES, key=lambda x: x[1])
+    if state['last_paper_id'] is not None:
+        RES = [a for a in RES if a[1]>state['last_paper_id']]
     dois = [a[0] for a in RES]
     paper_ids = [a[1] for a in RES]
 
-    dois_with_nonexisting_authors = []
-    for j,doi in enumerate(dois):
-        
+    docs = retriever.map(dois)
+    dois_with_nonexisting_authors = set()
+    last_paper_id = None
+    for j in range(len(dois)):
+        if j>0 and not(j%batch_size):
+            checkpoint(last_paper_id)
+
         try:
-            r = AbstractRetrieval(doi)
+            doi, r = next(docs)
         except Scopus429Error:
             print('Scopus resource exhausted. Check your quota.')
+            checkpoint(last_paper_id)
             return
-        except:
+        if isinstance(r, RetrievalError):
+            checkpoint(last_paper_id)
             raise ValueError('Could not download doi {}'.format(doi))
-        
+        last_paper_id = paper_ids[j]
+
         if r.authors is None:
             continue
-        
-        paper_scopus_id_list = [a.auid for a in r.authors]
-        for i,scps_id in enumerate(paper_scopus_id_list):
+
+        paper_scopus_ids = set()
+        for i,a in enumerate(r.authors):
+            scps_id = str(a.auid)
             # if repetitive author, ignore:
-            if scps_id in paper_scopus_id_list[:i]:
+            if scps_id in paper_scopus_ids:
                 continue
-
-            sql_cursor.execute('SELECT author_id \
-                                FROM author \
-                                WHERE author_scopus_ID = {}'.format(scps_id))
-            
-            this_author_PK = sql_cursor.fetchall()
-            if len(this_author_PK)==0:
-                if doi not in dois_with_nonexisting_authors:
-                    dois_with_nonexisting_authors += [doi]
-                logger.info('(CASE NUMBER {}) PAPER_ID {}, DOI {}: author with scopus ID {} does not exist.'.format(306+len(dois_with_nonexisting_authors), paper_ids[j], doi, scps_id))
+            paper_scopus_ids.add(scps_id)
+
+            this_author_PK = keys['authors'].get(scps_id, None)
+            if this_author_PK is None:
+                dois_with_nonexisting_authors.add(doi)
+                state['missing_authors'] += 1
+                logger.info('(CASE NUMBER {}) PAPER_ID {}, DOI {}: author with scopus ID {} does not exist.'.format(
+                    state['missing_authors'], paper_ids[j], doi, scps_id))
                 continue
-            else:
-                this_author_PK = this_author_PK[0][0]
-            
+
             # directly go to their affiliations
-            if r.authors[i].affiliation is not None:
-                author_aff_scopus_id_list = np.unique(r.authors[i].affiliation)
-            else:
-                author_aff_scopus_id_list = []
-                
-            for aff_scps_id in author_aff_scopus_id_list:
-                if aff_scps_id in curr_aff_scopus_id_list:
-                    sql_cursor.execute('SELECT aff_id \
-                    FROM affiliation \
-                    WHERE aff_scopus_ID = {}'.format(aff_scps_id))
-                    this_aff_PK = sql_cursor.fetchall()[0][0]
-
-                    # add the pair only if the author/aff. have not already
-                    # been added to the mapping table
-                    if (this_author_PK, this_aff_PK) not in curr_author_aff_pairs:
-                        sql_cursor.execute('INSERT INTO author_affiliation_mapping \
-                                            VALUES({}, {})'.format(this_author_PK,
-                                                                   this_aff_PK))
-                        curr_author_aff_pairs += [(this_author_PK, this_aff_PK)]
-                        logger.info('{} have been added to A2A.'.format((r.authors[i].given_name,
-                                                                         r.authors[i].surname,
-                                                                         this_aff_PK)))
-                else:
-                    lcn = np.where([x.id==aff_scps_id for x in r.affiliation])[0]
-                    if len(lcn)>0:
-                        lcn = lcn[0]
-                        aff_name = r.affiliation[lcn].name.replace('"','\\"')
-                        aff_city = r.affiliation[lcn].city
-                        aff_country = r.affiliation[lcn].country
-                    else:
-                        aff_name = 'NA'
-                        aff_city = 'NA'
-                        aff_country = 'NA'
-
-                    sql_cursor.execute('INSERT INTO affiliation \
-                                        VALUES({},"{}","{}","{}","{}");'.format(
-                                            aff_PK,
-                                            aff_scps_id,
-                                            aff_name,
-                                            aff_city,
-                                            aff_country)
-                    )
-                    sql_cursor.execute('INSERT INTO author_affiliation_mapping \
-                                        VALUES({}, {})'.format(this_author_PK, aff_PK))
-                    curr_author_aff_pairs += [(this_author_PK, aff_PK)]
-                    logger.info('{} have been added to A2A.'.format((r.authors[i].given_name,
-                                                                     r.authors[i].surname,
-                                                                     this_aff_PK)))
-
-                    # update the affliations list
-                    curr_aff_scopus_id_list += [aff_scps_id]
-                    aff_PK += 1
-
-        if not(j%1000):
-            np.savetxt('/home/jamshid/codes/data/iter_inds.txt', [j])
-        sql_db.commit()
-
-
-
-
-def correct_mats_from_WOS(msdb,wos_D,wos_T,wos_A,yr_susp_dois):
-
-    pr = MatTextProcessor()
-    
-    with open(yr_susp_dois,'r') as f:
-        susp_dois = f.read().splitlines()
+            for _, aff_PK in add_author_affiliations(r, i, this_author_PK, keys, rows):
+                logger.info('{} have been added to A2A.'.format((a.given_name, a.surname, aff_PK)))
 
-    missing_dois = []
-    for i in range(1,len(susp_dois)):
-        doi = susp_dois[i]
-        idx = np.where(wos_D==doi)
-        if len(idx)==0:
-            missing_dois += [doi]
-            continue
-        else:
-            idx = idx[0][0]
+    checkpoint(last_paper_id)
 
-        true_tt = wos_T[idx]
-        true_ab = wos_A[idx]
+    return sorted(dois_with_nonexisting_authors)
 
-        msdb.crsr.execute("SELECT title,abstract FROM paper WHERE doi='{}'".format(doi))
-        false_tt,false_ab = msdb.crsr.fetchone()
 
-        # replce mistaken chemicals in false_tt and false_ab by
-        # chemicals in true_tt and true_ab, respectively
-        false_tt_ccs = [_[0] for _ in pr.process(false_tt)[1]]
-        false_ab_ccs = [_[0] for _ in pr.process(false_ab)[1]]
-        true_tt_ccs  = [_[0] for _ in pr.process(true_tt)[1]]
-        true_ab_ccs  = [_[0] for _ in pr.process(true_ab)[1]]
+# text processor of the current (worker) process
+processor = None
 
-        # title
-        false_tt_tokens = sum(pr.tokenize(false_tt),[])
-        for cc in np.unique(true_tt_ccs):
-            if not(pr.is_simple_formula(cc)): continue
+def init_processor():
+    global processor
+    processor = MatTextProcessor()
 
-            # find the distorted forms of true chemical pattern in the tokens
-            distorted_forms = []
-            found_partial_matches = []
-            for tok in false_tt_tokens:
-                if not(pr.is_simple_formula(tok)): continue
-                if tok in cc:
-                    found_partial_matches += [tok]
-                else:
-                    # if the current token is not part of the pattern, but partial
-                    # found matches is not empty, reset it to empty set
-                    # consider scenario:
-                    # pattern: 'Zn3P2'
-                    # exp.:    'there are 3 properties for Zn and 2 for P'
-                    if len(found_partial_matches)>0:
-                        found_partial_matches = []
-
-                # if the partial matches become complete, AND
-                # the matches include broken parts, save the tokens
-                # as one of the detected distorted forms
-                if ''.join(found_partial_matches)==cc:
-                    if len(found_partial_matches)>1:
-                        distorted_forms += [' '.join(found_partial_matches)]
-
-            # replace the distorted forms, if any
-            for x in distorted_forms:
-                false_tt_tokens.replace(x,cc)
-                        
-            
-        # abstract
-        false_ab_tokens = sum(pr.tokenize(false_ab),[])
-        for cc in np.unique(true_ab_ccs):
-            if not(pr.is_simple_formula(cc)): continue
 
-            # find the distorted forms of true chemical pattern in the tokens
-            distorted_forms = []
+def find_distorted_forms(tokens, cc):
+    """Finding distorted forms of a chemical formula in a list of tokens, 
+    i.e. consecutive tokens (ignoring the irrelevant ones in between) whose
+    concatenation is the formula, e.g. "Zn 3 P 2" for "Zn3P2"
+    """
+
+    distorted_forms = []
+    found_partial_matches = []
+    for tok in tokens:
+        if not(processor.is_simple_formula(tok)) and (tok not in cc): continue
+        if tok in cc:
+            found_partial_matches += [tok]
+        else:
+            # if the current token is not part of the pattern, but partial
+            # found matches is not empty, reset it to empty set
+            # consider scenario:
+            # pattern: 'Zn3P2'
+            # exp.:    'there are 3 properties for Zn and 2 for P'
+            if len(found_partial_matches)>0:
+                found_partial_matches = []
+
+        # if the partial matches become complete, AND
+        # the matches include broken parts, save the tokens
+        # as one of the detected distorted forms
+        if ''.join(found_partial_matches)==cc:
+            if len(found_partial_matches)>1:
+                distorted_forms += [' '.join(found_partial_matches)]
+            # resetting partial m
             found_partial_matches = []
-            for tok in false_ab_tokens:
-                if not(pr.is_simple_formula(tok)) and (tok not in cc): continue
-                if tok in cc:
-                    found_partial_matches += [tok]
-                else:
-                    # if the current token is not part of the pattern, but partial
-                    # found matches is not empty, reset it to empty set
-                    # consider scenario:
-                    # pattern: 'Zn3P2'
-                    # exp.:    'there are 3 properties for Zn and 2 for P'
-                    if len(found_partial_matches)>0:
-                        found_partial_matches = []
-
-                # if the partial matches become complete, AND
-                # the matches include broken parts, save the tokens
-                # as one of the detected distorted forms
-                if ''.join(found_partial_matches)==cc:
-                    if len(found_partial_matches)>1:
-                        distorted_forms += [' '.join(found_partial_matches)]
-                    # resetting partial m
-                    found_partial_matches = []
-
-            pdb.set_trace()
-            # replace the distorted forms, if any
-            for x in np.unique(distorted_forms):
-                false_ab.replace(x,cc)
-
-        
-    return missing_dois
 
-            
-        
+    return distorted_forms
+
+
+def correct_text(false_text, true_text):
+    """Replacing distorted forms of the (simple) chemical formulas of the
+    true text in the false one
+    """
+    if (false_text is None) or (true_text is None):
+        return false_text
+
+    true_ccs = [_[0] for _ in processor.process(true_text)[1]]
+    false_tokens = sum(processor.tokenize(false_text),[])
+    for cc in np.unique(true_ccs):
+        if not(processor.is_simple_formula(cc)): continue
+        # replace the distorted forms, if any
+        for x in np.unique(find_distorted_forms(false_tokens, cc)):
+            false_text = false_text.replace(x,cc)
+
+    return false_text
+
+
+def correct_paper_batch(batch):
+    """Correcting titles and abstracts of a batch of papers, given as rows
+    of (ID, false title, false abstract, true title, true abstract), by the
+    processor of the current process (see `init_processor`); returns rows
+    of (corrected title, corrected abstract, ID) for the changed papers
+    """
+    updates = []
+    for pid, false_tt, false_ab, true_tt, true_ab in batch:
+        tt = correct_text(false_tt, true_tt)
+        ab = correct_text(false_ab, true_ab)
+        if (tt!=false_tt) or (ab!=false_ab):
+            updates += [(tt, ab, pid)]
+    return updates
+
+
+def correct_mats_from_WOS(msdb,wos_D,wos_T,wos_A,yr_susp_dois,**kwargs):
+    """Correcting distorted chemical formulas (e.g. "Zn 3 P 2" instead
+    of "Zn3P2") in titles and abstracts of papers with suspicious DOIs, by
+    comparing them with their titles and abstracts in WOS (`wos_D`, `wos_T`
+    and `wos_A` being the arrays of WOS DOIs, titles and abstracts)
+
+    WOS records are located through a DOI-->row dictionary that is built
+    once, and the papers are read in chunks of `chunk_size` DOIs. Batches of
+    papers are corrected by a pool of `nworkers` processes. The corrections
+    are returned as rows of (title, abstract, paper ID), along with the DOIs
+    that do not exist in WOS; with `update=True` they are also written into
+    the paper table in bulk.
+
+    *Keyword arguments:*
+
+    * chunk_size: number of DOIs per query/batch (default: 1000)
+    * nworkers: number of processes (default: 1)
+    * update: updating the paper table (default: False)
+    """
+
+    chunk_size = kwargs.get('chunk_size', 1000)
+    nworkers = kwargs.get('nworkers', 1)
+    update = kwargs.get('update', False)
+
+    with open(yr_susp_dois,'r') as f:
+        susp_dois = f.read().splitlines()
+
+    # the first occurrence of each DOI
+    wos_rows = {}
+    for i, doi in enumerate(wos_D):
+        wos_rows.setdefault(doi, i)
+
+    missing_dois = [doi for doi in susp_dois[1:] if doi not in wos_rows]
+    found_dois = list(dict.fromkeys([doi for doi in susp_dois[1:] if doi in wos_rows]))
+
+    def batches():
+        for i in range(0, len(found_dois), chunk_size):
+            chunk = found_dois[i:i+chunk_size]
+            rows = msdb.run_query('SELECT id, doi, title, abstract FROM paper \
+                                   WHERE doi IN ({});'.format(','.join(['%s']*len(chunk))), chunk)
+            yield [(pid, false_tt, false_ab, wos_T[wos_rows[doi]], wos_A[wos_rows[doi]])
+                   for pid, doi, false_tt, false_ab in rows]
+
+    updates = []
+    for _, batch_updates in helpers.ordered_pool_map(correct_paper_batch, batches(),
+                                                     nworkers, init_processor):
+        updates += batch_updates
+
+    if update:
+        msdb.execute_batch([('UPDATE paper SET title=%s, abstract=%s WHERE id=%s;', updates)])
+
+    return updates, missing_dois
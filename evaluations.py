@@ -2,9 +2,14 @@ import os
 import sys
 import pdb
 import json
+import types
+import pickle
+import hashlib
 import logging
+import functools
 import numpy as np
 from scipy import sparse
+from multiprocessing import get_context
 
 from gensim.models import Word2Vec
 from sklearn.metrics import roc_auc_score
@@ -44,13 +49,16 @@ def eval_predictor(predictor_func,
     match the actual discoveries returned by a given ground-truth function
 
     The evaluations are done for individual years strating from a given year 
-    of prediction to 2018.
+    of prediction to 2018. If the ground truth has already been computed
+    for these years (see `gt_by_year`), it can be given as `gt_dict` to skip
+    calling `gt_func`.
     """
 
     metric = kwargs.get('metric', 'cumul_precision')
     last_year = kwargs.get('last_year', 2019)
     save_path = kwargs.get('save_path', None)
     return_preds = kwargs.get('return_preds', False)
+    gt_dict = kwargs.get('gt_dict', None)
     logfile_path = kwargs.get('logfile_path', None)
     logger_disable = kwargs.get('logger_disable',False)
     logger = helpers.set_up_logger(__name__, logfile_path, logger_disable)
@@ -59,6 +67,7 @@ def eval_predictor(predictor_func,
     """ Generating the Prediction """
     preds = predictor_func(year_of_pred)
     logger.info('Number of actual predictions: {}'.format(len(preds)))
+    scores = None
     if metric=='auc':
         if len(preds)!=2:
             raise ValueError('When asking for AUC metric, predictor should return score array too.')
@@ -71,21 +80,9 @@ def eval_predictor(predictor_func,
     
     """ Evaluating the Predictions for the Upcoming Years """
     years_of_eval = np.arange(year_of_pred, last_year)
-    iter_list = []  # to be the prec. values or actul disc. (for AUC)   
-    for i, yr in enumerate(years_of_eval):
-        gt = gt_func(yr)
-
-        if metric=='cumul_precision':      # Cumulative Precision
-            iter_list += [np.sum(np.in1d(gt, preds)) / len(preds)]
-        elif metric=='auc':    # Area Under Curve
-            iter_list += gt.tolist()
-
-    if metric == 'cumul_precision':
-        res = np.cumsum(iter_list)
-    elif metric == 'auc':
-        y = np.zeros(len(preds))
-        y[np.isin(preds,iter_list)] = 1
-        res = roc_auc_score(y, scores)
+    if gt_dict is None:
+        gt_dict = {yr: gt_func(yr) for yr in years_of_eval}
+    res = metrics_from_preds(preds, scores, gt_dict, year_of_pred, last_year)[metric]
 
     if return_preds:
         return res, preds
@@ -93,6 +90,239 @@ def eval_predictor(predictor_func,
         return res
 
 
+def metrics_from_preds(preds, scores, gt_dict, year_of_pred, last_year=2019):
+    """Computing cumulative precision and AUC (if `scores` is given) of a
+    set of predictions against yearwise ground truth discoveries given in
+    form of a dictionary {year: array of discoveries}
+    """
+
+    pred_locs = {x:i for i,x in enumerate(preds)}
+    years_of_eval = np.arange(year_of_pred, last_year)
+    
+    # number of discoveries among the predictions in each year, and the
+    # indicator of the predictions that are discovered at some point
+    yr_hits = np.zeros(len(years_of_eval))
+    y = np.zeros(len(preds))
+    for i, yr in enumerate(years_of_eval):
+        locs = [pred_locs[x] for x in gt_dict[yr] if x in pred_locs]
+        yr_hits[i] = len(locs)
+        y[locs] = 1
+
+    res = {'cumul_precision': np.cumsum(yr_hits / len(preds))}
+    if scores is not None:
+        res['auc'] = roc_auc_score(y, scores) if 0<np.sum(y)<len(y) else np.nan
+
+    return res
+
+
+def gt_by_year(gt_func, years, save_path=None):
+    """Computing ground truth discoveries of a set of years only once
+
+    If `save_path` is given, the results are pickled there and only the years
+    that are missing from the saved dictionary will be computed in the 
+    subsequent calls.
+    """
+
+    gt_dict = {}
+    if (save_path is not None) and os.path.exists(save_path):
+        with open(save_path, 'rb') as f:
+            gt_dict = pickle.load(f)
+
+    missing_yrs = [yr for yr in years if yr not in gt_dict]
+    for yr in missing_yrs:
+        gt_dict[yr] = np.asarray(gt_func(yr))
+
+    if (save_path is not None) and len(missing_yrs)>0:
+        with open(save_path, 'wb') as f:
+            pickle.dump(gt_dict, f)
+
+    return gt_dict
+
+
+# predictors that are evaluated by the workers of `eval_predictors_grid`; local
+# predictor functions cannot be pickled, so they are shared with the (forked)
+# workers through this module-level variable
+GRID_PREDICTORS = {}
+
+def predict_grid_cell(key):
+    """Running the predictor of a given (name, year_of_pred) key
+    """
+
+    name, year_of_pred = key
+    preds = GRID_PREDICTORS[name](year_of_pred)
+    if isinstance(preds, tuple) and len(preds)==2:
+        return np.asarray(preds[0]), np.asarray(preds[1])
+    else:
+        return np.asarray(preds), None
+
+
+def update_params_hash(h, obj, visited=None):
+    """Feeding a (nested) predictor parameter into a hash object; arrays are
+    hashed by their contents, partial functions by their function and bound
+    arguments and plain functions by their code, defaults and closure
+
+    Objects that are already visited (e.g. a recursive inner function in its
+    own closure) are hashed by their order of visit; `visited` maps their
+    `id`s to (order, object), keeping them alive such that the `id`s are not
+    reused.
+    """
+
+    if visited is None:
+        visited = {}
+    # only the (mutable) objects that can refer to themselves are tracked
+    if isinstance(obj, (functools.partial, dict, list)) or hasattr(obj, '__code__'):
+        if id(obj) in visited:
+            h.update('visited{}'.format(visited[id(obj)][0]).encode('utf-8'))
+            return
+        visited[id(obj)] = (len(visited), obj)
+    update = lambda x: update_params_hash(h, x, visited)
+
+    if isinstance(obj, functools.partial):
+        h.update(b'partial')
+        for x in [obj.func, obj.args, obj.keywords]:
+            update(x)
+    elif isinstance(obj, types.CodeType):
+        h.update(obj.co_code)
+        update(obj.co_consts)
+        update(obj.co_names)
+    elif hasattr(obj, '__code__'):
+        h.update('{}.{}'.format(obj.__module__, obj.__qualname__).encode('utf-8'))
+        for x in [obj.__code__, obj.__defaults__, obj.__kwdefaults__]:
+            update(x)
+        for cell in (obj.__closure__ or []):
+            update(cell.cell_contents)
+    elif sparse.issparse(obj):
+        obj = obj.tocsr()
+        h.update('sparse{}'.format(obj.shape).encode('utf-8'))
+        for x in [obj.data, obj.indices, obj.indptr]:
+            update(x)
+    elif isinstance(obj, np.ndarray) and obj.dtype!=object:
+        h.update('{}{}'.format(obj.dtype, obj.shape).encode('utf-8'))
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, dict):
+        h.update(b'dict')
+        for key in sorted(obj, key=repr):
+            update(key)
+            update(obj[key])
+    elif isinstance(obj, (list, tuple, np.ndarray)):
+        h.update('{}{}'.format(type(obj).__name__, len(obj)).encode('utf-8'))
+        for x in obj:
+            update(x)
+    else:
+        h.update(repr(obj).encode('utf-8'))
+
+
+def predictor_params_hash(func, params=None):
+    """Hash of a predictor function and its parameters (see
+    `update_params_hash`), together with the optional user-given `params`
+
+    Objects without a content-based representation (e.g. models) are hashed
+    by their default `repr`, which changes between sessions; such parameters
+    should rather be described by `params`.
+    """
+
+    h = hashlib.sha1()
+    update_params_hash(h, func)
+    update_params_hash(h, params)
+    return h.hexdigest()
+
+
+def eval_predictors_grid(predictors,
+                         gt_func_or_dict,
+                         years_of_pred,
+                         **kwargs):
+    """Evaluating a set of predictors over a set of years of prediction
+
+    The predictors should be given as a dictionary {name: predictor_func}. 
+    Ground truth discoveries are computed once for all the years (if a ground 
+    truth function is given rather than a pre-computed dictionary). The 
+    (predictor, year_of_pred) grid is run on a pool of `nworkers` processes
+    and the predictions are stored in `cache_dir`, if given, such that they 
+    will not be re-generated in the subsequent calls. Both cumulative precision
+    and AUC (for predictors that return scores too) are computed from the 
+    same predictions.
+
+    Cached predictions are keyed by the predictor name, the year of prediction
+    and a hash of the predictor function and its parameters (see
+    `predictor_params_hash`), which is also stored in the cache file and 
+    checked on loading. Parameters that are not visible from the function
+    (e.g. global variables or the content of the data base) can be given by
+    `cache_params` as a dictionary {name: params}.
+
+    NOTE: the workers are forked from the current process (regardless of the
+    default start method of the platform, hence `nworkers` cannot be used
+    where forking is not available), thus the predictor functions should not
+    use a database connection when they are called.
+
+    *Returns:*
+
+    * a dictionary {(name, year_of_pred): {metric: value}}
+    """
+
+    last_year = kwargs.get('last_year', 2019)
+    nworkers = kwargs.get('nworkers', None)
+    cache_dir = kwargs.get('cache_dir', None)
+    cache_params = kwargs.get('cache_params', {})
+    gt_save_path = kwargs.get('gt_save_path', None)
+    logfile_path = kwargs.get('logfile_path', None)
+    logger_disable = kwargs.get('logger_disable',False)
+    logger = helpers.set_up_logger(__name__, logfile_path, logger_disable)
+
+    if isinstance(gt_func_or_dict, dict):
+        gt_dict = gt_func_or_dict
+    else:
+        gt_dict = gt_by_year(gt_func_or_dict,
+                             np.arange(np.min(years_of_pred), last_year),
+                             gt_save_path)
+
+    keys = [(name, yr) for name in predictors for yr in years_of_pred]
+    params_hash = {name: predictor_params_hash(func, cache_params.get(name, None))
+                   for name, func in predictors.items()}
+    cache_path = lambda key: os.path.join(cache_dir, '{}_{}_{}.npz'.format(
+        key[0], key[1], params_hash[key[0]][:12]))
+
+    # loading the cached predictions (only if they are generated by the same parameters)
+    preds_dict = {}
+    for key in keys:
+        if (cache_dir is not None) and os.path.exists(cache_path(key)):
+            with np.load(cache_path(key)) as npz:
+                if ('params_hash' in npz) and (str(npz['params_hash'])==params_hash[key[0]]):
+                    preds_dict[key] = (npz['preds'], npz['scores'] if 'scores' in npz else None)
+    todo_keys = [key for key in keys if key not in preds_dict]
+    logger.info('{} predictions are loaded from cache, {} to be generated.'.format(
+        len(preds_dict), len(todo_keys)))
+
+    GRID_PREDICTORS.clear()
+    GRID_PREDICTORS.update(predictors)
+    if nworkers is None:
+        grid_res = map(predict_grid_cell, todo_keys)
+        pool = None
+    else:
+        # the workers should be forked to inherit the predictors (see above)
+        pool = get_context('fork').Pool(nworkers)
+        grid_res = pool.imap(predict_grid_cell, todo_keys)
+
+    try:
+        for key, (preds, scores) in zip(todo_keys, grid_res):
+            preds_dict[key] = (preds, scores)
+            if cache_dir is not None:
+                arrs = {'preds': preds, 'params_hash': params_hash[key[0]]}
+                if scores is not None:
+                    arrs['scores'] = scores
+                np.savez(cache_path(key), **arrs)
+            logger.info('Predictions of {} for {} are generated.'.format(*key))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return {key: metrics_from_preds(preds_dict[key][0],
+                                    preds_dict[key][1],
+                                    gt_dict,
+                                    key[1],
+                                    last_year) for key in keys}
+
+
 def eval_author_predictor(discoverers_predictor_func,
                           gt_discoverers_func,
                           year_of_pred,
@@ -133,9 +363,12 @@ def gt_discoverers(**kwargs):
         VMkw = sparse.load_npz(path_to_VMkw)
         R = sparse.hstack((VM, VMkw), 'csc')
 
+    # discoverers of all the years are extracted at once
+    yr_discoverers = hypergraphs.yearwise_discoverers(R,
+                                                      row_years=kwargs.get('row_years', []),
+                                                      author_ids=kwargs.get('author_ids', None))
+
     def gt_discoverers_func(year_of_pred):
-        if 'R' in kwargs: del kwargs['R']
-        auids = hypergraphs.year_discoverers(R,year_of_pred)
-        return auids
+        return yr_discoverers.get(year_of_pred, np.array([], dtype=int))
 
     return gt_discoverers_func
@@ -15,7 +15,8 @@ from gensim.models import Word2Vec
 path = '/home/jamshid/codes/social-knowledge-analysis'
 sys.path.insert(0, path)
 
-from data import readers
+from data import readers, columnar
+from data.keyword_index import KeywordIndex
 from misc import helpers
 
 config_path = '/home/jamshid/codes/data/sql_config_0.json'
@@ -146,6 +147,47 @@ def compute_vertex_KW_submatrix(db, los, **kwargs):
     return VM
 
 
+def compute_vertex_KW_submatrix_columnar(export_dir, los, **kwargs):
+    """Forming a submatrix corresponding to conceptual nodes given as a
+    set of keywords (`los`) for the records exported into columnar partitions
+    (see `data.extractors`), read directly from the files
+
+    Only the partitions of the given `years` (all, by default) are read and
+    only their numbers, titles and abstracts are loaded. Keywords are looked
+    up in an inverted index of the texts (see `data.keyword_index`); the rows
+    of the output matrix correspond to the returned record numbers.
+    """
+
+    case_sensitives = kwargs.get('case_sensitives', [])
+    years = kwargs.get('years', None)
+
+    index = KeywordIndex()
+    numbers, titles, abstracts = [], [], []
+    for year, part in columnar.iter_parts(export_dir, ['number', 'title', 'abstract'], years):
+        index.add_papers(part['number'], [year]*len(part['number']), part['title'], part['abstract'])
+        numbers += [part['number']]
+        titles += [part['title']]
+        abstracts += [part['abstract']]
+    index.merge_segments()
+    numbers = np.concatenate(numbers) if len(numbers)>0 else np.array([], dtype=np.int64)
+    titles = np.concatenate(titles) if len(titles)>0 else np.array([], dtype=object)
+    abstracts = np.concatenate(abstracts) if len(abstracts)>0 else np.array([], dtype=object)
+    sinds = np.argsort(numbers)
+
+    VM = sparse.lil_matrix((len(numbers),len(los)), dtype=np.uint8)
+    for i, kw in enumerate(los):
+        res, exact = index.search([kw], case_sensitives=case_sensitives)
+        rows = sinds[np.searchsorted(numbers[sinds], res)]
+        if not(exact):
+            # verifying the candidates against the texts
+            cs = kw in case_sensitives
+            has_kw = lambda x: (x is not None) and ((kw in x) if cs else (kw.lower() in x.lower()))
+            rows = np.array([r for r in rows if has_kw(titles[r]) or has_kw(abstracts[r])], dtype=int)
+        VM[rows, i*np.ones(len(rows), dtype=int)] = 1
+
+    return VM, numbers
+
+
 def find_neighbors(idx, R):
     """Returning neighbors of a node indexed by `idx`
 
@@ -191,12 +233,10 @@ def year_discoveries(R, year, **kwargs):
     return_papers = kwargs.get('return_papers', False)
 
     if len(chems)==0:
-        msdb.crsr.execute('SELECT formula FROM chemical;')
-        chems = np.array([x[0] for x in msdb.crsr.fetchall()])
+        chems = msdb.get_1d_query('SELECT formula FROM chemical;')
 
     if len(row_years)==0:
-        msdb.crsr.execute('SELECT YEAR(date) FROM paper;')
-        row_years = np.array([x[0] for x in msdb.crsr.fetchall()])
+        row_years = msdb.get_1d_query('SELECT YEAR(date) FROM paper;')
 
         
     nA = 1739453
@@ -233,12 +273,78 @@ def year_discoveries(R, year, **kwargs):
 
 def year_discoverers(R, year, **kwargs):
 
-    kwargs['return_papers'] = True
-    disc_ents, papers = year_discoveries(R, year, **kwargs)
-    paper_ids = np.concatenate([pids for _,pids in papers.items()])
-    discoverers = msdb.get_authors_by_paper_ids(paper_ids, cols=['author_id'])
+    kwargs['years'] = [year]
+    kwargs['return_papers'] = False
+    return yearwise_discoverers(R, **kwargs).get(year, np.array([], dtype=int))
+
+
+def yearwise_discoverers(R, **kwargs):
+    """Finding discoverers (authors of the papers in which an entity co-occurs
+    with at least one of the property-related keywords for the first time)
+    of all years in one pass over the vertex matrix
+
+    Discovery papers and their authors are directly extracted from the rows
+    of R, hence no further querying of the database is needed. Author columns
+    are mapped to their IDs through `author_ids` (IDs of the author columns
+    of R, in the same order as in `compute_vertex_matrix`; read from the
+    database if not given). If `years` is given, only the discoverers of
+    those years are extracted.
+
+    *Returns:*
+
+    * dictionary {year: array of (unique) author IDs}
+    * (if `return_papers=True`) dictionary {year: array of discovery papers}
+    """
+
+    row_years = kwargs.get('row_years', [])
+    return_papers = kwargs.get('return_papers', False)
+    years = kwargs.get('years', None)
+    author_ids = kwargs.get('author_ids', None)
+    nA = kwargs.get('nA', 1739453)
+    nC = kwargs.get('nC', 107466)
 
-    return np.concatenate([auids['author_id'] for _,auids in discoverers.items()])
+    if len(row_years)==0:
+        row_years = msdb.get_1d_query('SELECT YEAR(date) FROM paper;')
+    row_years = np.asarray(row_years)
+    if author_ids is None:
+        author_ids = msdb.get_1d_query('SELECT id FROM author;')
+    author_ids = np.asarray(author_ids)
+
+    R = R.tocsr()
+    
+    # papers (rows) that contain at least one keyword, and their entities;
+    # papers after the last requested year cannot affect the discoveries
+    KW_rows = np.where(np.asarray(R[:,nA+nC:].sum(axis=1))[:,0]>0)[0]
+    if years is not None:
+        KW_rows = KW_rows[row_years[KW_rows]<=np.max(years)]
+    CKW = R[KW_rows,nA:nA+nC].tocoo()
+    pair_rows = KW_rows[CKW.row]
+    pair_yrs = row_years[pair_rows]
+
+    # first year of co-occurrence for each entity; pairs that happen
+    # in that year are the discoveries
+    first_yrs = np.full(nC, np.iinfo(np.int64).max)
+    np.minimum.at(first_yrs, CKW.col, pair_yrs)
+    disc_rows = np.unique(pair_rows[pair_yrs==first_yrs[CKW.col]])
+    if years is not None:
+        disc_rows = disc_rows[np.isin(row_years[disc_rows], years)]
+    disc_yrs = row_years[disc_rows]
+
+    # authors of the discovery papers, grouped by year through a single sort
+    auth_coo = R[disc_rows,:nA].tocoo()
+    auth_yrs = disc_yrs[auth_coo.row]
+    sinds = np.argsort(auth_yrs, kind='stable')
+    yrs, starts = np.unique(auth_yrs[sinds], return_index=True)
+    yr_auths = np.split(auth_coo.col[sinds], starts[1:])
+    discoverers = {yr: author_ids[np.unique(auths)] for yr, auths in zip(yrs, yr_auths)}
+
+    if return_papers:
+        sinds = np.argsort(disc_yrs, kind='stable')
+        yrs, starts = np.unique(disc_yrs[sinds], return_index=True)
+        papers = dict(zip(yrs, np.split(disc_rows[sinds], starts[1:])))
+        return discoverers, papers
+    else:
+        return discoverers
     
      
 def restrict_rows_to_years(R, years):
@@ -253,10 +359,8 @@ def restrict_rows_to_years(R, years):
 
     """ Restricting R to Articles in the Specified Years """
     # choosing rows (articles) associated with the given years
-    yrs_arr = ','.join([str(x) for x in years])
-    msdb.crsr.execute('SELECT id FROM paper WHERE \
-                       YEAR(date) IN ({});'.format(yrs_arr))
-    yr_pids = np.array([x[0] for x in msdb.crsr.fetchall()])
+    years_str, args = msdb.years_constraint(years)
+    yr_pids = msdb.get_1d_query('SELECT P.id FROM paper P WHERE {};'.format(years_str), args)
     R = R[yr_pids,:]
     
     return R
@@ -290,8 +394,7 @@ def compute_multistep_transprob(P, source_inds, dest_inds, **kwargs):
 
     if interm_inds is None:
         # number of authors 
-        msdb.crsr.execute('SELECT COUNT(*) FROM author;')
-        nA = msdb.crsr.fetchone()[0]
+        nA = msdb.count_table_rows('author')
         interm_inds = np.arange(nA)
 
     source_subP = P[source_inds,:]
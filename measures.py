@@ -49,8 +49,7 @@ def cooccurrences(Y_terms, ents, **kwargs):
     a set of keywords (Y-terms) in  abstracts of the database
     """
 
-    msdb.crsr.execute('SELECT COUNT(*) FROM chemical_paper_mapping;')
-    cnt = msdb.crsr.fetchall()[0][0]
+    cnt = msdb.count_table_rows('chemical_paper_mapping')
     print('Number of rows in chemical-paper-mapping: {}'.format(cnt))
     
     # setting up the logger
@@ -75,13 +74,21 @@ def cooccurrences(Y_terms, ents, **kwargs):
                  The earliest one is published in {}'.format(len(Y_papers), min_yr))
     cocrs = np.zeros((len(ents), len(yrs)))
     ents = np.array(ents)
+    # chemicals of the Y-papers are looked up in blocks of 1000 papers, with
+    # one query per block (grouped by paper IDs)
+    block_size = 1000
     for i,yr in enumerate(Y_years):
         yr_loc = yr - min_yr
+        if not(i%block_size):
+            block = [int(x) for x in Y_papers[i:i+block_size]]
+            block_ents = msdb.get_LoE_by_PID(block, cols=['formula'])
+            if len(block_ents)==0:
+                block_ents = {}
 
         # add co-occurrences to all chemicals present in this paper
         # all chemicals in this paper
-        present_ents = msdb.get_chemicals_by_paper_ids(int(Y_papers[i]), cols=['formula'])
-        present_ents_formula = present_ents[int(Y_papers[i])]['formula'] if len(present_ents)>0 else []
+        pid = int(Y_papers[i])
+        present_ents_formula = block_ents[pid]['formula'] if pid in block_ents else []
         present_ents_formula = list(set(present_ents_formula).intersection(set(ents)))
         present_ents_locs = [np.where(ents==frml)[0][0] for frml in present_ents_formula]
         
@@ -124,9 +131,8 @@ def yearwise_SD(Y_terms, chems, **kwargs):
     logfile_path =   kwargs.get('logfile_path', None)
     logger = helpers.set_up_logger(__name__, logfile_path, logger_disable)
 
-    msdb.crsr.execute('SELECT COUNT(*) FROM paper;')
     logger.info('Total number of documents in the DB: {}'.format(
-        msdb.crsr.fetchall()[0][0]))
+        msdb.count_table_rows('paper')))
 
 
     # getting unique authors of Y-terms in different years
@@ -151,20 +157,27 @@ def yearwise_SD(Y_terms, chems, **kwargs):
     years = np.arange(min_yr, max_yr+1)
     save_dirname = kwargs.get('save_dirname', None)
     logger.info('Iterating over chemicals for computing social densities began.')
+    # authors of the chemicals are looked up in blocks of 1000 chemicals, with
+    # one query per block (grouped by chemicals)
+    block_size = 1000
     for i, chm in enumerate(chems):
         if not(i%1000) or (i==len(chems)-1):
             logger.info('Iteration {}..'.format(i))
             if save_dirname is not None:
                 np.savetxt(os.path.join(save_dirname, 'yr_SDs.txt'), yr_SDs)
+        if not(i%block_size):
+            block_Rs = msdb.get_LoA_by_ents(list(chems[i:i+block_size]),
+                                            cols=['author_id','P.date'],
+                                            years=np.unique(Y_years),
+                                            return_papers=False)
+            if len(block_Rs)==0:
+                block_Rs = {}
 
         # getting unique authors of this materials in different years
-        R = msdb.get_authors_by_chemicals([chm],
-                                          cols=['author_id','P.date'],
-                                          years=np.unique(Y_years),
-                                          return_papers=False)
-        if len(R)==0: continue
-        X_years = np.array([y.year for y in R[chm]['date']])
-        X_authors = {y: R[chm]['author_id'][X_years==y] for y in np.unique(X_years)}
+        if chm not in block_Rs: continue
+        R = block_Rs[chm]
+        X_years = np.array([y.year for y in R['date']])
+        X_authors = {y: R['author_id'][X_years==y] for y in np.unique(X_years)}
         overlap_dict, union_dict = yearwise_authors_set_op(X_authors, Y_authors)
         for yr in Y_authors:
             yr_SDs[i,yr-min_yr] = len(overlap_dict[yr])/len(union_dict[yr])
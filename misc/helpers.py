@@ -4,6 +4,8 @@ import copy
 import json
 import logging
 import numpy as np
+from collections import deque
+from multiprocessing import Pool
 
 
 def set_up_logger(log_name, logfile_path, logger_disable, file_mode='w'):
@@ -26,6 +28,36 @@ def set_up_logger(log_name, logfile_path, logger_disable, file_mode='w'):
 
     return logger
 
+def ordered_pool_map(func, items, nworkers, initializer=None, max_pending=None):
+    """Applying a function on a stream of items by a pool of `nworkers`
+    processes and yielding (item, result) pairs in the order of the items
+
+    At most `max_pending` items (default: twice the number of workers) are
+    taken from the stream before their results are yielded, hence the
+    items can be consumed lazily (e.g. from a database cursor). With a
+    single worker, everything runs in the calling process.
+    """
+
+    if nworkers<=1:
+        if initializer is not None:
+            initializer()
+        for x in items:
+            yield x, func(x)
+        return
+
+    max_pending = 2*nworkers if max_pending is None else max_pending
+    with Pool(nworkers, initializer=initializer) as pool:
+        pending = deque()
+        for x in items:
+            pending.append((x, pool.apply_async(func, (x,))))
+            if len(pending)>=max_pending:
+                x, res = pending.popleft()
+                yield x, res.get()
+        while len(pending)>0:
+            x, res = pending.popleft()
+            yield x, res.get()
+
+
 def locate_array_in_array(moving_arr, fixed_arr):
     """For each overlapping element in moving_arr, find its location 
     index in fixed_arr
@@ -42,6 +74,76 @@ def locate_array_in_array(moving_arr, fixed_arr):
     return sinds[locs_in_sorted]
 
 
+def align_scores_to_array(ents, terms, scores):
+    """Re-arranging scores that are given for a set of terms such that they
+    align with a fixed array of entities, i.e., the i-th output element will
+    be the score of `ents[i]`
+
+    Entities that do not exist among the terms get NaN scores.
+    """
+
+    terms = np.asarray(terms)
+    scores = np.asarray(scores, dtype=float)
+    aligned = np.full(len(ents), np.nan)
+    if len(terms)==0:
+        return aligned
+
+    sinds = np.argsort(terms)
+    locs = np.searchsorted(terms[sinds], ents)
+    locs[locs==len(terms)] = 0
+    hits = terms[sinds][locs]==ents
+    aligned[hits] = scores[sinds[locs[hits]]]
+
+    return aligned
+
+
+def top_k_inds(scores, k, mask=None):
+    """Returning indices of the `k` largest scores (in descending order of
+    the scores), optionally restricted to the entries where `mask` is True
+
+    NaN scores are never selected.
+    """
+
+    valid = ~np.isnan(scores)
+    if mask is not None:
+        valid = valid & mask
+    cand = np.where(valid)[0]
+    if k <= 0:
+        return cand[:0]
+    if len(cand) > k:
+        cand = np.sort(cand[np.argpartition(-scores[cand], k-1)[:k]])
+
+    return cand[np.argsort(-scores[cand], kind='stable')]
+
+
+def first_cocr_locs(cocrs):
+    """Returning, for each entity (row) of a co-occurrence matrix of size
+    |entities| x |years| (dense or sparse), the location of the first year
+    with a non-zero co-occurrence (-1 for entities without any)
+    """
+
+    nrows, ncols = cocrs.shape
+    if hasattr(cocrs, 'tocoo'):
+        cocrs = cocrs.tocoo()
+        nz = cocrs.data!=0
+        rows, cols = cocrs.row[nz], cocrs.col[nz]
+    else:
+        rows, cols = np.nonzero(np.asarray(cocrs))
+
+    locs = np.full(nrows, ncols)
+    np.minimum.at(locs, rows, cols)
+    locs[locs==ncols] = -1
+
+    return locs
+
+
+def find_first_time_cocrs(cocrs, yr_loc):
+    """Indices of entities whose first co-occurrence happened in the
+    year located at `yr_loc` (see `first_cocr_locs`)
+    """
+    return np.where(first_cocr_locs(cocrs)==yr_loc)[0]
+
+
 def find_studied_ents_VW(ents,VW,row_yrs,yr):
     """Generating entities that have been studied prior to the input 
     year based on a given vertex-weight matrix 
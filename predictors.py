@@ -33,8 +33,7 @@ def ySD(cocrs, ySD, years_of_cocrs_columns, **kwargs):
 
 
     # get all chemicals
-    msdb.crsr.execute('SELECT formula FROM chemical;')
-    chems = np.array([x[0] for x in msdb.crsr.fetchall()])
+    chems = msdb.get_1d_query('SELECT formula FROM chemical;')
 
     def ySD_predictor(year_of_pred, sub_chems):
 
@@ -138,8 +137,7 @@ def hypergraph_access(cocrs,
     return_scores = kwargs.get('return_scores', False)
 
     # get all chemicals
-    msdb.crsr.execute('SELECT formula FROM chemical;')
-    chems = np.array([x[0] for x in msdb.crsr.fetchall()])
+    chems = msdb.get_1d_query('SELECT formula FROM chemical;')
 
     def access_score(year_of_pred, sub_chems):
         
@@ -181,8 +179,7 @@ def random_deepwalk(cocrs,
 
 
     # get all chemicals
-    msdb.crsr.execute('SELECT formula FROM chemical;')
-    chems = np.array([x[0] for x in msdb.crsr.fetchall()])
+    chems = msdb.get_1d_query('SELECT formula FROM chemical;')
 
     # chemicals in the deepwalk
     deepwalk_chems,_ = hypergraphs.extract_chems_from_deepwalks(path_to_deepwalk)
@@ -265,8 +262,7 @@ def first_passage_distance_deepwalk(cocrs,
     saved_dists = kwargs.get('saved_dists', None)
 
     # get all chemicals
-    msdb.crsr.execute('SELECT formula FROM chemical;')
-    chems = np.array([x[0] for x in msdb.crsr.fetchall()])
+    chems = msdb.get_1d_query('SELECT formula FROM chemical;')
 
     # sentences
     sents = open(path_to_deepwalk, 'r').read().splitlines()
@@ -321,8 +317,7 @@ def hypergraph_author_accesss(path_to_VM_core,
     memory = kwargs.get('memory', 5)
 
     # get all chemicals
-    msdb.crsr.execute('SELECT formula FROM chemical;')
-    chems = np.array([x[0] for x in msdb.crsr.fetchall()])
+    chems = msdb.get_1d_query('SELECT formula FROM chemical;')
 
     def author_access_scores(year_of_pred, size=0):
 
@@ -375,37 +370,35 @@ def mfw2v_deepwalk(cocrs,
     return_scores = kwargs.get('return_scores', False)
 
     # get all chemicals
-    msdb.crsr.execute('SELECT formula FROM chemical;')
-    chems = np.array([x[0] for x in msdb.crsr.fetchall()])
+    chems = msdb.get_1d_query('SELECT formula FROM chemical;')
 
     # keyword is always the first token
     KW = mfw2v.ind2tok[0]
+
+    # similarities to the keyword do not depend on the year of prediction,
+    # hence they are computed only once and aligned with the chemicals
+    # (chemicals absent from the deepwalk sentences get NaN similarities)
+    sorted_dw_chems = mfw2v.get_most_similar_terms(KW, None, len(mfw2v.uni_counts))
+    sims = helpers.align_scores_to_array(chems,
+                                         np.array([x[0] for x in sorted_dw_chems]),
+                                         np.array([x[1] for x in sorted_dw_chems]))
+    
     def predictor(year_of_pred, sub_chems):
-        
-        if sub_chems is not None:
-            overlap_indic = np.in1d(chems, sub_chems)
-            sub_cocrs = cocrs[overlap_indic, :]
-            sub_chems = chems[np.isin(chems,sub_chems)]
-        else:
-            sub_chems = chems
-            sub_cocrs = cocrs
+
+        sub_indic = np.ones(len(chems), dtype=bool) if sub_chems is None \
+            else np.isin(chems, sub_chems)
 
         """ Restricting Attention to Unstudied Materials """
         yr_loc = np.where(years_of_cocrs_columns==year_of_pred)[0][0]
-        unstudied_indic = np.sum(sub_cocrs[:,:yr_loc], axis=1)==0
-        sub_chems = sub_chems[unstudied_indic]
+        unstudied_indic = np.sum(cocrs[:,:yr_loc], axis=1)==0
 
-        # sort chemicals based on their counts in the deepwalk sentences
-        sorted_dw_chems = mfw2v.get_most_similar_terms(KW, None, len(mfw2v.uni_counts))
-        sorted_scores = np.array([x[1] for x in sorted_dw_chems])
-        sorted_dw_chems = np.array([x[0] for x in sorted_dw_chems])
-        sorted_dw_sub_chems = sorted_dw_chems[np.isin(sorted_dw_chems, sub_chems)]
-        sorted_dw_sub_chems_scores = sorted_scores[np.isin(sorted_dw_chems, sub_chems)]
+        # sort chemicals based on their similarities to the keyword
+        sorted_inds = helpers.top_k_inds(sims, pred_size, sub_indic & unstudied_indic)
 
         if return_scores:
-            return sorted_dw_sub_chems[:pred_size], sorted_dw_chems_scores[:pred_size]
+            return chems[sorted_inds], sims[sorted_inds]
         else:
-            return sorted_dw_sub_chems[:pred_size]
+            return chems[sorted_inds]
 
     return predictor
 
@@ -420,37 +413,28 @@ def pred_with_sims(cocrs,
     return_scores = kwargs.get('return_scores', False)
 
     # get all chemicals
-    msdb.crsr.execute('SELECT formula FROM chemical;')
-    chems = np.array([x[0] for x in msdb.crsr.fetchall()])
+    chems = msdb.get_1d_query('SELECT formula FROM chemical;')
 
+    # similarities are saved in the same order as the chemicals in the deepwalk;
+    # load them once and align them with the chemicals
     dw_chems = hypergraphs.extract_chems_from_deepwalks(path_to_dw)[0]
+    sims = helpers.align_scores_to_array(chems, dw_chems, np.loadtxt(path_to_sims))
     
     def predictor(year_of_pred, sub_chems):
-        
-        if sub_chems is not None:
-            overlap_indic = np.in1d(chems, sub_chems)
-            sub_cocrs = cocrs[overlap_indic, :]
-            sub_chems = chems[np.isin(chems,sub_chems)]
-        else:
-            sub_chems = chems
-            sub_cocrs = cocrs
+
+        sub_indic = np.ones(len(chems), dtype=bool) if sub_chems is None \
+            else np.isin(chems, sub_chems)
 
         """ Restricting Attention to Unstudied Materials """
         yr_loc = np.where(years_of_cocrs_columns==year_of_pred)[0][0]
-        unstudied_indic = np.sum(sub_cocrs[:,:yr_loc], axis=1)==0
-        sub_chems = sub_chems[unstudied_indic]
+        unstudied_indic = np.sum(cocrs[:,:yr_loc], axis=1)==0
         
         # sort chemicals based on their similarities
-        sims = np.loadtxt(path_to_sims)
-
-        dw_sub_chems = dw_chems[np.isin(dw_chems, sub_chems)]
-        sub_sims = sims[np.isin(dw_chems,sub_chems)]
-        
-        sorted_inds = np.argsort(-sub_sims)[:pred_size]
+        sorted_inds = helpers.top_k_inds(sims, pred_size, sub_indic & unstudied_indic)
     
         if return_scores:
-            return dw_sub_chems[sorted_inds], sub_sims[sorted_inds]
+            return chems[sorted_inds], sims[sorted_inds]
         else:
-            return dw_sub_chems[sorted_inds]
+            return chems[sorted_inds]
 
     return predictor